@@ -3,12 +3,20 @@ import csv
 import pickle
 import random
 import sys, io
-from src.preprocess import load_data, build_vocab
+import argparse
+from src.preprocess import load_data, build_vocab, build_vocab_streaming, map_unk, StreamingCorpus, TOKENIZERS
+from src.corpus_cache import cached_split
 from src.ngram_model import NGramModel
-from src.smoothing import AddOneSmoothing, LinearInterpolation, StupidBackoff
+from src.packed_model import PackedNGramModel, Vocabulary
+from src.parallel_train import train_all_orders
+from src.smoothing import AddOneSmoothing, LinearInterpolation, StupidBackoff, KneserNeySmoothing
 from src.evaluate import evaluate_model
 from src.fine_tuning import tune_lambdas_4gram, tune_alpha_4gram
-from src.generate import generate_text
+from src.generate import generate_batch
+from src.model_io import save_packed_models, load_packed_models, convert_pickles, save_smoothed, load_smoothed
+from src.arpa import write_arpa
+from src.compress import compression_report, compile_checked
+from src.instrument import stage, timed, profiling, write_report
 
 # ----------------------------------------------------
 # UTF-8 Safe Console Output for Windows
@@ -21,12 +29,14 @@ sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8")
 def ensure_dir(path):
     os.makedirs(path, exist_ok=True)
 
+@timed("pickle.save")
 def save_model(obj, path):
     ensure_dir(os.path.dirname(path))
     with open(path, "wb") as f:
         pickle.dump(obj, f)
     print(f"[SAVED] {os.path.basename(path)}")
 
+@timed("pickle.load")
 def load_model(path):
     with open(path, "rb") as f:
         obj = pickle.load(f)
@@ -50,34 +60,79 @@ def log_result(model_name, setting, perplexity):
 # ----------------------------------------------------
 # Data Loading & Training
 # ----------------------------------------------------
-def load_datasets():
-    print("[INFO] Loading datasets...")
-    train = load_data("data/ptb.train.txt")
-    dev   = load_data("data/ptb.valid.txt")
-    test  = load_data("data/ptb.test.txt")
-    train, vocab = build_vocab(train)
-    dev, _ = build_vocab(dev)
-    test, _ = build_vocab(test)
+@timed("load_datasets")
+def load_datasets(streaming=False, tokenizer="line", cache=True):
+    """
+    streaming=True keeps the training split on disk (re-read chunk by chunk per pass).
+    PTB is one pre-tokenized sentence per line, so the default "line" tokenizer
+    needs no NLTK; "regex" and "nltk" are there for raw text.
+    Dev and test are mapped onto the training vocabulary (unseen words → <unk>).
+    With cache=True the encoded splits are stored under cache/corpora and
+    memory-mapped on later runs instead of being tokenized again.
+    """
+    print(f"[INFO] Loading datasets ({tokenizer} tokenizer)...")
+    if streaming:
+        train, vocab = build_vocab_streaming("data/ptb.train.txt", tokenizer=tokenizer)
+    elif cache:
+        train, vocab = cached_split("data/ptb.train.txt", tokenizer)
+    else:
+        train = load_data("data/ptb.train.txt", tokenizer)
+        train, vocab = build_vocab(train)
+    if cache:
+        dev, _ = cached_split("data/ptb.valid.txt", tokenizer, vocab)
+        test, _ = cached_split("data/ptb.test.txt", tokenizer, vocab)
+    else:
+        dev = list(map_unk(load_data("data/ptb.valid.txt", tokenizer), vocab))
+        test = list(map_unk(load_data("data/ptb.test.txt", tokenizer), vocab))
     print("[INFO] Data successfully loaded.")
     return train, dev, test, vocab
 
-def train_ngram_models(train):
+@timed("train_ngram_models")
+def train_ngram_models(train, packed=False, workers=0):
+    """
+    packed=True uses the integer-ID, array-backed count store (shared vocab).
+    workers>0 counts all four orders in one sharded pass over `train` on that
+    many processes (always produces packed models).
+    """
     print("[INFO] Training N-gram models...")
-    uni = NGramModel(1); uni.train(train)
-    bi  = NGramModel(2); bi.train(train)
-    tri = NGramModel(3); tri.train(train)
-    tetra = NGramModel(4); tetra.train(train)
+    if workers:
+        uni, bi, tri, tetra = train_all_orders(train, (1, 2, 3, 4), workers=workers)
+    else:
+        if packed:
+            ids = Vocabulary()
+            uni, bi, tri, tetra = [PackedNGramModel(n, ids) for n in (1, 2, 3, 4)]
+        else:
+            uni, bi, tri, tetra = [NGramModel(n) for n in (1, 2, 3, 4)]
+        for m in (uni, bi, tri, tetra):
+            m.train(train)
     print("[INFO] Training complete.")
     return uni, bi, tri, tetra
 
+BASE_MODEL_DIR = "models/base"
+
 def save_base_models(models):
-    names = ["uni", "bi", "tri", "tetra"]
-    for m, name in zip(models, names):
-        save_model(m, f"models/{name}.pkl")
+    """Write the base models in the memory-mappable binary format."""
+    if not all(isinstance(m, PackedNGramModel) for m in models):
+        ids = Vocabulary()
+        models = [PackedNGramModel.from_model(m, ids) for m in models]
+    save_packed_models(models, BASE_MODEL_DIR)
+
+def update_base_models(new_paths, tokenizer="line"):
+    """Append new documents to the saved base models without retraining from scratch."""
+    models = load_packed_models(BASE_MODEL_DIR)
+    _, _, _, vocab = load_datasets(tokenizer=tokenizer)
+    for path in new_paths:
+        print(f"[INFO] Updating base models with {path}...")
+        docs = list(StreamingCorpus(path, vocab, tokenizer=tokenizer))
+        for m in models:
+            m.update(docs)
+    save_base_models(models)
+    return models
 
 # ----------------------------------------------------
 # Evaluation
 # ----------------------------------------------------
+@timed("evaluate_unsmoothed")
 def evaluate_unsmoothed(models, test):
     print("\n[INFO] Evaluating unsmoothed models...")
     for m in models:
@@ -85,6 +140,7 @@ def evaluate_unsmoothed(models, test):
         print(f"{m.n}-gram MLE perplexity: {pp:.2f}")
         log_result(f"{m.n}-gram", "MLE", pp)
 
+@timed("evaluate_add1")
 def evaluate_add1(models, test):
     print("\n[INFO] Evaluating Add-1 (Laplace) smoothing...")
     for m in models:
@@ -96,48 +152,74 @@ def evaluate_add1(models, test):
 # ----------------------------------------------------
 # Interpolation + Backoff
 # ----------------------------------------------------
-def build_interpolation_model(models, dev, test):
+@timed("build_interpolation_model")
+def build_interpolation_model(models, dev, test, racing=False):
     ensure_dir("models")
-    path = "models/interp_best.pkl"
+    path, legacy = "models/interp_best.json", "models/interp_best.pkl"
     if os.path.exists(path):
-        interp_best = load_model(path)
+        interp_best = load_smoothed(path, models)
+    elif os.path.exists(legacy):
+        # Older runs pickled the whole wrapper; keep its λs and context length (the
+        # constructor's default n=3 back then), rebuilt over the current base models
+        old = load_model(legacy)
+        interp_best = LinearInterpolation(models, old.lambdas, n=getattr(old, "n", 3))
+        save_smoothed(interp_best, path, BASE_MODEL_DIR)
     else:
         print("[INFO] Tuning λ₁–λ₄ using validation set...")
-        best_lambdas = tune_lambdas_4gram(models, dev, num_samples=500, refine_rounds=2, max_workers=8)
-        interp_best = LinearInterpolation(models, best_lambdas)
-        save_model(interp_best, path)
+        best_lambdas, _ = tune_lambdas_4gram(models, dev, num_samples=500, refine_rounds=2, max_workers=8,
+                                              racing=racing)
+        interp_best = LinearInterpolation(models, best_lambdas, n=4)
+        save_smoothed(interp_best, path, BASE_MODEL_DIR)
         print(f"[INFO] Best λs: {best_lambdas}")
     pp_interp = evaluate_model(interp_best, test)
     print(f"Final Test Perplexity (Interpolation): {pp_interp:.2f}")
     log_result("Interpolation", f"Tuned λ₁–λ₄ {tuple(round(l,3) for l in getattr(interp_best,'lambdas',[0,0,0,0]))}", pp_interp)
     return interp_best
 
-def build_backoff_model(models, dev, test):
+@timed("build_backoff_model")
+def build_backoff_model(models, dev, test, racing=False):
     ensure_dir("models")
-    path = "models/backoff_best.pkl"
+    path, legacy = "models/backoff_best.json", "models/backoff_best.pkl"
     if os.path.exists(path):
-        backoff_best = load_model(path)
+        backoff_best = load_smoothed(path, models)
+    elif os.path.exists(legacy):
+        backoff_best = StupidBackoff(models, alpha=load_model(legacy).alpha)
+        save_smoothed(backoff_best, path, BASE_MODEL_DIR)
     else:
         print("[INFO] Tuning α for Stupid Backoff...")
-        best_alpha, _ = tune_alpha_4gram(models, dev, alpha_values=[0.2,0.3,0.4,0.5,0.6], max_workers=6)
+        best_alpha, _ = tune_alpha_4gram(models, dev, alpha_values=[0.2,0.3,0.4,0.5,0.6], max_workers=6,
+                                        racing=racing)
         backoff_best = StupidBackoff(models, alpha=best_alpha)
-        save_model(backoff_best, path)
+        save_smoothed(backoff_best, path, BASE_MODEL_DIR)
         print(f"[INFO] Best α: {best_alpha}")
     pp_backoff = backoff_best.perplexity(test)
     print(f"Final Test Perplexity (Stupid Backoff): {pp_backoff:.2f}")
     log_result("Stupid Backoff", f"α={getattr(backoff_best,'alpha','?')}", pp_backoff)
     return backoff_best
 
+@timed("build_kneser_ney_model")
+def build_kneser_ney_model(models, test):
+    print("\n[INFO] Building interpolated Modified Kneser-Ney...")
+    kn = KneserNeySmoothing(models)
+    pp_kn = evaluate_model(kn, test)
+    print(f"Final Test Perplexity (Kneser-Ney): {pp_kn:.2f}")
+    log_result("Kneser-Ney", f"Modified KN, D={ {n: tuple(round(d, 3) for d in ds) for n, ds in kn.D.items()} }", pp_kn)
+    # Precompiled backoff form: same probabilities, no count arithmetic at query time
+    compiled, _, _ = compile_checked(kn, test)
+    write_arpa(compiled, os.path.join("models", "kn4.arpa"))
+    return kn
+
 # ----------------------------------------------------
 # Text Generation & Save
 # ----------------------------------------------------
-def generate_and_save(model, name, num=15, max_len=20):
+@timed("generate_and_save")
+def generate_and_save(model, name, num=15, max_len=20, top_k=None, top_p=None, seed=None):
     ensure_dir("results")
     out_path = f"results/generated_{name.lower().replace(' ', '_')}.txt"
     print(f"\n[INFO] Generating text using {name} model...")
+    texts = generate_batch(model, num=num, max_len=max_len, top_k=top_k, top_p=top_p, seed=seed)
     with open(out_path, "w", encoding="utf-8") as f:
-        for i in range(num):
-            text = generate_text(model, max_len=max_len)
+        for i, text in enumerate(texts):
             print(f"{i+1}. {text}")
             f.write(f"{i+1}. {text}\n")
     print(f"[SAVED] Generated text written to {out_path}")
@@ -145,25 +227,33 @@ def generate_and_save(model, name, num=15, max_len=20):
 # ----------------------------------------------------
 # Main Pipeline
 # ----------------------------------------------------
-def main():
-    train, dev, test, vocab = load_datasets()
+def main(tokenizer="line", cache=True, racing=False, report_compression=False):
+    train, dev, test, vocab = load_datasets(tokenizer=tokenizer, cache=cache)
 
     # Load or Train Base Models
     paths = [f"models/{n}.pkl" for n in ["uni","bi","tri","tetra"]]
-    if all(os.path.exists(p) for p in paths):
+    if os.path.exists(os.path.join(BASE_MODEL_DIR, "meta.json")):
         print("[INFO] Base models found — loading instead of retraining.")
-        uni, bi, tri, tetra = [load_model(p) for p in paths]
+        uni, bi, tri, tetra = load_packed_models(BASE_MODEL_DIR)
+    elif all(os.path.exists(p) for p in paths):
+        print("[INFO] Pickled base models found — converting to the binary format.")
+        uni, bi, tri, tetra = convert_pickles(paths, BASE_MODEL_DIR)
     else:
         uni, bi, tri, tetra = train_ngram_models(train)
         save_base_models([uni, bi, tri, tetra])
 
-    models = [uni, bi, tri, tetra]
+    # Inference only from here on: frozen lookups never grow the models
+    models = [m.freeze() for m in (uni, bi, tri, tetra)]
 
     evaluate_unsmoothed(models, test)
     evaluate_add1(models, test)
 
-    interp_best = build_interpolation_model(models, dev, test)
-    backoff_best = build_backoff_model([tetra, tri, bi, uni], dev, test)
+    interp_best = build_interpolation_model(models, dev, test, racing)
+    backoff_best = build_backoff_model([tetra, tri, bi, uni], dev, test, racing)
+    build_kneser_ney_model(models, test)
+    if report_compression:
+        with stage("compression_report"):
+            compression_report(models, dev, base_path=BASE_MODEL_DIR)
 
     generate_and_save(interp_best, "linear_Interpolation")
     generate_and_save(backoff_best, "Stupid_Backoff")
@@ -172,4 +262,20 @@ def main():
 
 # ----------------------------------------------------
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Train, tune and evaluate the N-gram models")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default="line",
+                        help="line: pre-tokenized, one sentence per line (PTB); regex / nltk for raw text")
+    parser.add_argument("--no-cache", action="store_true", help="re-tokenize instead of using cache/corpora")
+    parser.add_argument("--racing", action="store_true",
+                        help="tune λ/α by successive halving on growing dev subsamples (results/racing_log.csv)")
+    parser.add_argument("--report-compression", action="store_true",
+                        help="also write the perplexity vs. size report (results/compression_report.csv; slow)")
+    parser.add_argument("--profile", choices=["cprofile", "sample"], help="profile the whole run")
+    parser.add_argument("--report", default=os.path.join("results", "run_report.json"),
+                        help="per-run instrumentation report (stage timings, counters, cache hit rates)")
+    args = parser.parse_args()
+    ensure_dir("results")
+    with profiling(args.profile, os.path.join("results", "profile.prof")), stage("main"):
+        main(args.tokenizer, cache=not args.no_cache, racing=args.racing,
+             report_compression=args.report_compression)
+    write_report(args.report)
@@ -0,0 +1,329 @@
+import math
+import numpy as np
+from src.packed_model import Vocabulary, key_bits, pack_keys, unpack_keys, shared_tables
+from src.smoothing import LinearInterpolation, StupidBackoff, KneserNeySmoothing
+from src.evaluate import evaluate_model
+from src.instrument import count, timed
+
+ARPA_ZERO = -99.0  # log10 "probability zero" used by ARPA toolkits
+
+
+def _find(keys, query):
+    """Index of each query key in a sorted key array, -1 where absent (or query < 0)."""
+    if len(keys) == 0:
+        return np.full(len(query), -1, dtype=np.int64)
+    idx = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where((keys[idx] == query) & (query >= 0), idx, -1)
+
+
+class BackoffModel:
+    """
+    Static backoff language model: for every listed n-gram a log10 probability
+    and (below the top order) a log10 backoff weight, stored as sorted packed
+    int64 keys with aligned float arrays per order. A query walks down from the
+    longest matching n-gram, adding the backoff weights of the contexts it
+    leaves, so there is no count arithmetic on the hot path. This is the
+    engine behind compile_backoff() and read_arpa().
+    """
+    scoring = "backoff"  # batch path in src.batch_scoring
+
+    def __init__(self, ids, orders):
+        # orders: {n: (keys, logprob, backoff)} with keys packed using key_bits(len(ids))
+        self.ids = ids
+        self.bits = key_bits(len(ids))
+        self.orders = orders
+        self.n = max(orders)
+        unigram_ids = unpack_keys(orders[1][0], 1, self.bits)[:, 0]
+        self.vocab = {ids.words[i] for i in unigram_ids}
+        self.unk = ids.index.get("<unk>", -1) if "<unk>" in self.vocab else -1
+
+    def _encode(self, tokens):
+        key = 0
+        for w in tokens:
+            idx = self.ids.index.get(w)
+            if idx is None:
+                return None
+            key = (key << self.bits) | idx
+        return key
+
+    def _find_one(self, n, key):
+        keys = self.orders[n][0]
+        i = int(np.searchsorted(keys, key))
+        return i if i < len(keys) and keys[i] == key else -1
+
+    def log10_prob(self, context, word):
+        count("prob.arpa")
+        if word not in self.ids.index and self.unk >= 0:
+            word = "<unk>"
+        context = tuple(context)[-(self.n - 1):] if self.n > 1 else ()
+        bow = 0.0
+        for k in range(len(context) + 1, 0, -1):
+            h = context[len(context) - (k - 1):]
+            key = self._encode(h + (word,))
+            i = self._find_one(k, key) if key is not None else -1
+            if i >= 0:
+                return float(self.orders[k][1][i]) + bow
+            if k > 1:
+                ctx = self._encode(h)
+                j = self._find_one(k - 1, ctx) if ctx is not None else -1
+                if j >= 0:
+                    bow += float(self.orders[k - 1][2][j])
+        return -math.inf
+
+    def prob(self, context, word):
+        return 10.0 ** self.log10_prob(context, word)
+
+    def log10_probs(self, history, words, max_order=None, return_orders=False):
+        """
+        Vectorised query: `history` is an (T, h) matrix of this model's word IDs
+        (-1 for unknown), `words` a (T,) ID array. Returns log10 probabilities,
+        -inf where even the unigram is missing; with return_orders=True also the
+        order of the n-gram each probability came from (0 for none).
+        """
+        max_order = min(max_order or self.n, history.shape[1] + 1)
+        T = len(words)
+        bits = self.bits
+        if self.unk >= 0:
+            words = np.where(words >= 0, words, self.unk)
+        result = np.full(T, -np.inf)
+        bow = np.zeros(T)
+        done = np.zeros(T, dtype=bool)
+        used = np.zeros(T, dtype=np.int8)
+        for k in range(max_order, 0, -1):
+            h = history[:, history.shape[1] - (k - 1):] if k > 1 else history[:, :0]
+            ctx_ok = (h >= 0).all(axis=1)
+            ctx_keys = pack_keys(np.where(h >= 0, h, 0), bits)
+            ctx_keys[~ctx_ok] = -1
+            keys = (ctx_keys << bits) | np.where(words >= 0, words, 0)
+            keys[(ctx_keys < 0) | (words < 0)] = -1
+            i = _find(self.orders[k][0], keys)
+            hit = ~done & (i >= 0)
+            result[hit] = self.orders[k][1][i[hit]] + bow[hit]
+            used[hit] = k
+            done |= hit
+            if k > 1:
+                j = _find(self.orders[k - 1][0], ctx_keys)
+                back = ~done & (j >= 0)
+                bow[back] += self.orders[k - 1][2][j[back]]
+        return (result, used) if return_orders else result
+
+    def perplexity(self, data):
+        return evaluate_model(self, data)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for arrays in self.orders.values() for a in arrays)
+
+    def sizes(self):
+        return {n: len(arrays[0]) for n, arrays in sorted(self.orders.items())}
+
+
+# ----------------------------------------------------
+# Compiling smoothed models into backoff form
+# ----------------------------------------------------
+class _KneserNeySpec:
+    def __init__(self, model):
+        self.model = model
+        self.ids, self.bits = model.ids, model.bits
+        self.seen = {n: t.keys for n, t in model.tables.items()}
+        # Words without a continuation count still get gamma_1 * 1/V
+        gamma = model.gammas[1][0] if len(model.gammas[1]) else 1.0
+        self.unigram_floor = gamma / model.V
+
+    def backoff(self, k, ctx_keys):
+        table = self.model.tables[k]
+        i = _find(table.ctx_keys, ctx_keys)
+        out = np.zeros(len(ctx_keys))
+        out[i >= 0] = np.log10(np.maximum(self.model.gammas[k][i[i >= 0]], 1e-300))
+        return out
+
+    def seen_prob(self, k, keys, lower):
+        table = self.model.tables[k]
+        i = _find(table.keys, keys)
+        c = _find(table.ctx_keys, keys >> self.bits)
+        lower = np.full(len(keys), 1.0 / self.model.V) if lower is None else lower
+        return self.model.alphas[k][i] + self.model.gammas[k][c] * lower
+
+
+class _InterpolationSpec:
+    # Order-k view: p_k = (λ_k mle_k + Λ_{k-1} p_{k-1}) / Λ_k with Λ_k = λ_1 + … + λ_k
+    def __init__(self, model):
+        models = sorted(zip(model.models, model.lambdas), key=lambda ml: ml[0].n)
+        if [m.n for m, _ in models] != list(range(1, len(models) + 1)):
+            raise ValueError("LinearInterpolation must cover orders 1..N to be compiled")
+        self.ids, self.bits, self.tables = shared_tables([m for m, _ in models])
+        self.lams = {m.n: lam for m, lam in models}
+        self.cum = np.cumsum([lam for _, lam in models])
+        if self.cum[0] <= 0:
+            raise ValueError("The unigram weight must be positive to compile an interpolated model")
+        self.seen = {n: t.keys for n, t in self.tables.items()}
+        self.unigram_floor = 0.0
+
+    def _mle(self, k, keys):
+        table = self.tables[k]
+        count = table.lookup(table.keys, table.counts, keys)
+        total = table.lookup(table.ctx_keys, table.ctx_totals, keys >> self.bits)
+        return np.where(total > 0, count / np.maximum(total, 1), 0.0)
+
+    def backoff(self, k, ctx_keys):
+        table = self.tables[k]
+        seen = _find(table.ctx_keys, ctx_keys) >= 0
+        return np.where(seen, math.log10(self.cum[k - 2] / self.cum[k - 1]), 0.0)
+
+    def seen_prob(self, k, keys, lower):
+        prob = self.lams[k] * self._mle(k, keys)
+        if lower is not None:
+            prob += self.cum[k - 2] * lower
+        return prob / self.cum[k - 1]
+
+
+class _StupidBackoffSpec:
+    def __init__(self, model):
+        self.ids, self.bits, self.tables = shared_tables(model.models)
+        self.log_alpha = math.log10(model.alpha)
+        self.seen = {n: t.keys for n, t in self.tables.items()}
+        self.unigram_floor = 0.0
+
+    def backoff(self, k, ctx_keys):
+        table = self.tables[k]
+        return np.where(_find(table.ctx_keys, ctx_keys) >= 0, self.log_alpha, 0.0)
+
+    def seen_prob(self, k, keys, lower):
+        table = self.tables[k]
+        count = table.lookup(table.keys, table.counts, keys)
+        total = table.lookup(table.ctx_keys, table.ctx_totals, keys >> self.bits)
+        return count / np.maximum(total, 1)
+
+
+@timed("compile_backoff")
+def compile_backoff(model, approximate=False):
+    """
+    Compile a smoothed model into a static BackoffModel. Every n-gram the model
+    has seen gets its smoothed probability at that order, every context its
+    backoff weight, and prefixes required by the ARPA format are added.
+    KneserNeySmoothing compiles exactly. LinearInterpolation and StupidBackoff
+    have no exact backoff form and are refused unless approximate=True: only
+    n-grams seen at the highest matching order keep their probability (PTB
+    4-gram dev PP 310 → 178 for interpolation, 397 → 164 for stupid backoff),
+    so compare with compress.compile_checked() before relying on one.
+    """
+    if isinstance(model, KneserNeySmoothing):
+        spec = _KneserNeySpec(model)
+    elif isinstance(model, (LinearInterpolation, StupidBackoff)):
+        if not approximate:
+            raise ValueError(f"{type(model).__name__} has no exact backoff form: its compiled probabilities "
+                             f"differ for most tokens; pass approximate=True to compile it anyway")
+        spec = (_InterpolationSpec if isinstance(model, LinearInterpolation) else _StupidBackoffSpec)(model)
+    else:
+        raise TypeError(f"compile_backoff supports KneserNeySmoothing, LinearInterpolation and StupidBackoff, "
+                        f"not {type(model).__name__}")
+    bits = spec.bits
+    N = max(spec.seen)
+
+    # Entries per order: seen n-grams plus every prefix of a higher-order entry,
+    # and every word of the vocabulary as a unigram
+    entries = {N: spec.seen[N]}
+    for k in range(N - 1, 0, -1):
+        entries[k] = np.union1d(spec.seen[k], entries[k + 1] >> bits)
+    entries[1] = np.union1d(entries[1], np.arange(len(spec.ids), dtype=np.int64))
+
+    orders = {}
+    engine = BackoffModel.__new__(BackoffModel)
+    engine.ids, engine.bits, engine.orders, engine.unk = spec.ids, bits, orders, -1
+    for k in range(1, N + 1):
+        keys = entries[k]
+        if k > 1:
+            # Contexts of order k are the order-(k-1) entries: fill in their backoffs
+            prev_keys, prev_logp, _ = orders[k - 1]
+            orders[k - 1] = (prev_keys, prev_logp, spec.backoff(k, prev_keys))
+        rows = unpack_keys(keys, k, bits)
+        if k > 1:
+            engine.n = k - 1
+            lower_log = engine.log10_probs(rows[:, 1:-1], rows[:, -1], max_order=k - 1)
+            lower = 10.0 ** lower_log
+        else:
+            lower = None
+        seen = _find(spec.seen[k], keys) >= 0
+        logp = np.empty(len(keys))
+        with np.errstate(divide="ignore"):
+            if seen.any():
+                logp[seen] = np.log10(spec.seen_prob(k, keys[seen], None if lower is None else lower[seen]))
+            if (~seen).any():
+                # Prefix-only entries: back off from their own context, as a query would
+                ctx_bow = np.zeros((~seen).sum())
+                if k > 1:
+                    j = _find(orders[k - 1][0], keys[~seen] >> bits)
+                    ctx_bow[j >= 0] = orders[k - 1][2][j[j >= 0]]
+                    logp[~seen] = ctx_bow + lower_log[~seen]
+                elif spec.unigram_floor > 0:
+                    logp[~seen] = math.log10(spec.unigram_floor)
+                else:
+                    logp[~seen] = ARPA_ZERO
+        logp = np.maximum(logp, ARPA_ZERO)
+        orders[k] = (keys, logp.astype(np.float32), np.zeros(len(keys), dtype=np.float32))
+    for k in range(1, N):
+        orders[k] = (orders[k][0], orders[k][1], orders[k][2].astype(np.float32))
+    return BackoffModel(spec.ids, orders)
+
+
+# ----------------------------------------------------
+# ARPA text format
+# ----------------------------------------------------
+def write_arpa(model, path, approximate=False):
+    """Export a BackoffModel (or any model compile_backoff accepts) to an ARPA file."""
+    if not isinstance(model, BackoffModel):
+        model = compile_backoff(model, approximate)
+    words = model.ids.words
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\\data\\\n")
+        for n, size in model.sizes().items():
+            f.write(f"ngram {n}={size}\n")
+        for n in sorted(model.orders):
+            keys, logp, bow = model.orders[n]
+            f.write(f"\n\\{n}-grams:\n")
+            rows = unpack_keys(keys, n, model.bits)
+            for row, lp, b in zip(rows, logp, bow):
+                gram = " ".join(words[i] for i in row)
+                if n < model.n:
+                    f.write(f"{lp:.6f}\t{gram}\t{b:.6f}\n")
+                else:
+                    f.write(f"{lp:.6f}\t{gram}\n")
+        f.write("\n\\end\\\n")
+    print(f"[SAVED] ARPA model → {path}")
+
+
+def read_arpa(path):
+    """Load an ARPA file into a BackoffModel."""
+    ids = Vocabulary()
+    raw = {}
+    n = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("ngram ") or line == "\\data\\":
+                continue
+            if line == "\\end\\":
+                break
+            if line.startswith("\\") and line.endswith("-grams:"):
+                n = int(line[1:line.index("-")])
+                raw[n] = ([], [], [])
+                continue
+            if n is None:
+                continue
+            parts = line.split()
+            logp = float(parts[0])
+            gram = parts[1:1 + n]
+            bow = float(parts[1 + n]) if len(parts) > 1 + n else 0.0
+            raw[n][0].append([ids.add(w) for w in gram])
+            raw[n][1].append(logp)
+            raw[n][2].append(bow)
+    bits = key_bits(len(ids))
+    if bits * max(raw) > 63:
+        raise ValueError(f"Vocabulary of {len(ids)} words is too large to pack {max(raw)}-grams into int64 keys")
+    orders = {}
+    for k, (rows, logp, bow) in raw.items():
+        keys = pack_keys(np.array(rows, dtype=np.int64).reshape(len(rows), k), bits)
+        order = np.argsort(keys, kind="stable")
+        orders[k] = (keys[order], np.array(logp, dtype=np.float32)[order], np.array(bow, dtype=np.float32)[order])
+    print(f"[LOADED] ARPA model {path} ({', '.join(f'{k}-grams={len(v[0])}' for k, v in sorted(orders.items()))})")
+    return BackoffModel(ids, orders)
@@ -0,0 +1,333 @@
+import numpy as np
+from src.vocabulary import Vocabulary, pack_keys
+from src.instrument import count
+from src.corpus_cache import EncodedSplit
+
+# ----------------------------------------------------
+# Vectorised scoring
+# Models name their batch path with a `scoring` class attribute instead of
+# being matched by type, so this module imports none of them and the model
+# modules can import evaluate_model (which calls into it) at the top.
+# ----------------------------------------------------
+class EncodedCorpus:
+    """
+    A corpus interned once for scoring with an order-n model: `history` is the
+    (T, n-1) matrix of preceding token IDs and `words` the (T,) target IDs, for
+    every scored token. IDs are corpus-local; `translate()` maps them into a
+    model's vocabulary.
+    """
+    def __init__(self, sentences, n):
+        self.n = n
+        self.ids = Vocabulary()
+        add = self.ids.add
+        flat, positions, offsets = [], [], [0]
+        for sentence in sentences:
+            start = len(flat)
+            flat.extend(add(w) for w in ["<s>"] * (n - 1) + list(sentence))
+            positions.extend(range(start + n - 1, len(flat)))
+            offsets.append(len(positions))
+        flat = np.array(flat, dtype=np.int64)
+        positions = np.array(positions, dtype=np.int64)
+        self.words = flat[positions] if len(positions) else np.zeros(0, dtype=np.int64)
+        self.history = flat[positions[:, None] + np.arange(-(n - 1), 0)] if len(positions) \
+            else np.zeros((0, n - 1), dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self._translations = {}
+        self._count_cache = {}
+
+    @classmethod
+    def from_arrays(cls, ids, words, history, offsets, n, translations=None, count_cache=None):
+        """
+        Wrap already-encoded arrays (IDs from the Vocabulary `ids`). A derived
+        corpus over the same vocabulary may share its parent's `translations`
+        and start from its (re-indexed) `count_cache`.
+        """
+        corpus = cls.__new__(cls)
+        corpus.n = n
+        corpus.ids = ids
+        corpus.words, corpus.history, corpus.offsets = words, history, offsets
+        corpus._translations = {} if translations is None else translations
+        corpus._count_cache = {} if count_cache is None else count_cache
+        return corpus
+
+    @classmethod
+    def from_split(cls, split, n):
+        """Build straight from an EncodedSplit's ID arrays, without re-interning tokens."""
+        ids = Vocabulary(split.words)
+        pad = ids.add("<s>")
+        lengths = np.diff(np.asarray(split.offsets))
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        # Token j of the split lands after n-1 pad slots per sentence so far
+        positions = np.arange(len(sentence), dtype=np.int64) + (n - 1) * (sentence + 1)
+        flat = np.full(len(sentence) + (n - 1) * len(lengths), pad, dtype=np.int64)
+        flat[positions] = split.ids
+        history = flat[positions[:, None] + np.arange(-(n - 1), 0)] if len(positions) \
+            else np.zeros((0, n - 1), dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return cls.from_arrays(ids, flat[positions], history, offsets, n)
+
+    def __len__(self):
+        return len(self.words)
+
+    def head(self, num_sentences):
+        """
+        Corpus of the first `num_sentences` sentences, sharing this one's arrays
+        and cached per-model lookups (sliced, not recomputed).
+        """
+        t = int(self.offsets[num_sentences])
+        return EncodedCorpus.from_arrays(
+            self.ids, self.words[:t], self.history[:t], self.offsets[:num_sentences + 1], self.n,
+            self._translations, {key: _tokens_of(value, slice(t)) for key, value in self._count_cache.items()})
+
+    def select(self, sentences):
+        """
+        Corpus of the given sentences in the given order (e.g. a shuffle), sharing
+        this one's vocabulary and reordering its cached per-model lookups.
+        """
+        sentences = np.asarray(sentences, dtype=np.int64)
+        lengths = np.diff(self.offsets)[sentences]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        tokens = np.repeat(self.offsets[sentences] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return EncodedCorpus.from_arrays(
+            self.ids, self.words[tokens], self.history[tokens], offsets, self.n,
+            self._translations, {key: _tokens_of(value, tokens) for key, value in self._count_cache.items()})
+
+    def translate(self, vocab):
+        """Corpus ID -> `vocab` ID array (-1 for tokens the vocab has never seen)."""
+        key = (id(vocab), len(vocab))
+        if key not in self._translations:
+            self._translations[key] = (vocab, vocab.lookup(self.ids.words))
+        return self._translations[key][1]
+
+    def contexts(self, length):
+        """String contexts of the given length, for models without a vectorised path."""
+        words = self.ids.words
+        cols = self.history[:, self.n - 1 - length:] if length else self.history[:, :0]
+        return [tuple(words[i] for i in row) for row in cols]
+
+
+def _tokens_of(cached, tokens):
+    # Cache entries are (owner, ..., arrays) tuples/lists: index every per-token
+    # array by `tokens` (a slice or an index array)
+    if isinstance(cached, np.ndarray):
+        return cached[tokens]
+    if isinstance(cached, (tuple, list)):
+        return type(cached)(_tokens_of(v, tokens) for v in cached)
+    return cached
+
+
+def as_corpus(sentences, n):
+    """EncodedCorpus for order n from token lists, an EncodedSplit (built once per order) or a corpus."""
+    if isinstance(sentences, EncodedCorpus):
+        return sentences
+    if isinstance(sentences, EncodedSplit):
+        corpus = sentences._corpora.get(n)
+        if corpus is None:
+            corpus = sentences._corpora[n] = EncodedCorpus.from_split(sentences, n)
+        return corpus
+    return EncodedCorpus(sentences, n)
+
+
+def model_vocabulary(model):
+    """Set of words a (smoothed, base or compiled) model can score."""
+    return set(getattr(model, "words", None) or getattr(model, "vocab", None) or model.models[-1].vocab)
+
+
+def _count_arrays(model, corpus):
+    """(counts, totals) for every corpus token under a base n-gram model, or None."""
+    scoring = getattr(model, "scoring", None)
+    if scoring == "suffix_array":
+        return _suffix_array_counts(model, corpus)
+    if scoring == "packed":
+        # Count tables are replaced (never mutated) on training, so a cached result
+        # stays valid for as long as the table object it was computed from is alive.
+        table = model.table
+        cached = corpus._count_cache.get(id(table))
+        if cached is not None and cached[0] is table:
+            return cached[1]
+        result = _lookup_counts(model, corpus)
+        corpus._count_cache[id(table)] = (table, result)
+        return result
+    if not hasattr(model, "packed"):
+        return None
+    # Dict-based models: their packed copy (built once per model version) is scored
+    return _count_arrays(model.packed(), corpus)
+
+
+def _suffix_array_counts(model, corpus):
+    # One pass over the index yields every order, so all views of it share the result
+    index = model.index
+    key = ("suffix_array", id(index))
+    cached = corpus._count_cache.get(key)
+    if cached is None or cached[0] is not index or cached[1] != index.version:
+        trans = corpus.translate(index.ids)
+        cached = (index, index.version, index.lookup(trans[corpus.history], trans[corpus.words]))
+        corpus._count_cache[key] = cached
+    by_order = cached[2]
+    if model.n > len(by_order):
+        # Context longer than the caller's: unknown context, as in _lookup_counts
+        zeros = np.zeros(len(corpus), dtype=np.int64)
+        return zeros, zeros
+    return by_order[model.n - 1]
+
+
+def _lookup_counts(packed, corpus):
+    k = packed.n - 1
+    T = len(corpus)
+    if k > corpus.n - 1:
+        # The caller's context is shorter than this model's: prob() sees an
+        # unknown context, exactly as the per-token code path does.
+        zeros = np.zeros(T, dtype=np.int64)
+        return zeros, zeros
+    table = packed.table
+    trans = corpus.translate(packed.ids)
+    # IDs interned after this table was packed (shared vocabularies) can't match
+    trans = np.where(trans < (1 << table.bits), trans, -1)
+    hist = trans[corpus.history[:, corpus.n - 1 - k:]] if k else np.zeros((T, 0), dtype=np.int64)
+    words = trans[corpus.words]
+    ctx_ok = (hist >= 0).all(axis=1)
+    ctx_keys = pack_keys(np.where(hist >= 0, hist, 0), table.bits)
+    ctx_keys[~ctx_ok] = -1
+    totals = table.lookup(table.ctx_keys, table.ctx_totals, ctx_keys)
+    full_keys = (ctx_keys << table.bits) | np.where(words >= 0, words, 0)
+    full_keys[~ctx_ok | (words < 0)] = -1
+    counts = table.lookup(table.keys, table.counts, full_keys)
+    return counts, totals
+
+
+def _generic_probs(model, corpus, context_len):
+    words = corpus.ids.words
+    targets = [words[i] for i in corpus.words]
+    return np.array([model.prob(c, w) for c, w in zip(corpus.contexts(context_len), targets)], dtype=np.float64)
+
+
+def token_probs(model, corpus):
+    """Probability of every token in an EncodedCorpus, resolved in bulk per n-gram order."""
+    scoring = getattr(model, "scoring", None)
+    if scoring == "interpolation":
+        prob = np.zeros(len(corpus))
+        for m, lam in zip(model.models, model.lambdas):
+            prob += lam * _component_probs(m, corpus)
+        return prob
+    if scoring == "stupid_backoff":
+        return _backoff_probs(model, corpus)
+    if scoring == "kneser_ney":
+        return _kneser_ney_probs(model, corpus)
+    if scoring == "backoff":
+        trans = corpus.translate(model.ids)
+        k = min(model.n - 1, corpus.n - 1)
+        hist = trans[corpus.history[:, corpus.n - 1 - k:]] if k else np.zeros((len(corpus), 0), dtype=np.int64)
+        return 10.0 ** model.log10_probs(hist, trans[corpus.words])
+    if scoring == "add_one":
+        arrays = _count_arrays(model.model, corpus)
+        if arrays is None:
+            return _generic_probs(model, corpus, corpus.n - 1)
+        counts, totals = arrays
+        return (counts + 1) / (totals + len(model.model.vocab))
+    return _component_probs(model, corpus)
+
+
+def order_probs(models, corpus):
+    """(tokens x models) matrix of each base model's probability on an EncodedCorpus."""
+    return np.column_stack([_component_probs(m, corpus) for m in models])
+
+
+def _component_probs(model, corpus):
+    """MLE probabilities of a base model, using the caller's context truncated to its order."""
+    arrays = _count_arrays(model, corpus)
+    if arrays is None:
+        return _generic_probs(model, corpus, min(model.n - 1, corpus.n - 1))
+    counts, totals = arrays
+    prob = np.zeros(len(corpus))
+    seen = totals > 0
+    prob[seen] = counts[seen] / totals[seen]
+    return prob
+
+
+def _backoff_probs(model, corpus):
+    T = len(corpus)
+    score = np.ones(T)
+    prob = np.zeros(T)
+    done = np.zeros(T, dtype=bool)
+    for m in model.models:
+        arrays = _count_arrays(m, corpus)
+        if arrays is None:
+            return _generic_probs(model, corpus, corpus.n - 1)
+        counts, totals = arrays
+        hit = ~done & (totals > 0) & (counts > 0)
+        prob[hit] = score[hit] * (counts[hit] / totals[hit])
+        done |= hit
+        score[~done] *= model.alpha
+    prob[~done] = score[~done] * (1.0 / len(model.models[0].vocab))
+    return prob
+
+
+def _find(table, query):
+    """Index of each query key in a sorted key array, -1 where absent."""
+    if len(table) == 0:
+        return np.full(len(query), -1, dtype=np.int64)
+    idx = np.minimum(np.searchsorted(table, query), len(table) - 1)
+    return np.where((table[idx] == query) & (query >= 0), idx, -1)
+
+
+def _kneser_ney_probs(model, corpus):
+    T = len(corpus)
+    bits = model.bits
+    trans = corpus.translate(model.ids)
+    words = trans[corpus.words]
+    prob = np.full(T, 1.0 / model.V)
+    for m in model.models:
+        k = m.n - 1
+        if k > corpus.n - 1:
+            continue
+        table = model.tables[m.n]
+        hist = trans[corpus.history[:, corpus.n - 1 - k:]] if k else np.zeros((T, 0), dtype=np.int64)
+        ctx_ok = (hist >= 0).all(axis=1)
+        ctx_keys = pack_keys(np.where(hist >= 0, hist, 0), bits)
+        ctx_keys[~ctx_ok] = -1
+        ci = _find(table.ctx_keys, ctx_keys)
+        full_keys = (ctx_keys << bits) | np.where(words >= 0, words, 0)
+        full_keys[(ci < 0) | (words < 0)] = -1
+        ni = _find(table.keys, full_keys)
+        seen = ci >= 0
+        alpha = np.where(ni >= 0, model.alphas[m.n][np.maximum(ni, 0)], 0.0)
+        prob[seen] = alpha[seen] + model.gammas[m.n][ci[seen]] * prob[seen]
+    return prob
+
+
+def score_batch(model, sentences):
+    """
+    Log2-probability of every scored token, in corpus order, as a NumPy array.
+    `sentences` may be a list of token lists or an EncodedCorpus built for
+    `model.n` (reuse one to score many model configurations cheaply).
+    """
+    corpus = as_corpus(sentences, model.n)
+    if corpus.n != model.n:
+        raise ValueError(f"Corpus encoded for order {corpus.n}, model has order {model.n}")
+    count("score.batches")
+    count("score.tokens", len(corpus))
+    with np.errstate(divide="ignore"):
+        return np.log2(token_probs(model, corpus))
+
+
+def batch_perplexity(model, sentences):
+    """Corpus perplexity from score_batch (inf if any token has zero probability)."""
+    log_probs = score_batch(model, sentences)
+    if len(log_probs) == 0 or not np.isfinite(log_probs).all():
+        return float("inf")
+    return float(2.0 ** (-log_probs.mean()))
+
+
+def sentence_logprobs(model, sentences):
+    """
+    Per-sentence total log2-probability and scored-token count, as two arrays.
+    A sentence containing a zero-probability token gets -inf.
+    """
+    corpus = as_corpus(sentences, model.n)
+    log_probs = score_batch(model, corpus)
+    lengths = np.diff(corpus.offsets)
+    sums = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(log_probs, corpus.offsets[:-1][nonempty])
+    return sums, lengths
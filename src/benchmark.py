@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from src.ngram_model import NGramModel
+from src.packed_model import PackedNGramModel, Vocabulary
+from src.parallel_train import train_all_orders
+from src.smoothing import AddOneSmoothing, LinearInterpolation, StupidBackoff, KneserNeySmoothing
+from src.arpa import compile_backoff
+from src.evaluate import evaluate_model
+from src.fine_tuning import tune_lambdas_4gram, tune_alpha_4gram, race_schedule
+from src.generate import generate_text, generate_batch
+from src.model_io import save_packed_models, load_packed_models
+
+SECTIONS = ["train", "score", "tune", "generate", "load"]
+ORDERS = (1, 2, 3, 4)
+
+# ----------------------------------------------------
+# Throughput benchmarks
+#   python -m src.benchmark --ptb data --synthetic 200000 1000000
+# Every run appends one JSON record (machine info, git commit, one entry per
+# measurement) to results/benchmarks.jsonl, so runs on different commits or
+# storage/engine variants can be compared line by line.
+# ----------------------------------------------------
+def load_lines(path, limit=None):
+    """PTB-style file: one pre-tokenized sentence per line, wrapped in <s> … </s>."""
+    sentences = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                sentences.append(["<s>"] + line.split() + ["</s>"])
+                if limit and len(sentences) >= limit:
+                    break
+    return sentences
+
+def synthetic_corpus(num_tokens, vocab_size=10000, zipf=1.1, mean_len=20, seed=0):
+    """Zipf-distributed random sentences totalling about `num_tokens` words."""
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, vocab_size + 1, dtype=np.float64)
+    p = ranks ** -zipf
+    words = rng.choice(vocab_size, size=num_tokens, p=p / p.sum())
+    lengths = np.maximum(1, rng.poisson(mean_len, size=num_tokens // max(mean_len, 1) + 1))
+    sentences, start = [], 0
+    for length in lengths:
+        if start >= num_tokens:
+            break
+        sentences.append(["<s>"] + [f"w{i}" for i in words[start:start + length]] + ["</s>"])
+        start += length
+    return sentences
+
+def split_dev(sentences, dev_fraction=0.1, seed=0):
+    """Hold out a dev split and map its unseen words to <unk> (which train gains once)."""
+    rng = random.Random(seed)
+    sentences = list(sentences)
+    rng.shuffle(sentences)
+    cut = max(1, int(len(sentences) * dev_fraction))
+    train, dev = sentences[cut:], sentences[:cut]
+    return map_to_vocab(train, dev)
+
+def map_to_vocab(train, dev):
+    vocab = {w for s in train for w in s}
+    train = train + [["<s>", "<unk>", "</s>"]]
+    return train, [[w if w in vocab else "<unk>" for w in s] for s in dev]
+
+def num_tokens(sentences):
+    return sum(len(s) for s in sentences)
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+def timed(fn, repeat=1):
+    """(result of the last call, first-call seconds, best seconds) over `repeat` calls."""
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times[0], min(times)
+
+def _entry(section, name, units, amount, first, best, **extra):
+    entry = {"section": section, "name": name, "units": units, "amount": amount,
+             "first_seconds": round(first, 6), "seconds": round(best, 6),
+             "per_second": round(amount / best, 2) if best > 0 else None,
+             # ru_maxrss never goes down: this is the high-water mark of the whole
+             # run so far, not what this measurement alone needed
+             "peak_rss_mb_cumulative": round(peak_rss_mb(), 1)}
+    entry.update(extra)
+    print(f"[BENCH] {section:<8} {name:<28} {entry['per_second'] or 0:>14,.1f} {units}/s  ({best:.3f}s)")
+    return entry
+
+# ----------------------------------------------------
+# Sections
+# ----------------------------------------------------
+def bench_train(train, repeat=1):
+    tokens = num_tokens(train)
+    results = []
+    for n in ORDERS:
+        _, first, best = timed(lambda: NGramModel(n).train(train), repeat)
+        results.append(_entry("train", f"dict.order{n}", "tokens", tokens, first, best, order=n))
+        _, first, best = timed(lambda: PackedNGramModel(n, Vocabulary()).train(train), repeat)
+        results.append(_entry("train", f"packed.order{n}", "tokens", tokens, first, best, order=n))
+    _, first, best = timed(lambda: train_all_orders(train, ORDERS), repeat)
+    results.append(_entry("train", "parallel.orders1-4", "tokens", tokens, first, best))
+    return results
+
+def build_models(train):
+    models = []
+    for n in ORDERS:
+        m = NGramModel(n)
+        m.train(train)
+        models.append(m.freeze())
+    return models
+
+def smoothed_models(models):
+    uni, bi, tri, tetra = models
+    kn = KneserNeySmoothing(models)
+    return {
+        "add1.order4": AddOneSmoothing(tetra),
+        "interpolation": LinearInterpolation(models, [0.1, 0.3, 0.3, 0.3], n=4),
+        "stupid_backoff": StupidBackoff([tetra, tri, bi, uni], alpha=0.4),
+        "kneser_ney": kn,
+        "kneser_ney.compiled": compile_backoff(kn),
+    }
+
+def bench_score(models, dev, repeat=1):
+    tokens = num_tokens(dev)
+    results = []
+    for name, model in smoothed_models(models).items():
+        pp, first, best = timed(lambda: evaluate_model(model, dev), repeat)
+        results.append(_entry("score", name, "tokens", tokens, first, best, perplexity=round(pp, 4)))
+    return results
+
+def race_min_sentences(dev, eta=3, rungs=3):
+    """
+    Smallest rung size for the racing rows: the tuners' default of 100 sentences
+    unless the dev set is too small to give `rungs` halvings above that.
+    """
+    return max(1, min(100, len(dev) // eta ** rungs))
+
+def bench_tune(models, dev, num_samples=200, repeat=1):
+    uni, bi, tri, tetra = models
+    results = []
+    min_sentences = race_min_sentences(dev)
+    # Tuning appends to results/*.csv: keep benchmark rows out of the real logs
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for mode, samples in (("matrix", num_samples), ("exact", max(8, num_samples // 10))):
+                for racing in (False, True):
+                    candidates = samples * 3  # random round + two refinement rounds of `samples`
+                    _, first, best = timed(lambda: tune_lambdas_4gram(
+                        models, dev, num_samples=samples, refine_rounds=2, mode=mode, racing=racing,
+                        min_sentences=min_sentences), repeat)
+                    if racing:
+                        rungs = len(race_schedule(samples, len(dev), min_sentences=min_sentences)) - 1
+                        results.append(_entry("tune", f"lambda.{mode}.racing", "candidates", candidates, first, best,
+                                              min_sentences=min_sentences, round1_rungs=rungs))
+                    else:
+                        results.append(_entry("tune", f"lambda.{mode}", "candidates", candidates, first, best))
+            _, first, best = timed(lambda: tune_lambdas_4gram(models, dev, optimizer="em"), repeat)
+            results.append(_entry("tune", "lambda.em", "runs", 1, first, best))
+            alphas = [round(a, 2) for a in np.linspace(0.1, 0.8, 8)]
+            for racing in (False, True):
+                _, first, best = timed(lambda: tune_alpha_4gram([tetra, tri, bi, uni], dev, alphas, racing=racing,
+                                                                min_sentences=min_sentences), repeat)
+                if racing:
+                    rungs = len(race_schedule(len(alphas), len(dev), min_sentences=min_sentences)) - 1
+                    results.append(_entry("tune", "alpha.racing", "candidates", len(alphas), first, best,
+                                          min_sentences=min_sentences, round1_rungs=rungs))
+                else:
+                    results.append(_entry("tune", "alpha", "candidates", len(alphas), first, best))
+        finally:
+            os.chdir(cwd)
+    return results
+
+def bench_generate(models, num=200, max_len=20, repeat=1):
+    uni, bi, tri, tetra = models
+    results = []
+    for name, model in (("interpolation", LinearInterpolation(models, [0.1, 0.3, 0.3, 0.3], n=4)),
+                        ("stupid_backoff", StupidBackoff([tetra, tri, bi, uni], alpha=0.4))):
+        random.seed(0)
+        texts, first, best = timed(lambda: [generate_text(model, max_len=max_len) for _ in range(num)], repeat)
+        results.append(_entry("generate", f"{name}.text", "tokens", num_tokens(t.split() for t in texts),
+                              first, best))
+        # Untruncated (main.py's default, the exact sparse sampler) and top-k (the dense path)
+        for suffix, top_k in (("batch", None), ("batch.top_k50", 50)):
+            texts, first, best = timed(lambda: generate_batch(model, num=num, max_len=max_len, top_k=top_k,
+                                                              seed=0), repeat)
+            results.append(_entry("generate", f"{name}.{suffix}", "tokens", num_tokens(t.split() for t in texts),
+                                  first, best, top_k=top_k))
+    return results
+
+def bench_load(models, repeat=1):
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for m in models:
+            path = os.path.join(scratch, f"order{m.n}.pkl")
+            with open(path, "wb") as f:
+                pickle.dump(m, f)
+            size = os.path.getsize(path)
+
+            def load():
+                with open(path, "rb") as f:
+                    return pickle.load(f)
+            _, first, best = timed(load, repeat)
+            results.append(_entry("load", f"pickle.order{m.n}", "MB", size / 2**20, first, best, bytes=size))
+        ids = Vocabulary()
+        base = os.path.join(scratch, "base")
+        save_packed_models([PackedNGramModel.from_model(m, ids) for m in models], base)
+
+        def load_binary():
+            # Touch every order so the lazy mmap loaders actually run
+            loaded = load_packed_models(base)
+            for m in loaded:
+                m.table
+            return loaded
+        _, first, best = timed(load_binary, repeat)
+        size = sum(os.path.getsize(os.path.join(base, f)) for f in os.listdir(base))
+        results.append(_entry("load", "binary.mmap", "MB", size / 2**20, first, best, bytes=size))
+    return results
+
+# ----------------------------------------------------
+# Runner
+# ----------------------------------------------------
+def run_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+def run_benchmarks(corpora, sections=SECTIONS, repeat=1, tune_samples=200, output=None):
+    """
+    Run the selected sections on each (name, train, dev) corpus and append one
+    JSON record to `output` (default results/benchmarks.jsonl). Returns the record.
+    """
+    record = dict(run_info(), repeat=repeat, corpora=[])
+    for name, train, dev in corpora:
+        print(f"\n[INFO] Benchmarking {name}: {num_tokens(train):,} train / {num_tokens(dev):,} dev tokens")
+        results = []
+        if "train" in sections:
+            results += bench_train(train, repeat)
+        models = build_models(train)
+        if "score" in sections:
+            results += bench_score(models, dev, repeat)
+        if "tune" in sections:
+            results += bench_tune(models, dev, tune_samples, repeat)
+        if "generate" in sections:
+            results += bench_generate(models, repeat=repeat)
+        if "load" in sections:
+            results += bench_load(models, repeat)
+        record["corpora"].append({"name": name, "train_tokens": num_tokens(train),
+                                  "dev_tokens": num_tokens(dev), "results": results})
+    record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    output = output or os.path.join("results", "benchmarks.jsonl")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"[LOGGED] Benchmark record appended to {output}")
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description="N-gram throughput benchmarks")
+    parser.add_argument("--ptb", metavar="DIR", help="benchmark on DIR/ptb.train.txt (+ ptb.valid.txt as dev)")
+    parser.add_argument("--train", help="any one-sentence-per-line training file")
+    parser.add_argument("--dev", help="dev file for --train (default: hold out 10%%)")
+    parser.add_argument("--limit", type=int, help="read at most this many training sentences")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[], metavar="TOKENS",
+                        help="synthetic Zipf corpora of these sizes")
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=SECTIONS)
+    parser.add_argument("--repeat", type=int, default=1, help="report the best of N runs")
+    parser.add_argument("--tune-samples", type=int, default=200)
+    parser.add_argument("--output", help="JSONL file to append to (default results/benchmarks.jsonl)")
+    args = parser.parse_args()
+
+    corpora = []
+    if args.ptb:
+        train = load_lines(os.path.join(args.ptb, "ptb.train.txt"), args.limit)
+        corpora.append(("ptb",) + map_to_vocab(train, load_lines(os.path.join(args.ptb, "ptb.valid.txt"))))
+    if args.train:
+        train = load_lines(args.train, args.limit)
+        pair = map_to_vocab(train, load_lines(args.dev)) if args.dev else split_dev(train)
+        corpora.append((os.path.basename(args.train),) + pair)
+    for size in args.synthetic:
+        corpora.append((f"synthetic{size}",) + split_dev(synthetic_corpus(size, args.vocab_size)))
+    if not corpora:
+        parser.error("nothing to benchmark: give --ptb, --train or --synthetic")
+    run_benchmarks(corpora, args.sections, args.repeat, args.tune_samples, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import csv
+import math
+import numpy as np
+from src.packed_model import PackedNGramModel, pack_keys, unpack_keys
+from src.smoothing import KneserNeySmoothing
+from src.arpa import BackoffModel, compile_backoff, _find
+from src.evaluate import evaluate_model
+
+# ----------------------------------------------------
+# Model compression
+#   prune_counts()   count cutoffs on base models, before smoothing
+#   entropy_prune()  Stolcke relative-entropy pruning of a BackoffModel
+#   quantize()       8/16-bit codebooks for log-probabilities and backoffs
+#   compression_report()  dev perplexity vs. size for a grid of settings
+#   compile_checked()     compile_backoff() plus the dev PP it costs
+# ----------------------------------------------------
+def compile_checked(model, data, approximate=False):
+    """
+    compile_backoff(model) and report the perplexity of the compiled model on
+    `data` against the original's. Returns (compiled, original PP, compiled PP).
+    """
+    compiled = compile_backoff(model, approximate)
+    pp_model, pp_compiled = evaluate_model(model, data), evaluate_model(compiled, data)
+    print(f"[COMPRESS] Compiled {type(model).__name__} to backoff form: PP {pp_compiled:.2f} "
+          f"vs {pp_model:.2f} original ({pp_compiled - pp_model:+.2f})")
+    return compiled, pp_model, pp_compiled
+
+def prune_counts(model, cutoffs, base_models=None):
+    """
+    Count cutoffs: drop n-grams seen fewer than cutoffs[n] times (e.g. {3: 2, 4: 2})
+    from a compiled model, so their probability falls back to the lower order.
+    Cutoffs are applied after smoothing, so Kneser-Ney continuation counts still
+    come from the full tables. `model` is a smoothed model (its base models give
+    the raw counts) or a BackoffModel together with `base_models`.
+    """
+    if not isinstance(model, BackoffModel):
+        base_models = model.models
+        model = compile_backoff(model)
+    if base_models is None:
+        raise ValueError("prune_counts needs the base models of a compiled BackoffModel for raw counts")
+    bits = model.bits
+    kept = dict(model.orders)
+    for m in sorted(base_models, key=lambda m: m.n, reverse=True):
+        cutoff = cutoffs.get(m.n, 0)
+        if cutoff <= 1 or m.n == 1:
+            continue
+        packed = m if isinstance(m, PackedNGramModel) else m.packed()
+        table = packed.table
+        keys, logp, bow = model.orders[m.n]
+        # Translate entries into the base model's IDs to look up their raw counts
+        trans = packed.ids.lookup(model.ids.words)
+        trans = np.where(trans < (1 << table.bits), trans, -1)
+        rows = trans[unpack_keys(keys, m.n, bits)]
+        local = pack_keys(np.maximum(rows, 0), table.bits)
+        local[(rows < 0).any(axis=1)] = -1
+        keep = table.lookup(table.keys, table.counts, local) >= cutoff
+        if m.n < model.n:
+            keep |= _find(kept[m.n + 1][0] >> bits, keys) >= 0
+        kept[m.n] = (keys[keep], logp[keep], bow[keep])
+        print(f"[PRUNE] {m.n}-grams with count < {cutoff}: kept {int(keep.sum())} / {len(keys)}")
+    return recompute_backoffs(BackoffModel(model.ids, kept))
+
+
+def _backoff_mass(model, k):
+    """
+    For the order-k entries grouped by context h: 1 - Σ p(w|h) and 1 - Σ p(w|h'),
+    the left-over mass the backoff weight of h redistributes (h' = h minus its
+    first word). Returns (contexts, numerators, denominators, lower log10 p per
+    entry, context index per entry).
+    """
+    keys, logp, _ = model.orders[k]
+    rows = unpack_keys(keys, k, model.bits)
+    lower = model.log10_probs(rows[:, 1:-1], rows[:, -1], max_order=k - 1)
+    p = 10.0 ** np.asarray(logp, dtype=np.float64)
+    ctx, starts, inverse = np.unique(keys >> model.bits, return_index=True, return_inverse=True)
+    num = 1.0 - (np.add.reduceat(p, starts) if len(starts) else np.zeros(0))
+    den = 1.0 - (np.add.reduceat(10.0 ** lower, starts) if len(starts) else np.zeros(0))
+    return ctx, np.maximum(num, 1e-12), np.maximum(den, 1e-12), lower, inverse
+
+
+def recompute_backoffs(model):
+    """
+    Renormalise a BackoffModel after entries were removed: each context's
+    backoff weight becomes (1 - Σ p(w|h)) / (1 - Σ p(w|h')) over its remaining
+    successors. Orders are processed bottom-up, so every lower-order query
+    already sees the updated weights.
+    """
+    orders = {k: (keys, logp, bow.copy()) for k, (keys, logp, bow) in model.orders.items()}
+    out = BackoffModel(model.ids, orders)
+    for k in range(1, out.n):
+        keys, _, bow = orders[k]
+        bow[:] = 0.0
+        if len(orders[k + 1][0]) == 0:
+            continue
+        ctx, num, den, _, _ = _backoff_mass(out, k + 1)
+        i = _find(keys, ctx)
+        bow[i[i >= 0]] = np.log10(num / den)[i >= 0]
+    return out
+
+
+def entropy_prune(model, threshold):
+    """
+    Stolcke pruning: remove every n-gram (order >= 2) whose removal raises the
+    model's perplexity by a relative amount below `threshold` (e.g. 1e-8),
+    letting the backoff estimate take over. Each n-gram is scored against the
+    original model, as in SRILM; n-grams that prefix a kept higher-order entry
+    stay. Backoff weights are renormalised afterwards.
+    """
+    if not isinstance(model, BackoffModel):
+        model = compile_backoff(model)
+    bits = model.bits
+    start = model.ids.index.get("<s>", -1)
+    kept = dict(model.orders)
+    for k in range(model.n, 1, -1):
+        keys, logp, bow = model.orders[k]
+        if len(keys) == 0:
+            continue
+        rows = unpack_keys(keys, k, bits)
+        ctx, num, den, lower, inverse = _backoff_mass(model, k)
+        ln10 = math.log(10)
+        p = 10.0 ** np.asarray(logp, dtype=np.float64)
+        ln_p, ln_lower = np.asarray(logp, dtype=np.float64) * ln10, lower * ln10
+        N, D = num[inverse], den[inverse]
+        ln_bow = np.log(N / D)
+        ln_bow_new = np.log((N + p) / (D + 10.0 ** lower))
+        # Probability of the context itself, chained through the model (<s> is given)
+        ln_ctx = np.zeros(len(keys))
+        for i in range(k - 1):
+            step = model.log10_probs(rows[:, :i], rows[:, i], max_order=i + 1) * ln10
+            ln_ctx += np.where(rows[:, i] == start, 0.0, step)
+        delta = -np.exp(ln_ctx) * (p * (ln_lower + ln_bow_new - ln_p) + N * (ln_bow_new - ln_bow))
+        remove = np.expm1(delta) < threshold
+        if k < model.n:
+            remove &= _find(kept[k + 1][0] >> bits, keys) < 0
+        keep = ~remove
+        kept[k] = (keys[keep], logp[keep], bow[keep])
+        print(f"[PRUNE] {k}-grams: kept {int(keep.sum())} / {len(keys)}")
+    return recompute_backoffs(BackoffModel(model.ids, kept))
+
+
+# ----------------------------------------------------
+# Quantization
+# ----------------------------------------------------
+class QuantizedArray:
+    """Read-only float array stored as uint8/uint16 codes into a float32 codebook."""
+    def __init__(self, codes, codebook):
+        self.codes = codes
+        self.codebook = codebook
+
+    @classmethod
+    def from_values(cls, values, bits=8, iterations=10):
+        """
+        1-D k-means (Lloyd) codebook seeded at quantiles: at most 2**bits centres,
+        and never a codebook larger than the codes themselves.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        dtype = np.uint8 if bits <= 8 else np.uint16
+        if len(values) == 0:
+            return cls(np.zeros(0, dtype=dtype), np.zeros(1, dtype=np.float32))
+        size = min(1 << bits, max(2, len(values) * np.dtype(dtype).itemsize // 4))
+        centres = np.unique(np.quantile(values, np.linspace(0, 1, size)))
+        for _ in range(iterations):
+            codes = np.searchsorted((centres[1:] + centres[:-1]) / 2, values)
+            sums = np.bincount(codes, weights=values, minlength=len(centres))
+            sizes = np.bincount(codes, minlength=len(centres))
+            centres = np.unique(np.where(sizes > 0, sums / np.maximum(sizes, 1), centres))
+        codes = np.searchsorted((centres[1:] + centres[:-1]) / 2, values)
+        return cls(codes.astype(dtype), centres.astype(np.float32))
+
+    def __getitem__(self, idx):
+        return self.codebook[self.codes[idx]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.codebook[self.codes])
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.codebook[self.codes]
+        return values if dtype is None else values.astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebook.nbytes
+
+
+def quantize(model, bits=8):
+    """Copy of a BackoffModel with per-order codebooks for log-probabilities and backoffs."""
+    if bits not in (8, 16):
+        raise ValueError(f"Quantization supports 8 or 16 bits, not {bits}")
+    orders = {}
+    for k, (keys, logp, bow) in model.orders.items():
+        orders[k] = (keys, QuantizedArray.from_values(logp, bits),
+                     QuantizedArray.from_values(bow, bits) if k < model.n else bow)
+    return BackoffModel(model.ids, orders)
+
+
+# ----------------------------------------------------
+# Perplexity vs. size report
+# ----------------------------------------------------
+def compression_report(models, dev, cutoffs=({}, {3: 2, 4: 2}), thresholds=(0, 1e-8, 1e-7, 1e-6),
+                       quant_bits=(None, 16, 8), build=KneserNeySmoothing, path=None, approximate=False,
+                       base_path=None):
+    """
+    Compile `build(models)` (default Kneser-Ney), then apply every combination of
+    count cutoffs, entropy-pruning threshold and quantization, and report dev
+    perplexity against in-memory size relative to the uncompressed model.
+    Rows are written to results/compression_report.csv and returned.
+    Builds without an exact backoff form need approximate=True (see compile_backoff).
+    `base_path` (a save_packed_models directory) adds its on-disk size for reference.
+    """
+    path = path or os.path.join("results", "compression_report.csv")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if base_path and os.path.isdir(base_path):
+        # File sizes only: never touches the (lazily mmap'd) tables themselves
+        size = sum(os.path.getsize(os.path.join(base_path, f)) for f in os.listdir(base_path))
+        print(f"[INFO] Base models on disk ({base_path}): {size / 2**20:.1f} MB")
+    smoothed = build(models)
+    full, _, _ = compile_checked(smoothed, dev, approximate)
+    rows, base = [], None
+    for cut in cutoffs:
+        compiled = prune_counts(full, cut, smoothed.models) if cut else full
+        for threshold in thresholds:
+            pruned = entropy_prune(compiled, threshold) if threshold else compiled
+            for bits in quant_bits:
+                model = quantize(pruned, bits) if bits else pruned
+                pp = evaluate_model(model, dev)
+                size = model.nbytes
+                base = base or (size, pp)
+                row = {"cutoffs": " ".join(f"{n}:{c}" for n, c in sorted(cut.items())) or "-",
+                       "threshold": threshold, "bits": bits or 32,
+                       "entries": sum(model.sizes().values()), "bytes": size,
+                       "size_ratio": round(base[0] / size, 2), "dev_pp": round(pp, 4),
+                       "pp_delta": round(pp - base[1], 4)}
+                rows.append(row)
+                print(f"[COMPRESS] cutoffs={row['cutoffs']} θ={threshold:g} bits={row['bits']} → "
+                      f"{size / 2**20:.2f} MB ({row['size_ratio']}× smaller), PP={pp:.2f} ({row['pp_delta']:+.2f})")
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"[LOGGED] Compression report saved to {path}")
+    return rows
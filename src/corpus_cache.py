@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from src.preprocess import load_data, build_vocab, map_unk, TOKEN_PATTERN
+from src.instrument import timed
+
+CACHE_DIR = os.path.join("cache", "corpora")
+CACHE_VERSION = 1
+
+# ----------------------------------------------------
+# Encoded corpus cache (one directory per key under cache/corpora/):
+#   meta.json      key inputs, sentence and token counts
+#   vocab.txt      ID -> token table (the training vocabulary)
+#   ids.npy        every token of every sentence as int32 IDs, concatenated
+#   offsets.npy    sentence start positions into ids (len = sentences + 1)
+# The key hashes the file contents, tokenizer settings and the vocabulary the
+# split was mapped onto, so a changed input simply lands in a new entry.
+# ----------------------------------------------------
+class EncodedSplit:
+    """
+    A tokenized, vocab-mapped corpus as flat token IDs plus sentence offsets.
+    Iterates as token lists wherever a list of sentences is expected; the
+    scoring engine reads the arrays directly (see batch_scoring.as_corpus).
+    """
+    def __init__(self, ids, offsets, words):
+        self.ids = ids
+        self.offsets = offsets
+        self.words = words
+        self._corpora = {}  # order -> EncodedCorpus built from these arrays
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _sentence(self, i):
+        words = self.words
+        return [words[t] for t in self.ids[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._sentence(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self._sentence(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._sentence(i)
+
+    @property
+    def num_tokens(self):
+        return int(self.offsets[-1])
+
+def file_digest(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def vocab_digest(vocab):
+    return hashlib.sha256("\n".join(vocab).encode("utf-8")).hexdigest()
+
+def encode_sentences(sentences, vocab, index=None):
+    """
+    EncodedSplit of token lists over `vocab`. Every token must be in it unless
+    the vocab has <unk>, which then stands in for unseen tokens. Pass a prebuilt
+    word -> ID `index` when encoding many batches over the same vocab.
+    """
+    index = index or {w: i for i, w in enumerate(vocab)}
+    lengths = [len(s) for s in sentences]
+    unk = index.get("<unk>")
+    tokens = (index[w] for s in sentences for w in s) if unk is None else \
+        (index.get(w, unk) for s in sentences for w in s)
+    ids = np.fromiter(tokens, dtype=np.int32, count=sum(lengths))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return EncodedSplit(ids, offsets, list(vocab))
+
+def save_split(split, path, meta):
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, "ids.npy"), split.ids)
+    np.save(os.path.join(tmp, "offsets.npy"), split.offsets)
+    with open(os.path.join(tmp, "vocab.txt"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{w}\n" for w in split.words))
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(dict(meta, sentences=len(split), tokens=split.num_tokens), f, indent=2)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Another run stored the same entry first; its contents are identical
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def load_split(path, mmap=True):
+    mode = "r" if mmap else None
+    with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+        words = [line.rstrip("\n") for line in f]
+    return EncodedSplit(np.load(os.path.join(path, "ids.npy"), mmap_mode=mode),
+                        np.load(os.path.join(path, "offsets.npy"), mmap_mode=mode), words)
+
+@timed("cached_split")
+def cached_split(path, tokenizer="line", vocab=None, min_freq=1, cache_dir=None):
+    """
+    Tokenized `path` as an EncodedSplit, from the cache when possible.
+    Without `vocab` the split defines its own (build_vocab with min_freq);
+    with one, out-of-vocabulary tokens map to <unk>. Returns (split, vocab).
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    meta = {"version": CACHE_VERSION, "file": file_digest(path), "tokenizer": tokenizer,
+            "pattern": TOKEN_PATTERN if tokenizer == "regex" else None,
+            "vocab": vocab_digest(vocab) if vocab is not None else None,
+            "min_freq": min_freq if vocab is None else None}
+    key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry, "meta.json")):
+        split = load_split(entry)
+        print(f"[CACHE] {os.path.basename(path)}: {len(split)} sentences memory-mapped from {entry}")
+        return split, split.words
+    sentences = load_data(path, tokenizer)
+    if vocab is None:
+        sentences, vocab = build_vocab(sentences, min_freq)
+    else:
+        sentences = list(map_unk(sentences, vocab))
+    split = encode_sentences(sentences, vocab)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_split(split, entry, dict(meta, source=path))
+    print(f"[CACHE] {os.path.basename(path)}: encoded {len(split)} sentences → {entry}")
+    return split, split.words
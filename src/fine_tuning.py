@@ -1,9 +1,13 @@
 import os
 import csv
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing as mp
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from src.smoothing import LinearInterpolation, StupidBackoff
 from src.evaluate import evaluate_model
+from src.batch_scoring import as_corpus, order_probs
+from src.instrument import count, timed, counted, add_counts, staged, current_stage
 
 def sample_lambdas(num_samples=1000):
     """Generate random λ1–λ4 that sum to 1."""
@@ -23,7 +27,7 @@ def refine_lambdas(best_lambdas, delta=0.05, num_samples=200):
         refined.append([v / s for v in perturbed])
     return refined
 
-def ensure_results_dir():
+def ensure_lambda_log():
     os.makedirs("results", exist_ok=True)
     log_path = os.path.join("results", "lambda_tuning_log.csv")
     if not os.path.exists(log_path):
@@ -32,36 +36,229 @@ def ensure_results_dir():
             writer.writerow(["Round", "Lambda1", "Lambda2", "Lambda3", "Lambda4", "Perplexity"])
     return log_path
 
-def tune_lambdas_4gram(models, dev, num_samples=800, refine_rounds=2, max_workers=8):
+# ----------------------------------------------------
+# Parallel evaluation (threads or processes) with a single CSV writer
+# ----------------------------------------------------
+class CsvBatchWriter:
+    """Single writer for tuning logs: rows are buffered and appended in batches."""
+    def __init__(self, path, flush_every=256):
+        self.path = path
+        self.flush_every = flush_every
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            with open(self.path, "a", newline="") as f:
+                csv.writer(f).writerows(self.rows)
+            self.rows = []
+
+# Models and dev corpus of a worker process, set once by the pool initializer
+# (never once per task). With the fork start method the initializer's arguments
+# are inherited copy-on-write rather than pickled. Thread pools get the state as
+# an argument instead, so the parent never keeps it here.
+_WORKER_STATE = {}
+
+def _init_worker(state):
+    _WORKER_STATE.update(state)
+
+def _eval_chunk(kind, params, state=None):
+    state = state or _WORKER_STATE
+    models, dev, n = state["models"], state["dev"], state["n"]
+    results = []
+    for p in params:
+        if kind == "lambda":
+            pp = evaluate_model(LinearInterpolation(models, p, n=n), dev)
+        else:
+            pp = evaluate_model(StupidBackoff(models, alpha=p), dev)
+        results.append((p, pp))
+    return results
+
+def parallel_evaluate(kind, params, models, dev, n, max_workers=8, executor="thread", chunksize=None):
+    """
+    Evaluate λ vectors (kind="lambda") or α values (kind="alpha") on a thread or
+    process pool; yields (param, perplexity) as chunks complete. The dev corpus
+    is encoded and its per-order lookups cached before any worker starts, so
+    forked workers share those arrays instead of recomputing them.
+    """
+    dev = as_corpus(dev, n)
+    order_probs(models, dev)
+    state = {"models": models, "dev": dev, "n": n}
+    chunksize = chunksize or max(1, len(params) // (max_workers * 4))
+    chunks = [params[i:i + chunksize] for i in range(0, len(params), chunksize)]
+
+    if executor == "process":
+        fork = "fork" in mp.get_all_start_methods()
+        pool = ProcessPoolExecutor(max_workers=max_workers,
+                                   mp_context=mp.get_context("fork" if fork else "spawn"),
+                                   initializer=_init_worker, initargs=(state,))
+        task_state = None
+    else:
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        task_state = state
+    with pool:
+        if executor == "process":
+            # Worker processes hand back the counters they bumped along with the results
+            futures = [pool.submit(counted, _eval_chunk, kind, chunk) for chunk in chunks]
+        else:
+            # Pool threads time their stages under the caller's (e.g. tune_lambdas/evaluate)
+            parent = current_stage()
+            futures = [pool.submit(staged, parent, _eval_chunk, kind, chunk, task_state) for chunk in chunks]
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+                if executor == "process":
+                    results, delta = results
+                    add_counts(delta)
+                count("tune.evaluations", len(results))
+                yield from results
+            except Exception as e:
+                print(f"[ERROR] Worker failed: {e}")
+
+# ----------------------------------------------------
+# Racing (successive halving) on growing dev subsamples
+# ----------------------------------------------------
+def racing_corpus(dev, n, seed=0):
+    """
+    Dev sentences in a fixed random order, encoded once: every rung's subsample
+    is a prefix of it (EncodedCorpus.head), so per-model lookups are shared.
+    An already encoded corpus is shuffled by sentence (EncodedCorpus.select).
+    """
+    corpus = as_corpus(dev, n)
+    return corpus.select(np.random.default_rng(seed).permutation(len(corpus.offsets) - 1))
+
+def race_schedule(num_candidates, num_sentences, eta=3, min_sentences=100):
+    """[(candidates scored, dev sentences used)] per rung; the last rung is the full dev set."""
+    rungs = 0
+    while eta ** (rungs + 1) <= num_candidates and num_sentences // eta ** (rungs + 1) >= min_sentences:
+        rungs += 1
+    schedule, k = [], num_candidates
+    for r in range(rungs, -1, -1):
+        schedule.append((k, max(1, num_sentences // eta ** r)))
+        k = -(-k // eta)
+    return schedule
+
+def successive_halving(candidates, evaluate, corpus, eta=3, min_sentences=100):
+    """
+    Score every candidate on a small dev prefix, keep the best 1/eta, and repeat
+    on eta× more sentences until the survivors are scored on the whole set.
+    evaluate(candidates, num_sentences) returns [(candidate, perplexity)].
+    Returns (full-dev results sorted by perplexity, race statistics).
+    """
+    num_sentences = len(corpus.offsets) - 1
+    stats = {"candidates": len(candidates), "rungs": [], "token_evaluations": 0,
+             "exhaustive_token_evaluations": len(candidates) * len(corpus)}
+    results = [(c, None) for c in candidates]
+    for keep, m in race_schedule(len(candidates), num_sentences, eta, min_sentences):
+        results = sorted(evaluate([c for c, _ in results[:keep]], m), key=lambda r: r[1])
+        tokens = int(corpus.offsets[m])
+        stats["token_evaluations"] += tokens * len(results)
+        stats["rungs"].append((len(results), m, tokens, results[0][1] if results else float("inf")))
+    return results, stats
+
+def log_race(search, round_id, stats):
+    """Append one row per rung to results/racing_log.csv and print the saving."""
+    os.makedirs("results", exist_ok=True)
+    log_path = os.path.join("results", "racing_log.csv")
+    new_file = not os.path.exists(log_path)
+    spent, full = stats["token_evaluations"], stats["exhaustive_token_evaluations"]
+    reduction = full / spent if spent else float("inf")
+    with open(log_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["Search", "Round", "Rung", "Candidates", "Sentences", "Tokens", "Best_Subset_PP",
+                             "Token_Evaluations", "Exhaustive_Token_Evaluations", "Reduction"])
+        for rung, (k, m, tokens, best) in enumerate(stats["rungs"]):
+            writer.writerow([search, round_id, rung, k, m, tokens, round(best, 4), spent, full, round(reduction, 2)])
+    print(f"[RACING] {stats['candidates']} candidates → {stats['rungs'][-1][0]} on the full dev set in "
+          f"{len(stats['rungs'])} rungs: {spent:,} token evaluations vs {full:,} exhaustive ({reduction:.1f}× fewer)")
+
+def dev_probability_matrix(models, dev, n=None):
+    """(dev tokens × models) probability matrix, computed once per tuning run."""
+    corpus = as_corpus(dev, n or max(m.n for m in models))
+    return order_probs(models, corpus)
+
+def matrix_perplexities(P, lambda_sets, block=256):
+    """Dev perplexity of each λ vector: one matrix product, then log and mean."""
+    L = np.asarray(lambda_sets, dtype=np.float64)
+    out = np.empty(len(L))
+    with np.errstate(divide="ignore"):
+        for i in range(0, len(L), block):
+            out[i:i + block] = 2.0 ** (-np.log2(P @ L[i:i + block].T).mean(axis=0))
+    return out
+
+def em_lambdas(P, init=None, max_iter=200, tol=1e-7):
+    """
+    EM re-estimation of interpolation weights on the dev probability matrix.
+    Each iteration sets λ_k to the mean posterior responsibility of model k.
+    Returns (lambdas, [(lambdas, perplexity) per iteration]).
+    """
+    K = P.shape[1]
+    lam = np.full(K, 1.0 / K) if init is None else np.asarray(init, dtype=np.float64)
+    # Tokens no model can explain carry no information about the weights
+    P = P[P.sum(axis=1) > 0]
+    trace, prev = [], -np.inf
+    for _ in range(max_iter):
+        mix = P * lam
+        total = mix.sum(axis=1)
+        ll = np.log2(total).mean()
+        trace.append((lam.tolist(), float(2.0 ** -ll)))
+        if ll - prev < tol:
+            break
+        prev = ll
+        lam = (mix / total[:, None]).mean(axis=0)
+    return lam.tolist(), trace
+
+@timed("tune_lambdas")
+def tune_lambdas_4gram(models, dev, num_samples=800, refine_rounds=2, max_workers=8,
+                       mode="matrix", optimizer="random", n=None, executor="thread",
+                       racing=False, eta=3, min_sentences=100):
     """
     Fast randomized + refinement fine-tuning for λ1–λ4 with CSV logging.
+    mode="matrix" precomputes the dev (tokens × orders) probability matrix once, so
+    each candidate costs one matrix-vector product; mode="exact" rebuilds a
+    LinearInterpolation per candidate on a thread pool (executor="process" for a
+    process pool that shares the models with workers).
+    optimizer="em" replaces random search with EM re-estimation of the weights.
+    racing=True races each round's candidates by successive halving on growing
+    dev subsamples (factor `eta`, from at least `min_sentences` sentences); only
+    the survivors get a full-dev perplexity (see results/racing_log.csv).
     """
-    log_path = ensure_results_dir()
+    n = n or max(m.n for m in models)
+    if mode == "matrix" or optimizer == "em":
+        return _tune_lambdas_matrix(models, dev, num_samples, refine_rounds, optimizer, n,
+                                    racing, eta, min_sentences)
+
+    log_path = ensure_lambda_log()
+    log = CsvBatchWriter(log_path)
     best_pp = float("inf")
     best_lambdas = None
+    dev = racing_corpus(dev, n) if racing else as_corpus(dev, n)
+    if racing:
+        # Lookups on the whole (shuffled) dev set once; every rung slices them
+        order_probs(models, dev)
 
-    def eval_lambdas(lambdas, round_id):
-        interp = LinearInterpolation(models, lambdas)
-        pp = evaluate_model(interp, dev)
-        # Log each evaluation
-        with open(log_path, "a", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([round_id, *[round(l, 4) for l in lambdas], round(pp, 4)])
-        return lambdas, pp
+    def evaluate(lambda_sets, num_sentences):
+        return list(parallel_evaluate("lambda", lambda_sets, models, dev.head(num_sentences), n,
+                                      max_workers, executor))
 
     def parallel_eval(lambda_sets, round_id):
-        results = []
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(eval_lambdas, lam, round_id) for lam in lambda_sets]
-            for future in as_completed(futures):
-                try:
-                    results.append(future.result())
-                except Exception as e:
-                    print(f"[ERROR] Thread failed: {e}")
+        if racing:
+            results, stats = successive_halving(lambda_sets, evaluate, dev, eta, min_sentences)
+            log_race("lambda", round_id, stats)
+        else:
+            results = list(parallel_evaluate("lambda", lambda_sets, models, dev, n, max_workers, executor))
+        for lam, pp in results:
+            log.add([round_id, *[round(l, 4) for l in lam], round(pp, 4)])
+        log.flush()
         return results
 
     # === Randomized search ===
-    print(f"[INFO] Randomized search over {num_samples} λ sets using {max_workers} threads...")
+    print(f"[INFO] Randomized search over {num_samples} λ sets using {max_workers} {executor} workers...")
     random_sets = sample_lambdas(num_samples)
     results = parallel_eval(random_sets, round_id=1)
     for lam, pp in results:
@@ -81,16 +278,65 @@ def tune_lambdas_4gram(models, dev, num_samples=800, refine_rounds=2, max_worker
     print(f"[FINAL RESULT] Tuned λs={best_lambdas}, Dev PP={best_pp:.2f}")
     print(f"[LOGGED] All evaluations saved to {log_path}")
     return best_lambdas, best_pp
+
+def _tune_lambdas_matrix(models, dev, num_samples, refine_rounds, optimizer, n,
+                         racing=False, eta=3, min_sentences=100):
+    log_path = ensure_lambda_log()
+    corpus = racing_corpus(dev, n) if racing else as_corpus(dev, n)
+    P = order_probs(models, corpus)
+    print(f"[INFO] Dev probability matrix: {P.shape[0]} tokens × {P.shape[1]} orders")
+
+    def log_rows(round_id, lambda_sets, pps):
+        with open(log_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerows([round_id, *[round(l, 4) for l in lam], round(pp, 4)]
+                             for lam, pp in zip(lambda_sets, pps))
+
+    if optimizer == "em":
+        best_lambdas, trace = em_lambdas(P)
+        count("tune.em_iterations", len(trace))
+        log_rows("EM", [lam for lam, _ in trace], [pp for _, pp in trace])
+        best_pp = float(matrix_perplexities(P, [best_lambdas])[0])
+        print(f"[EM] Converged after {len(trace)} iterations")
+    else:
+        print(f"[INFO] Randomized search over {num_samples} λ sets (matrix mode)...")
+        best_lambdas, best_pp = None, float("inf")
+        for round_id in range(1, refine_rounds + 2):
+            lambda_sets = sample_lambdas(num_samples) if round_id == 1 else refine_lambdas(best_lambdas, delta=0.05)
+            if racing:
+                def evaluate(candidates, num_sentences):
+                    count("tune.evaluations", len(candidates))
+                    return list(zip(candidates, matrix_perplexities(P[:corpus.offsets[num_sentences]], candidates)))
+                results, stats = successive_halving(lambda_sets, evaluate, corpus, eta, min_sentences)
+                log_race("lambda", round_id, stats)
+                lambda_sets, pps = [lam for lam, _ in results], np.array([pp for _, pp in results])
+            else:
+                pps = matrix_perplexities(P, lambda_sets)
+                count("tune.evaluations", len(lambda_sets))
+            log_rows(round_id, lambda_sets, pps)
+            i = int(np.argmin(pps))
+            if pps[i] < best_pp:
+                best_pp, best_lambdas = float(pps[i]), lambda_sets[i]
+            print(f"[ROUND {round_id}] Best λ={best_lambdas} → PP={best_pp:.2f}")
+
+    print(f"[FINAL RESULT] Tuned λs={best_lambdas}, Dev PP={best_pp:.2f}")
+    print(f"[LOGGED] All evaluations saved to {log_path}")
+    return best_lambdas, best_pp
+
 def ensure_results_dir():
     os.makedirs("results", exist_ok=True)
     return os.path.join("results", "alpha_tuning_log.csv")
 
-def tune_alpha_4gram(models, dev, alpha_values=None, max_workers=6):
+@timed("tune_alpha")
+def tune_alpha_4gram(models, dev, alpha_values=None, max_workers=6, executor="thread",
+                     racing=False, eta=3, min_sentences=100):
     """
     Parallel α tuning for 4-gram Stupid Backoff with CSV logging.
     models: [four, tri, bi, uni]
     dev: development set
     alpha_values: list of α values to try
+    executor: "thread" or "process" (models shared with workers via fork)
+    racing: successive halving on growing dev subsamples, as in tune_lambdas_4gram
     """
     if alpha_values is None:
         alpha_values = [round(a, 2) for a in [0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8]]
@@ -100,30 +346,31 @@ def tune_alpha_4gram(models, dev, alpha_values=None, max_workers=6):
         with open(log_path, "w", newline="") as f:
             writer = csv.writer(f)
             writer.writerow(["Alpha", "Dev_Perplexity"])
+    log = CsvBatchWriter(log_path)
 
     best_alpha, best_pp = None, float("inf")
 
-    def eval_alpha(alpha):
-        backoff = StupidBackoff(models, alpha=alpha)
-        pp = backoff.perplexity(dev)
-        with open(log_path, "a", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([alpha, round(pp, 4)])
-        return alpha, pp
+    print(f"[INFO] Evaluating {len(alpha_values)} α values using {max_workers} {executor} workers...")
 
-    print(f"[INFO] Evaluating {len(alpha_values)} α values using {max_workers} threads...")
+    n = models[0].n
+    if racing:
+        corpus = racing_corpus(dev, n)
+        order_probs(models, corpus)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(eval_alpha, a) for a in alpha_values]
-        for future in as_completed(futures):
-            try:
-                alpha, pp = future.result()
-                print(f"[α={alpha:.2f}] Dev PP={pp:.2f}")
-                if pp < best_pp:
-                    best_alpha, best_pp = alpha, pp
-            except Exception as e:
-                print(f"[ERROR] α evaluation failed: {e}")
+        def evaluate(alphas, num_sentences):
+            return list(parallel_evaluate("alpha", alphas, models, corpus.head(num_sentences), n,
+                                          max_workers, executor))
+        results, stats = successive_halving(list(alpha_values), evaluate, corpus, eta, min_sentences)
+        log_race("alpha", 1, stats)
+    else:
+        results = parallel_evaluate("alpha", list(alpha_values), models, dev, n, max_workers, executor)
+    for alpha, pp in results:
+        log.add([alpha, round(pp, 4)])
+        print(f"[α={alpha:.2f}] Dev PP={pp:.2f}")
+        if pp < best_pp:
+            best_alpha, best_pp = alpha, pp
+    log.flush()
 
     print(f"[RESULT] Best α={best_alpha:.2f}, Dev Perplexity={best_pp:.2f}")
     print(f"[LOGGED] All α results saved to {log_path}")
-    return best_alpha, best_pp
\ No newline at end of file
+    return best_alpha, best_pp
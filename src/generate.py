@@ -1,9 +1,14 @@
 import random
+import numpy as np
+from src.instrument import count, timed
+from src.smoothing import LRUCache
 
+@timed("generate_text")
 def generate_text(model, max_len=15, temperature=1.0):
     """
     Generate text from any model (MLE, LinearInterpolation, or StupidBackoff).
-    Supports models with either `.counts` or `.prob(context, word)` methods.
+    Supports models with `.counts`, `.next_word_distribution(context)` (sampled
+    with NumPy from a cached vector) or just `.prob(context, word)`.
     """
     sentence = ["<s>"] * (getattr(model, "n", 1) - 1)
     output = []
@@ -18,7 +23,23 @@ def generate_text(model, max_len=15, temperature=1.0):
                 break
             words, probs = zip(*candidates.items())
 
-        # --- Case 2: Smoothed / interpolated / backoff models ---
+        # --- Case 2: Smoothed models with a cached, vectorised distribution ---
+        elif hasattr(model, "next_word_distribution"):
+            words = model.words
+            probs = np.maximum(model.next_word_distribution(context), 1e-12)
+            if temperature != 1.0:
+                probs = probs ** (1.0 / temperature)
+            cdf = np.cumsum(probs)
+            if cdf[-1] <= 0:
+                break
+            next_word = words[min(int(np.searchsorted(cdf, random.random() * cdf[-1], side="right")), len(words) - 1)]
+            sentence.append(next_word)
+            count("generate.tokens")
+            if next_word == "</s>":
+                break
+            continue
+
+        # --- Case 3: Other models exposing only .prob(context, word) ---
         else:
             vocab = None
             # Try to extract vocab from sub-models if available
@@ -45,8 +66,200 @@ def generate_text(model, max_len=15, temperature=1.0):
         # --- Sample next word ---
         next_word = random.choices(words, weights=probs, k=1)[0]
         sentence.append(next_word)
+        count("generate.tokens")
         if next_word == "</s>":
             break
 
     # Clean up start tokens
     return " ".join(sentence[(getattr(model, "n", 1) - 1):])
+
+def _truncate(probs, temperature, top_k, top_p):
+    """
+    Temperature, top-k and nucleus truncation of each row of `probs`.
+    Returns one (candidate indices or None for all, CDF normalised to 1) per row.
+    """
+    probs = np.maximum(probs, 1e-12)
+    if temperature != 1.0:
+        probs **= 1.0 / temperature
+    idx = None
+    if top_k and top_k < probs.shape[1]:
+        idx = np.argpartition(-probs, top_k - 1, axis=1)[:, :top_k]
+    if top_p is not None and top_p < 1.0:
+        values = probs if idx is None else np.take_along_axis(probs, idx, 1)
+        ranked = np.sort(values, axis=1)[:, ::-1]
+        mass = np.cumsum(ranked, axis=1)
+        # Smallest prefix whose mass reaches top_p of the (top-k) total: everything
+        # above the last kept value, plus as many of its ties as needed (lowest index first)
+        keep = (mass < top_p * mass[:, -1:]).sum(axis=1) + 1
+        cut = ranked[np.arange(len(keep)), keep - 1][:, None]
+        ties = values == cut
+        chosen = (values > cut) | (ties & (np.cumsum(ties, axis=1) <= (keep - (values > cut).sum(axis=1))[:, None]))
+        out = []
+        for r in range(len(values)):
+            cols = np.flatnonzero(chosen[r])
+            cdf = np.cumsum(values[r, cols])
+            out.append((cols if idx is None else idx[r, cols], cdf / cdf[-1]))
+        return out
+    cdf = np.cumsum(probs if idx is None else np.take_along_axis(probs, idx, 1), axis=1)
+    cdf /= cdf[:, -1:]
+    return [(None if idx is None else idx[r], cdf[r]) for r in range(len(cdf))]
+
+def _sparse_candidates(base_cdf, fbase, rows, pos, values, num_rows, temperature):
+    """
+    Per-row samplers for "base with overrides" distributions (see
+    NextWordDistribution.sparse_distributions): the overridden words' CDF plus,
+    for the base, where each excluded word starts once earlier exclusions are
+    taken out (`starts`) and the mass excluded up to it (`skipped`).
+    """
+    weights = np.maximum(values, 1e-12)
+    if temperature != 1.0:
+        weights **= 1.0 / temperature
+    excluded = fbase[pos]
+    bounds = np.searchsorted(rows, np.arange(num_rows + 1))
+    out = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        skipped = np.cumsum(excluded[lo:hi])
+        out.append((pos[lo:hi], np.cumsum(weights[lo:hi]), base_cdf[pos[lo:hi]] - skipped, skipped))
+    return out
+
+def _sample_sparse(live, base_cdf, rng):
+    """One draw per member of each (members, candidates) group; returns positions in model.words."""
+    total = base_cdf[-1]
+    over = np.array([cand[1][-1] if len(cand[1]) else 0.0 for _, cand in live])
+    kept = total - np.array([cand[3][-1] if len(cand[3]) else 0.0 for _, cand in live])
+    sizes = np.array([len(cand[0]) for _, cand in live])
+    firsts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    group = np.repeat(np.arange(len(live)), [len(members) for members, _ in live])
+    u = rng.random(len(group)) * (over + kept)[group]
+    picks = np.empty(len(group), dtype=np.int64)
+    # Overridden words: every group's CDF stacked on the running total of the groups before it
+    shift = np.concatenate([[0.0], np.cumsum(over)[:-1]])
+    hit = u < over[group]
+    if hit.any():
+        stacked = np.concatenate([shift[g] + cand[1] for g, (_, cand) in enumerate(live)])
+        pos = np.concatenate([cand[0] for _, cand in live])
+        k = np.searchsorted(stacked, shift[group[hit]] + u[hit], side="right")
+        picks[hit] = pos[np.minimum(k, firsts[group[hit]] + sizes[group[hit]] - 1)]
+    # Base words: step over the excluded ones by adding back the mass skipped before t
+    miss = ~hit
+    if miss.any():
+        t = u[miss] - over[group[miss]]
+        g = group[miss]
+        if sizes.sum():
+            span = 2 * total
+            starts = np.concatenate([i * span + cand[2] for i, (_, cand) in enumerate(live)])
+            skipped = np.concatenate([cand[3] for _, cand in live])
+            j = np.searchsorted(starts, g * span + t, side="right") - firsts[g]
+            t = t + np.where(j > 0, skipped[np.maximum(firsts[g] + j - 1, 0)], 0.0)
+        picks[miss] = np.minimum(np.searchsorted(base_cdf, t, side="right"), len(base_cdf) - 1)
+    return picks.tolist()
+
+def _sample_dense(live, rng):
+    """One draw per member of each (members, (words, idx, cdf)) group; returns indices into words."""
+    # Group g's normalised CDF is shifted to (g, g + 1] so one searchsorted serves every row
+    sizes = np.array([len(cand[2]) for _, cand in live])
+    firsts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    stacked = np.concatenate([g + cand[2] for g, (_, cand) in enumerate(live)])
+    group = np.repeat(np.arange(len(live)), [len(members) for members, _ in live])
+    picks = np.searchsorted(stacked, group + rng.random(len(group)), side="right") - firsts[group]
+    picks = np.minimum(picks, sizes[group] - 1).tolist()
+    out = []
+    row = 0
+    for members, (_, idx, _) in live:
+        for _ in members:
+            out.append(picks[row] if idx is None else int(idx[picks[row]]))
+            row += 1
+    return out
+
+@timed("generate_batch")
+def generate_batch(model, num=15, max_len=15, temperature=1.0, top_k=None, top_p=None, seed=None,
+                   cache_size=256):
+    """
+    Generate `num` sentences in lock-step. At each step the active sequences are
+    grouped by context; candidates for the contexts not seen yet are built
+    together (in chunks of `cache_size`, kept in an LRU of that many contexts)
+    and all active rows are then sampled with one vectorised searchsorted.
+    Without top_k / top_p, models with sparse_distributions() are sampled
+    exactly from a shared base CDF plus each context's few overridden words, so
+    no per-context vector over the vocabulary is built.
+    top_k / top_p restrict sampling to the k most likely words / the smallest
+    set holding top_p of the mass; `seed` makes the batch reproducible.
+    """
+    rng = np.random.default_rng(seed)
+    order = getattr(model, "n", 1)
+    pad = ["<s>"] * (order - 1)
+    sentences = [list(pad) for _ in range(num)]
+    active = list(range(num))
+    memo = LRUCache(cache_size, "generate_batch")
+    dead = ()  # cached marker for contexts with nothing to sample
+    dense = hasattr(model, "next_word_distribution")
+    sparse = {}
+    if hasattr(model, "sparse_distributions") and not top_k and (top_p is None or top_p >= 1.0):
+        base = model.sparse_distributions([])
+        if base is not None:
+            sparse["fbase"] = np.maximum(base[0], 1e-12)
+            if temperature != 1.0:
+                sparse["fbase"] **= 1.0 / temperature
+            sparse["cdf"] = np.cumsum(sparse["fbase"])
+
+    def fill(contexts):
+        """Compute, truncate and cache the candidates of `contexts`; returns {context: candidates}."""
+        found = {}
+        for lo in range(0, len(contexts), cache_size):
+            chunk = contexts[lo:lo + cache_size]
+            if sparse:
+                _, rows, pos, values = model.sparse_distributions(chunk)
+                cands = _sparse_candidates(sparse["cdf"], sparse["fbase"], rows, pos, values,
+                                           len(chunk), temperature)
+            elif dense:
+                if hasattr(model, "next_word_distributions"):
+                    probs = model.next_word_distributions(chunk)
+                else:
+                    probs = np.array([model.next_word_distribution(c) for c in chunk])
+                # Copies, so an evicted entry doesn't pin the whole chunk
+                cands = [(model.words, None if idx is None else idx.copy(), cdf.copy())
+                         for idx, cdf in _truncate(probs, temperature, top_k, top_p)]
+            else:
+                cands = []
+                for context in chunk:
+                    successors = model.counts.get(context, {})
+                    if not successors:
+                        cands.append(dead)
+                        continue
+                    words, counts = zip(*successors.items())
+                    idx, cdf = _truncate(np.array([counts], dtype=np.float64), temperature, top_k, top_p)[0]
+                    cands.append((words, idx, cdf))
+            for context, cand in zip(chunk, cands):
+                found[context] = cand
+                memo.put(context, cand)
+        return found
+
+    for _ in range(max_len):
+        if not active:
+            break
+        count("generate.steps")
+        count("generate.tokens", len(active))
+        groups = {}
+        for s in active:
+            groups.setdefault(tuple(sentences[s][-(order - 1):]) if order > 1 else (), []).append(s)
+        cands = {context: memo.get(context) for context in groups}
+        missing = [context for context, cand in cands.items() if cand is None]
+        if missing:
+            cands.update(fill(missing))
+        live = [(groups[context], cand) for context, cand in cands.items() if cand is not dead]
+        if not live:
+            break
+        picks = _sample_sparse(live, sparse["cdf"], rng) if sparse else _sample_dense(live, rng)
+        still_active = []
+        row = 0
+        for members, cand in live:
+            words = model.words if sparse else cand[0]
+            for s in members:
+                word = words[picks[row]]
+                row += 1
+                sentences[s].append(word)
+                if word != "</s>":
+                    still_active.append(s)
+        active = sorted(still_active)
+
+    return [" ".join(s[len(pad):]) for s in sentences]
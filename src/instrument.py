@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import functools
+from collections import defaultdict, Counter
+
+# ----------------------------------------------------
+# Lightweight run instrumentation
+#   with stage("train"): ...      nested wall-clock timers ("main/train/...")
+#   @timed("load_data")           the same, as a decorator
+#   count("prob.kneser_ney")     plain counters (read back with counters())
+#   pool.submit(counted, fn, ...)  process-pool tasks hand their counter
+#                                  increments back (add_counts / collect_counts)
+#   pool.submit(staged, current_stage(), fn, ...)
+#                                  thread-pool tasks time their stages under
+#                                  the submitting stage instead of at the top
+#   "cache.<name>.hits/misses" counters are summarised as hit rates
+#   with profiling("cprofile"|"sample"): ...
+# write_report() dumps everything as one JSON document per run. Counters are
+# kept per thread (no lock on the hot path) and summed when read. Set
+# NGRAM_INSTRUMENT=0 to turn timers and counters off entirely.
+# ----------------------------------------------------
+ENABLED = os.environ.get("NGRAM_INSTRUMENT", "1") != "0"
+TIMERS = {}  # stage path -> [calls, total seconds, max seconds, first start]
+_PROFILES = {}
+_local = threading.local()
+_THREAD_COUNTERS = []  # one defaultdict(int) per thread that ever counted
+_lock = threading.Lock()  # guards _THREAD_COUNTERS and TIMERS
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class stage:
+    """Time a block; stages opened inside it are reported under its path."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if ENABLED:
+            _stack().append(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if ENABLED:
+            elapsed = time.perf_counter() - self.start
+            stack = _stack()
+            path = "/".join(stack)
+            stack.pop()
+            with _lock:
+                entry = TIMERS.get(path)
+                if entry is None:
+                    TIMERS[path] = [1, elapsed, elapsed, self.start]
+                else:
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    entry[2] = max(entry[2], elapsed)
+        return False
+
+
+def timed(name):
+    """Decorator form of stage(name)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def current_stage():
+    """The calling thread's open stages, outermost first (for staged())."""
+    return tuple(_stack())
+
+
+def staged(path, fn, *args, **kwargs):
+    """
+    Run fn with `path` (from current_stage() in the submitting thread) as this
+    thread's stage stack, so a pool thread's stages nest under the stage that
+    submitted the task rather than showing up as new top-level entries.
+    """
+    saved = getattr(_local, "stack", None)
+    _local.stack = list(path)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.stack = saved
+
+
+def _thread_counters():
+    table = getattr(_local, "counters", None)
+    if table is None:
+        table = _local.counters = defaultdict(int)
+        with _lock:
+            _THREAD_COUNTERS.append(table)
+    return table
+
+
+def count(name, n=1):
+    """Add n to counter `name` (in this thread's own table, so no lock is taken)."""
+    if ENABLED:
+        _thread_counters()[name] += n
+
+
+def counters():
+    """Every thread's counters summed, as a plain dict."""
+    with _lock:
+        tables = list(_THREAD_COUNTERS)
+    total = defaultdict(int)
+    for table in tables:
+        for name, n in table.copy().items():
+            total[name] += n
+    return dict(total)
+
+
+def counted(fn, *args, **kwargs):
+    """
+    Run a task in a pool worker process and return (result, counter increments it
+    made). A worker's counters die with it, so the parent folds the increments in
+    with add_counts(). Not for thread pools, whose counters the parent already sees.
+    """
+    before = counters()
+    result = fn(*args, **kwargs)
+    delta = {name: n - before.get(name, 0) for name, n in counters().items() if n != before.get(name, 0)}
+    return result, delta
+
+
+def add_counts(delta):
+    """Fold a worker's counter increments (from counted()) into this process's counters."""
+    table = _thread_counters()
+    for name, n in delta.items():
+        table[name] += n
+
+
+def collect_counts(results):
+    """Yield the results of an iterable of counted() pairs, folding in their counters."""
+    for result, delta in results:
+        add_counts(delta)
+        yield result
+
+
+def reset():
+    with _lock:
+        for table in _THREAD_COUNTERS:
+            table.clear()
+        TIMERS.clear()
+    _PROFILES.clear()
+
+
+# ----------------------------------------------------
+# Profilers
+# ----------------------------------------------------
+class _Sampler(threading.Thread):
+    """Statistical profiler: samples the target thread's stack every `interval` seconds."""
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.samples = 0
+        self.own = Counter()
+        self.inclusive = Counter()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[_frame_name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = _frame_name(frame)
+                if name not in seen:
+                    self.inclusive[name] += 1
+                    seen.add(name)
+                frame = frame.f_back
+
+    def summary(self, top=25):
+        def rows(counter):
+            return [{"function": name, "samples": n, "fraction": round(n / max(self.samples, 1), 4)}
+                    for name, n in counter.most_common(top)]
+        return {"mode": "sample", "interval": self.interval, "samples": self.samples,
+                "self": rows(self.own), "inclusive": rows(self.inclusive)}
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}:{code.co_name}"
+
+
+class profiling:
+    """
+    Optional profiler around a block: mode="cprofile" (deterministic, also
+    written to `path` as pstats data) or mode="sample" (sampling thread, low
+    overhead). mode=None is a no-op, so callers can pass a CLI flag straight in.
+    The top functions end up in the run report.
+    """
+    def __init__(self, mode=None, path=None, interval=0.005, top=25):
+        if mode not in (None, "cprofile", "sample"):
+            raise ValueError(f"Unknown profiler {mode!r} (expected 'cprofile' or 'sample')")
+        self.mode, self.path, self.interval, self.top = mode, path, interval, top
+
+    def __enter__(self):
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == "sample":
+            self.profiler = _Sampler(threading.get_ident(), self.interval)
+            self.profiler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            if self.path:
+                stats.dump_stats(self.path)
+            ranked = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+            _PROFILES["cprofile"] = {"mode": "cprofile", "path": self.path, "functions": [
+                {"function": f"{os.path.basename(f)}:{line}:{name}", "calls": nc,
+                 "self_seconds": round(tt, 6), "cumulative_seconds": round(ct, 6)}
+                for (f, line, name), (cc, nc, tt, ct, _) in ranked]}
+        elif self.mode == "sample":
+            self.profiler.stop_event.set()
+            self.profiler.join()
+            _PROFILES["sample"] = self.profiler.summary(self.top)
+        return False
+
+
+# ----------------------------------------------------
+# Report
+# ----------------------------------------------------
+def report():
+    """Structured snapshot of every stage timer, counter, cache and profile."""
+    totals = counters()
+    with _lock:
+        timers = list(TIMERS.items())
+    caches = {}
+    for key in totals:
+        if not (key.startswith("cache.") and key.endswith(".hits")):
+            continue
+        name = key[len("cache."):-len(".hits")]
+        hits, misses = totals[key], totals.get(f"cache.{name}.misses", 0)
+        caches[name] = {"hits": hits, "misses": misses,
+                        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "argv": sys.argv,
+        # Ordered by first entry, so every stage follows its parent
+        "stages": {path: {"calls": calls, "seconds": round(total, 6), "max_seconds": round(peak, 6)}
+                   for path, (calls, total, peak, _) in sorted(timers, key=lambda item: item[1][3])},
+        "counters": dict(sorted(totals.items())),
+        "caches": caches,
+        "profiles": dict(_PROFILES),
+    }
+
+
+def write_report(path=None):
+    """Write report() as JSON (default results/run_report.json) and print the stage table."""
+    data = report()
+    path = path or os.path.join("results", "run_report.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print("\n[INFO] Stage timings:")
+    for name, entry in data["stages"].items():
+        depth = name.count("/")
+        print(f"  {'  ' * depth}{name.rsplit('/', 1)[-1]:<{32 - 2 * depth}} "
+              f"{entry['seconds']:>9.3f}s  ×{entry['calls']}")
+    for name, entry in data["caches"].items():
+        if entry["hit_rate"] is not None:
+            print(f"  cache {name}: {entry['hit_rate']:.1%} hits ({entry['hits']} / {entry['hits'] + entry['misses']})")
+    print(f"[SAVED] Run report → {path}")
+    return data
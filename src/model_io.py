@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import pickle
+import numpy as np
+from src.packed_model import PackedNGramModel, CountTable, Vocabulary
+from src.smoothing import LinearInterpolation, StupidBackoff
+from src.instrument import timed
+
+FORMAT_NAME = "ngram-packed"
+FORMAT_VERSION = 1
+TABLE_ARRAYS = ["keys", "counts", "ctx_keys", "ctx_ptr", "ctx_totals"]
+
+# ----------------------------------------------------
+# On-disk layout (one directory per model set):
+#   meta.json               format name/version, orders, key bits per order
+#   vocab.txt               shared ID -> token table, one token per line
+#   order{n}.{array}.npy    packed CountTable arrays for each order
+#   order{n}.vocab.npy      IDs of the words that order predicts (model.vocab)
+# Arrays are plain .npy files, so they open with mmap and pages are shared
+# between every process serving the same models.
+# ----------------------------------------------------
+def _array_path(path, n, name):
+    return os.path.join(path, f"order{n}.{name}.npy")
+
+def _atomic_write(path, write):
+    # Write-then-rename: processes that still map the old file keep a valid inode
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+@timed("save_packed_models")
+def save_packed_models(models, path):
+    """Write packed models (sharing one Vocabulary) in the binary format."""
+    ids = models[0].ids
+    if any(m.ids is not ids for m in models):
+        raise ValueError("All models must share one Vocabulary; convert them with a common `ids`")
+    os.makedirs(path, exist_ok=True)
+    _atomic_write(os.path.join(path, "vocab.txt"),
+                  lambda f: f.write("".join(f"{word}\n" for word in ids.words).encode("utf-8")))
+    for m in models:
+        for name in TABLE_ARRAYS:
+            _atomic_write(_array_path(path, m.n, name), lambda f: np.save(f, np.asarray(getattr(m.table, name))))
+        vocab_ids = np.array(sorted(ids.index[w] for w in m.vocab), dtype=np.int64)
+        _atomic_write(_array_path(path, m.n, "vocab"), lambda f: np.save(f, vocab_ids))
+    meta = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "orders": [m.n for m in models],
+        "bits": {str(m.n): m.table.bits for m in models},
+        "vocab_size": len(ids),
+    }
+    _atomic_write(os.path.join(path, "meta.json"), lambda f: f.write(json.dumps(meta, indent=2).encode("utf-8")))
+    print(f"[SAVED] {len(models)} packed models → {path}")
+
+@timed("load_packed_models")
+def load_packed_models(path, mmap=True):
+    """
+    Open a binary model directory. Only meta.json and the vocab table are read
+    up front; each order's arrays are memory-mapped the first time it is used.
+    """
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not an {FORMAT_NAME} model directory")
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported {FORMAT_NAME} version {meta.get('version')} (expected {FORMAT_VERSION})")
+    with open(os.path.join(path, "vocab.txt"), encoding="utf-8") as f:
+        ids = Vocabulary(line.rstrip("\n") for line in f)
+    mmap_mode = "r" if mmap else None
+
+    def loader(n):
+        @timed(f"load_order{n}")
+        def load():
+            arrays = [np.load(_array_path(path, n, name), mmap_mode=mmap_mode) for name in TABLE_ARRAYS]
+            table = CountTable(n, meta["bits"][str(n)], *arrays)
+            vocab = {ids.words[i] for i in np.load(_array_path(path, n, "vocab"))}
+            return table, vocab
+        return load
+
+    models = [PackedNGramModel(n, ids, loader=loader(n)) for n in meta["orders"]]
+    print(f"[LOADED] {os.path.basename(os.path.normpath(path))} (orders {meta['orders']}, lazy)")
+    return models
+
+@timed("convert_pickles")
+def convert_pickles(pickle_paths, path):
+    """
+    Convert pickled NGramModel or PackedNGramModel checkpoints (e.g. models/*.pkl)
+    to the binary format. Every model is re-interned onto one shared Vocabulary.
+    """
+    ids = Vocabulary()
+    models = []
+    for p in pickle_paths:
+        with open(p, "rb") as f:
+            model = pickle.load(f)
+        models.append(PackedNGramModel.from_model(model, ids))
+        print(f"[CONVERTED] {os.path.basename(p)}")
+    save_packed_models(models, path)
+    return models
+
+# ----------------------------------------------------
+# Tuned smoothing wrappers (e.g. models/interp_best.json) are stored as their
+# parameters plus the base model directory they were tuned on, and rebuilt on
+# load. Pickling them would copy every (memory-mapped) base table into the file.
+# ----------------------------------------------------
+SMOOTHED_FORMAT = "ngram-smoothed"
+
+def save_smoothed(model, path, base_path):
+    """Write a LinearInterpolation / StupidBackoff wrapper's parameters as JSON."""
+    if isinstance(model, LinearInterpolation):
+        params = {"kind": "interpolation", "lambdas": [float(l) for l in model.lambdas], "n": model.n}
+    elif isinstance(model, StupidBackoff):
+        params = {"kind": "stupid_backoff", "alpha": float(model.alpha), "n": model.n}
+    else:
+        raise TypeError(f"Cannot save {type(model).__name__}; expected LinearInterpolation or StupidBackoff")
+    meta = {"format": SMOOTHED_FORMAT, "version": FORMAT_VERSION, **params,
+            "base": base_path, "orders": [m.n for m in model.models]}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    _atomic_write(path, lambda f: f.write(json.dumps(meta, indent=2).encode("utf-8")))
+    print(f"[SAVED] {os.path.basename(path)}")
+
+def load_smoothed(path, models=None):
+    """Rebuild a saved wrapper over `models` (any order), or over the base directory it names."""
+    with open(path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format") != SMOOTHED_FORMAT:
+        raise ValueError(f"{path} is not an {SMOOTHED_FORMAT} file")
+    if models is None:
+        models = load_packed_models(meta["base"])
+    by_order = {m.n: m for m in models}
+    missing = [n for n in meta["orders"] if n not in by_order]
+    if missing:
+        raise ValueError(f"{path} needs base models of orders {missing}")
+    base = [by_order[n] for n in meta["orders"]]
+    if meta["kind"] == "interpolation":
+        model = LinearInterpolation(base, meta["lambdas"], n=meta.get("n", 3))
+    else:
+        model = StupidBackoff(base, alpha=meta["alpha"])
+    print(f"[LOADED] {os.path.basename(path)}")
+    return model
+
+if __name__ == "__main__":
+    # python -m src.model_io models/uni.pkl models/bi.pkl ... models/base
+    if len(sys.argv) < 3:
+        print("usage: python -m src.model_io <model.pkl>... <output_dir>")
+        sys.exit(1)
+    convert_pickles(sys.argv[1:-1], sys.argv[-1])
@@ -1,15 +1,35 @@
 from collections import defaultdict,Counter
-import math
+from src.packed_model import PackedNGramModel
+from src.evaluate import evaluate_model
+from src.instrument import count, timed
 def counter_defaultdict():
     return defaultdict(int)
+
+class FrozenSuccessors(dict):
+    """Plain successor dict whose missing words read as 0 without being inserted."""
+    def __missing__(self, word):
+        return 0
+
+class FrozenCounts(dict):
+    """Plain context dict whose missing contexts read as empty without being inserted."""
+    def __missing__(self, context):
+        # A fresh mapping each time: a shared one could be written to by a caller
+        return FrozenSuccessors()
+
 class NGramModel:
     def __init__(self,n):
         self.n = n
         self.counts = defaultdict(counter_defaultdict)
         self.context_counts = Counter()
         self.vocab = set()
+        self.frozen = False
+        self.version = 0
 
+    @timed("train")
     def train(self, data):
+        if getattr(self, "frozen", False):
+            raise RuntimeError("Cannot train a frozen NGramModel; use update() to add documents")
+        self._invalidate()
         for sentence in data:
             padded = ["<s>"] * (self.n - 1) + sentence
             for i in range(len(padded) - self.n + 1):
@@ -18,22 +38,89 @@ class NGramModel:
                 self.counts[context][word] += 1
                 self.context_counts[context] += 1
                 self.vocab.add(word)
+
+    def _invalidate(self):
+        """Bump the version that wrappers and batch scoring key their caches on."""
+        self.version = getattr(self, "version", 0) + 1
+
+    def update(self, data):
+        """Append new documents without retraining; also works on a frozen model."""
+        delta = NGramModel(self.n)
+        delta.train(data)
+        return self.merge(delta)
+
+    def merge(self, other):
+        """
+        Add another model's counts (same order; dict-based or packed) into this one.
+        Only the touched contexts' totals change; derived caches are invalidated.
+        """
+        if other.n != self.n:
+            raise ValueError(f"Cannot merge a {other.n}-gram model into a {self.n}-gram model")
+        frozen = getattr(self, "frozen", False)
+        for context, successors in other.counts.items():
+            added = 0
+            for word, c in successors.items():
+                if not c:
+                    continue
+                target = self.counts.get(context)
+                if target is None:
+                    target = self.counts[context] = FrozenSuccessors() if frozen else counter_defaultdict()
+                target[word] = target.get(word, 0) + c
+                added += c
+            if added:
+                self.context_counts[context] += added
+        self.vocab.update(other.vocab)
+        self._invalidate()
+        return self
+
+    def freeze(self):
+        """
+        Switch to inference mode: counts become plain dicts (dropping any empty
+        entries left behind by earlier defaultdict reads) and further training is
+        refused. Lookups on a frozen model never allocate or insert.
+        """
+        if getattr(self, "frozen", False):
+            return self
+        self.counts = FrozenCounts(
+            (context, FrozenSuccessors((w, c) for w, c in successors.items() if c))
+            for context, successors in self.counts.items()
+            if self.context_counts[context]
+        )
+        self.context_counts = Counter({c: t for c, t in self.context_counts.items() if t})
+        self.frozen = True
+        return self
+
+    def packed(self):
+        """
+        Array-backed copy for batch scoring, converted once and kept until the
+        model changes (it is keyed on `version`, so train/update rebuild it).
+        """
+        version = getattr(self, "version", 0)
+        cached = getattr(self, "_packed", None)
+        if cached is None or cached[0] != version:
+            cached = self._packed = (version, PackedNGramModel.from_model(self))
+        return cached[1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_packed", None)
+        return state
+
+    def count(self, context, word):
+        """Read-only n-gram count; never inserts into `counts`."""
+        successors = self.counts.get(context)
+        return successors.get(word, 0) if successors else 0
+
+    def context_total(self, context):
+        """Read-only context total; never inserts into `context_counts`."""
+        return self.context_counts.get(context, 0)
     
     def prob(self, context, word):
-        if context not in self.counts or self.context_counts[context] == 0:
+        count("prob.mle")
+        total = self.context_total(context)
+        if total == 0:
             return 0.0
-        return self.counts[context][word] / self.context_counts[context]
+        return self.count(context, word) / total
 
     def perplexity(self,data):
-        log_prob, token_count = 0, 0
-        for sentence in data:
-            padded = ["<s>"] * (self.n - 1) + sentence
-            for i in range(self.n - 1, len(padded)):
-                context = tuple(padded[i-self.n+1:i])
-                word = padded[i]
-                p = self.prob(context, word)
-                if p <= 0:
-                    return float("inf")
-                log_prob += math.log2(p)
-                token_count += 1
-        return math.pow(2, -log_prob / token_count)
\ No newline at end of file
+        return evaluate_model(self, data)
@@ -0,0 +1,449 @@
+import threading
+import numpy as np
+from src.vocabulary import Vocabulary, key_bits, pack_keys, unpack_keys
+from src.evaluate import evaluate_model
+from src.instrument import count, timed
+
+# Serialises the lazy loads of on-disk models (see PackedNGramModel._load)
+_LOAD_LOCK = threading.Lock()
+
+
+def merge_counts(keys_a, counts_a, keys_b, counts_b):
+    """Sort-merge two (key, count) tables, summing counts of equal keys."""
+    keys = np.concatenate([keys_a, keys_b])
+    counts = np.concatenate([counts_a, counts_b])
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def merge_sorted_counts(keys_a, counts_a, keys_b, counts_b):
+    """
+    merge_counts for two tables whose keys are already sorted: `b` is inserted
+    into `a` by searchsorted, so the cost is linear in len(a) instead of a re-sort.
+    """
+    if len(keys_b) == 0:
+        return keys_a, counts_a
+    pos = np.searchsorted(keys_a, keys_b, side="right")
+    keys = np.insert(keys_a, pos, keys_b)
+    counts = np.insert(counts_a, pos, counts_b)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if len(starts) == len(keys):
+        return keys, counts
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def shared_tables(models):
+    """
+    Re-pack base models (dict-based or packed) onto one fresh Vocabulary with a
+    common key width. Returns (ids, bits, {n: CountTable}).
+    """
+    ids = Vocabulary()
+    rows_by_order = {}
+    for m in models:
+        if not isinstance(m, PackedNGramModel):
+            m = m.packed() if hasattr(m, "packed") else PackedNGramModel.from_model(m)
+        rows = unpack_keys(m.table.keys, m.n, m.table.bits)
+        trans = np.array([ids.add(w) for w in m.ids.words], dtype=np.int64)
+        rows_by_order[m.n] = (trans[rows] if len(rows) else rows, m.table.counts)
+    bits = key_bits(len(ids))
+    if bits * max(rows_by_order) > 63:
+        raise ValueError(f"Vocabulary of {len(ids)} words is too large to pack {max(rows_by_order)}-grams into int64 keys")
+    tables = {n: CountTable.from_counts(n, bits, pack_keys(rows, bits), counts)
+              for n, (rows, counts) in rows_by_order.items()}
+    return ids, bits, tables
+
+
+class CountTable:
+    """
+    Counts of one n-gram order stored as sorted packed int64 keys.
+    N-grams sharing a context are contiguous, so the context index is a CSR layout:
+    successors of ctx_keys[i] are keys[ctx_ptr[i]:ctx_ptr[i+1]].
+    """
+    def __init__(self, order, bits, keys, counts, ctx_keys=None, ctx_ptr=None, ctx_totals=None):
+        self.order = order
+        self.bits = bits
+        self.keys = keys
+        self.counts = counts
+        if ctx_keys is None:
+            ctx = keys >> bits
+            if len(ctx):
+                starts = np.flatnonzero(np.r_[True, ctx[1:] != ctx[:-1]])
+                ctx_keys = ctx[starts]
+                ctx_totals = np.add.reduceat(counts, starts)
+            else:
+                starts = np.zeros(0, dtype=np.int64)
+                ctx_keys = np.zeros(0, dtype=np.int64)
+                ctx_totals = np.zeros(0, dtype=np.int64)
+            ctx_ptr = np.append(starts, len(keys)).astype(np.int64)
+        self.ctx_keys = ctx_keys
+        self.ctx_ptr = ctx_ptr
+        self.ctx_totals = ctx_totals
+
+    @classmethod
+    def empty(cls, order, bits):
+        return cls(order, bits, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def from_counts(cls, order, bits, keys, counts):
+        """Build from unsorted, possibly repeated keys."""
+        return cls(order, bits, *merge_counts(keys, counts, keys[:0], counts[:0]))
+
+    def rebits(self, bits):
+        """Re-pack keys for a wider ID space (IDs themselves never change)."""
+        if bits == self.bits:
+            return self
+        keys = pack_keys(unpack_keys(self.keys, self.order, self.bits), bits)
+        return CountTable(self.order, bits, keys, self.counts)
+
+    def merge(self, other):
+        return CountTable(self.order, self.bits,
+                          *merge_sorted_counts(self.keys, self.counts, other.keys, other.counts))
+
+    def find(self, table, key):
+        i = int(np.searchsorted(table, key))
+        return i if i < len(table) and table[i] == key else -1
+
+    def lookup(self, table, values, query):
+        """Vectorised lookup of packed keys; misses (and negative keys) yield 0."""
+        out = np.zeros(len(query), dtype=values.dtype)
+        if len(table) == 0:
+            return out
+        idx = np.minimum(np.searchsorted(table, query), len(table) - 1)
+        hit = (table[idx] == query) & (query >= 0)
+        out[hit] = values[idx[hit]]
+        return out
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.keys, self.counts, self.ctx_keys, self.ctx_ptr, self.ctx_totals))
+
+
+class PackedNGramModel:
+    """
+    Array-backed drop-in for NGramModel: tokens are interned to integer IDs and
+    n-gram counts live in a CountTable instead of nested dicts. `prob()`,
+    `counts[context][word]`, `context_counts[context]` and `perplexity()` behave
+    as in NGramModel, but lookups are binary searches over packed int64 keys.
+    """
+    scoring = "packed"  # batch path in src.batch_scoring
+
+    def __init__(self, n, ids=None, loader=None):
+        self.n = n
+        self.ids = ids if ids is not None else Vocabulary()
+        # `loader` defers materialising (table, vocab) until first use, so an
+        # on-disk model only maps the orders that are actually queried.
+        self._loader = loader
+        self.version = 0
+        if loader is None:
+            self.vocab = set()
+            self.table = CountTable.empty(n, key_bits(len(self.ids)))
+
+    def _load(self):
+        # Several server threads may hit an unloaded model at once: load it once
+        with _LOAD_LOCK:
+            if self._loader is not None:
+                self._table, self._vocab = self._loader()
+                self._loader = None
+
+    @property
+    def table(self):
+        if self._loader is not None:
+            self._load()
+        return self._table
+
+    @table.setter
+    def table(self, value):
+        self._table = value
+
+    @property
+    def vocab(self):
+        if self._loader is not None:
+            self._load()
+        return self._vocab
+
+    @vocab.setter
+    def vocab(self, value):
+        self._vocab = value
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def __getstate__(self):
+        if self._loader is not None:
+            self._load()
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        # Pickles from before lazy loading hold `table` / `vocab` as plain attributes
+        for name in ("table", "vocab"):
+            if name in state:
+                state["_" + name] = state.pop(name)
+        state.setdefault("_loader", None)
+        state.setdefault("version", 0)
+        self.__dict__.update(state)
+
+    @classmethod
+    def from_model(cls, model, ids=None):
+        """Convert a trained dict-based NGramModel, or re-intern a packed one onto `ids`."""
+        packed = cls(model.n, ids)
+        if isinstance(model, PackedNGramModel):
+            trans = np.array([packed.ids.add(w) for w in model.ids.words], dtype=np.int64)
+            bits = packed._ensure_bits()
+            rows = unpack_keys(model.table.keys, model.n, model.table.bits)
+            packed.table = CountTable.from_counts(model.n, bits, pack_keys(trans[rows] if len(rows) else rows, bits),
+                                                  np.asarray(model.table.counts))
+            packed.vocab = set(model.vocab)
+            return packed
+        for context in model.counts:
+            for w in context:
+                packed.ids.add(w)
+        for w in model.vocab:
+            packed.ids.add(w)
+        bits = packed._ensure_bits()
+        rows, counts = [], []
+        for context, successors in model.counts.items():
+            ctx = [packed.ids.index[w] for w in context]
+            for word, c in successors.items():
+                if c:
+                    rows.append(ctx + [packed.ids.index[word]])
+                    counts.append(c)
+        ids = np.array(rows, dtype=np.int64).reshape(len(rows), model.n)
+        packed.table = CountTable.from_counts(model.n, bits, pack_keys(ids, bits), np.array(counts, dtype=np.int64))
+        packed.vocab = set(model.vocab)
+        return packed
+
+    def freeze(self):
+        """Packed tables are already immutable lookup structures."""
+        return self
+
+    def _ensure_bits(self):
+        bits = key_bits(len(self.ids))
+        if bits * self.n > 63:
+            raise ValueError(f"Vocabulary of {len(self.ids)} words is too large to pack {self.n}-grams into int64 keys")
+        if bits != self.table.bits:
+            self.table = self.table.rebits(bits)
+        return bits
+
+    # ------------------------------------------------
+    # Training
+    # ------------------------------------------------
+    @timed("train")
+    def train(self, data, chunk_size=50000):
+        self.version += 1
+        chunk = []
+        for sentence in data:
+            chunk.append(sentence)
+            if len(chunk) >= chunk_size:
+                self._train_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._train_chunk(chunk)
+
+    def update(self, data):
+        """Append new documents; only this order's table is rebuilt."""
+        self.train(data)
+        return self
+
+    def merge(self, other):
+        """Add another model's counts (same order; packed or dict-based) into this one."""
+        if other.n != self.n:
+            raise ValueError(f"Cannot merge a {other.n}-gram model into a {self.n}-gram model")
+        if not isinstance(other, PackedNGramModel):
+            other = PackedNGramModel.from_model(other, self.ids)
+        if other.ids is self.ids:
+            rows = unpack_keys(other.table.keys, self.n, other.table.bits)
+        else:
+            trans = np.array([self.ids.add(w) for w in other.ids.words], dtype=np.int64)
+            rows = trans[unpack_keys(other.table.keys, self.n, other.table.bits)]
+        bits = self._ensure_bits()
+        self.table = self.table.merge(CountTable.from_counts(self.n, bits, pack_keys(rows, bits), other.table.counts))
+        self.vocab.update(other.vocab)
+        self.version += 1
+        return self
+
+    def _train_chunk(self, sentences):
+        n = self.n
+        add = self.ids.add
+        flat, sent_ids = [], []
+        for s_idx, sentence in enumerate(sentences):
+            padded = ["<s>"] * (n - 1) + sentence
+            flat.extend(add(w) for w in padded)
+            sent_ids.extend([s_idx] * len(padded))
+        bits = self._ensure_bits()
+        flat = np.array(flat, dtype=np.int64)
+        sent_ids = np.array(sent_ids, dtype=np.int64)
+        if len(flat) < n:
+            return
+        starts = np.flatnonzero(sent_ids[: len(flat) - n + 1] == sent_ids[n - 1:])
+        windows = flat[starts[:, None] + np.arange(n)]
+        keys = pack_keys(windows, bits)
+        ukeys, ucounts = np.unique(keys, return_counts=True)
+        self.table = self.table.merge(CountTable(n, bits, ukeys, ucounts.astype(np.int64)))
+        self.vocab.update(self.ids.words[i] for i in np.unique(windows[:, -1]))
+
+    # ------------------------------------------------
+    # Lookups
+    # ------------------------------------------------
+    def _encode(self, tokens):
+        """Pack a token tuple into a key, or None if any token is unknown."""
+        key = 0
+        bits = self.table.bits
+        for w in tokens:
+            idx = self.ids.index.get(w)
+            # IDs interned after this table was packed can never be in it
+            if idx is None or idx >> bits:
+                return None
+            key = (key << bits) | idx
+        return key
+
+    def _context_index(self, context):
+        if len(context) != self.n - 1:
+            return -1
+        key = self._encode(context)
+        if key is None:
+            return -1
+        return self.table.find(self.table.ctx_keys, key)
+
+    def context_indices(self, contexts):
+        """_context_index of many contexts with one binary search (-1: unseen)."""
+        keys = np.full(len(contexts), -1, dtype=np.int64)
+        for r, context in enumerate(contexts):
+            key = self._encode(context) if len(context) == self.n - 1 else None
+            if key is not None:
+                keys[r] = key
+        table = self.table.ctx_keys
+        if len(table) == 0:
+            return np.full_like(keys, -1)
+        idx = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+        return np.where((table[idx] == keys) & (keys >= 0), idx, -1)
+
+    def count(self, context, word):
+        if len(context) != self.n - 1:
+            return 0
+        key = self._encode(tuple(context) + (word,))
+        if key is None:
+            return 0
+        i = self.table.find(self.table.keys, key)
+        return int(self.table.counts[i]) if i >= 0 else 0
+
+    def context_total(self, context):
+        i = self._context_index(context)
+        return int(self.table.ctx_totals[i]) if i >= 0 else 0
+
+    def successors(self, context):
+        """(word IDs, counts) of everything observed after `context`."""
+        i = self._context_index(context)
+        if i < 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        lo, hi = self.table.ctx_ptr[i], self.table.ctx_ptr[i + 1]
+        mask = (1 << self.table.bits) - 1
+        return self.table.keys[lo:hi] & mask, self.table.counts[lo:hi]
+
+    @property
+    def counts(self):
+        return _CountsView(self)
+
+    @property
+    def context_counts(self):
+        return _ContextTotalsView(self)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    def prob(self, context, word):
+        count("prob.mle")
+        total = self.context_total(context)
+        if total == 0:
+            return 0.0
+        return self.count(context, word) / total
+
+    def perplexity(self, data):
+        return evaluate_model(self, data)
+
+
+class _SuccessorView:
+    """Read-only `counts[context]` view; missing words count as 0."""
+    def __init__(self, model, context):
+        self.model = model
+        self.context = tuple(context)
+
+    def __getitem__(self, word):
+        return self.model.count(self.context, word)
+
+    def get(self, word, default=0):
+        c = self.model.count(self.context, word)
+        return c if c else default
+
+    def __contains__(self, word):
+        return self.model.count(self.context, word) > 0
+
+    def items(self):
+        ids, counts = self.model.successors(self.context)
+        words = self.model.ids.words
+        return [(words[i], int(c)) for i, c in zip(ids, counts)]
+
+    def keys(self):
+        return [w for w, _ in self.items()]
+
+    def values(self):
+        return [c for _, c in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.model.successors(self.context)[0])
+
+
+class _CountsView:
+    """Read-only `counts` view: `counts[context][word]` never inserts anything."""
+    def __init__(self, model):
+        self.model = model
+
+    def __getitem__(self, context):
+        return _SuccessorView(self.model, context)
+
+    def get(self, context, default=None):
+        if self.model.context_total(context) == 0:
+            return default
+        return _SuccessorView(self.model, context)
+
+    def __contains__(self, context):
+        return self.model.context_total(context) > 0
+
+    def __len__(self):
+        return len(self.model.table.ctx_keys)
+
+    def __iter__(self):
+        table = self.model.table
+        words = self.model.ids.words
+        for row in unpack_keys(table.ctx_keys, self.model.n - 1, table.bits):
+            yield tuple(words[i] for i in row)
+
+    def items(self):
+        return ((ctx, _SuccessorView(self.model, ctx)) for ctx in self)
+
+
+class _ContextTotalsView:
+    """Read-only `context_counts` view; unseen contexts total 0."""
+    def __init__(self, model):
+        self.model = model
+
+    def __getitem__(self, context):
+        return self.model.context_total(context)
+
+    def get(self, context, default=0):
+        return self.model.context_total(context) or default
+
+    def __contains__(self, context):
+        return self.model.context_total(context) > 0
+
+    def __len__(self):
+        return len(self.model.table.ctx_keys)
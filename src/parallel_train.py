@@ -0,0 +1,133 @@
+import os
+import itertools
+import multiprocessing as mp
+from collections import deque
+import numpy as np
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from src.packed_model import (PackedNGramModel, CountTable, Vocabulary,
+                              key_bits, pack_keys, unpack_keys, merge_counts,
+                              merge_sorted_counts)
+from src.instrument import timed, counted, collect_counts
+
+
+def _checked_bits(num_words, order):
+    """key_bits for `num_words`, raising before any key would overflow int64."""
+    bits = key_bits(num_words)
+    if bits * order > 63:
+        raise ValueError(f"Vocabulary of {num_words} words is too large to pack {order}-grams into int64 keys")
+    return bits
+
+
+def _count_shard(sentences, orders):
+    """
+    Count every order of one shard in a single pass. Tokens are interned into a
+    shard-local vocabulary; returns (local words, {n: (keys, counts, bits, predicted ids)}).
+    """
+    pad = max(orders) - 1
+    local = Vocabulary()
+    add = local.add
+    flat, starts = [], []
+    for sentence in sentences:
+        starts.append(len(flat))
+        flat.extend(add(w) for w in ["<s>"] * pad + sentence)
+    bits = _checked_bits(len(local), max(orders))
+    flat = np.array(flat, dtype=np.int64)
+    sent_start = np.repeat(np.array(starts, dtype=np.int64),
+                           np.diff(np.append(starts, len(flat))).astype(np.int64))
+    rel = np.arange(len(flat)) - sent_start
+    tables = {}
+    for n in orders:
+        if len(flat) < n:
+            empty = np.zeros(0, dtype=np.int64)
+            tables[n] = (empty, empty, bits, empty)
+            continue
+        # A window is an n-gram of NGramModel(n) iff it stays inside its sentence
+        # and uses at most n-1 of the pad tokens.
+        pos = np.arange(len(flat) - n + 1)
+        ok = (rel[pos] >= pad - (n - 1)) & (sent_start[pos] == sent_start[pos + n - 1])
+        windows = flat[pos[ok][:, None] + np.arange(n)]
+        keys, counts = np.unique(pack_keys(windows, bits), return_counts=True)
+        tables[n] = (keys, counts.astype(np.int64), bits, np.unique(windows[:, -1]))
+    return local.words, tables
+
+
+def _bounded_map(pool, fn, items, window):
+    """pool.map that keeps at most `window` tasks in flight and yields in order."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _shards(data, shard_size):
+    it = iter(data)
+    while True:
+        shard = list(itertools.islice(it, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+@timed("train_all_orders")
+def train_all_orders(data, orders=(1, 2, 3, 4), workers=None, shard_size=20000):
+    """
+    Train packed models for every order in one pass over `data` (any iterable of
+    token lists, e.g. a StreamingCorpus). Shards are counted in worker processes
+    (at most 2 x workers in flight, so only a window of the corpus is held at a
+    time) and their packed tables sort-merged in the parent. Shard results are folded
+    in shard order, so IDs and counts are deterministic and the count tables are
+    identical to training each order serially.
+    """
+    orders = tuple(orders)
+    workers = workers or os.cpu_count() or 1
+    ids = Vocabulary()
+    predicted = {n: set() for n in orders}
+    pending = {n: [] for n in orders}
+    merged = {n: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)) for n in orders}
+    merged_bits = key_bits(0)
+
+    def fold():
+        # Sort only the newly arrived shard counts, then insert that sorted run into
+        # the (already sorted) running table: each fold is linear in the table size
+        nonlocal merged_bits
+        bits = _checked_bits(len(ids), max(orders))
+        for n in orders:
+            keys, counts = merged[n]
+            if bits != merged_bits:
+                # Re-packing with wider fields keeps the lexicographic order
+                keys = pack_keys(unpack_keys(keys, n, merged_bits), bits)
+            if pending[n]:
+                new_k = np.concatenate([pack_keys(rows, bits) for rows, _ in pending[n]])
+                new_c = np.concatenate([c for _, c in pending[n]])
+                merged[n] = merge_sorted_counts(keys, counts, *merge_counts(new_k, new_c, new_k[:0], new_c[:0]))
+            else:
+                merged[n] = keys, counts
+            pending[n] = []
+        merged_bits = bits
+
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        # Results come back in submission order, which keeps ID assignment deterministic
+        results = collect_counts(_bounded_map(pool, partial(counted, _count_shard, orders=orders),
+                                              _shards(data, shard_size), 2 * workers))
+        for i, (words, tables) in enumerate(results):
+            trans = np.array([ids.add(w) for w in words], dtype=np.int64)
+            for n, (keys, counts, bits, last) in tables.items():
+                pending[n].append((trans[unpack_keys(keys, n, bits)], counts))
+                predicted[n].update(trans[last].tolist())
+            if (i + 1) % workers == 0:
+                fold()
+    fold()
+
+    bits = merged_bits
+    models = []
+    for n in orders:
+        m = PackedNGramModel(n, ids)
+        m.table = CountTable(n, bits, *merged[n])
+        m.vocab = {ids.words[i] for i in predicted[n]}
+        models.append(m)
+    return models
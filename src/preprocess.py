@@ -1,17 +1,146 @@
-import nltk
-from nltk.tokenize import word_tokenize, sent_tokenize
+import re
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from collections import Counter
 import os
+import sys
+from src.instrument import timed
 
-nltk.download('punkt', quiet=True)
-nltk.download('punkt_tab', quiet=True)
-def load_data(path):
-    with open(path, 'r', encoding='utf-8') as file:
-        text = file.read()
-    sentences = sent_tokenize(text)
-    tokenized_sentences = [["<s>"] + word_tokenize(s) + ["</s>"] for s in sentences]
-    return tokenized_sentences
+# ----------------------------------------------------
+# Tokenizers
+#   "line"   one sentence per line, whitespace tokens (PTB and other
+#            pre-tokenized corpora) — no dependencies, by far the fastest
+#   "regex"  sentences split at . ! ? and line ends, tokens from TOKEN_PATTERN
+#   "nltk"   Punkt sent_tokenize + word_tokenize
+# NLTK is only imported (and its Punkt data fetched if missing) the first
+# time the "nltk" mode actually runs.
+# ----------------------------------------------------
+TOKENIZERS = ("line", "regex", "nltk")
+TOKEN_PATTERN = r"\w+(?:[-'.]\w+)*|[^\w\s]"
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_nltk = None
 
+def _load_nltk():
+    global _nltk
+    if _nltk is None:
+        import nltk
+        for resource in ("punkt", "punkt_tab"):
+            try:
+                nltk.data.find(f"tokenizers/{resource}")
+            except LookupError:
+                nltk.download(resource, quiet=True)
+        _nltk = nltk
+    return _nltk
+
+def tokenize_text(text, tokenizer="line", pattern=TOKEN_PATTERN):
+    """Split raw text into <s> … </s> wrapped token lists with the given tokenizer."""
+    if tokenizer == "line":
+        return [["<s>"] + line.split() + ["</s>"] for line in text.splitlines() if line.strip()]
+    if tokenizer == "regex":
+        find = re.compile(pattern).findall
+        return [["<s>"] + find(s) + ["</s>"]
+                for line in text.splitlines() for s in _SENTENCE_END.split(line) if s.strip()]
+    if tokenizer == "nltk":
+        nltk = _load_nltk()
+        return [["<s>"] + nltk.word_tokenize(s) + ["</s>"] for s in nltk.sent_tokenize(text)]
+    raise ValueError(f"Unknown tokenizer {tokenizer!r} (expected one of {TOKENIZERS})")
+
+def _iter_chunks(path, chunk_size):
+    """Blocks of about `chunk_size` characters, always cut at a line boundary ("-" reads stdin)."""
+    with (open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False) if path == "-"
+          else open(path, 'r', encoding='utf-8')) as file:
+        carry = ""
+        while True:
+            block = file.read(chunk_size)
+            if not block:
+                break
+            text = carry + block
+            cut = text.rfind("\n")
+            if cut < 0:
+                carry = text
+                continue
+            carry = text[cut + 1:]
+            yield text[:cut + 1]
+        if carry.strip():
+            yield carry
+
+@timed("load_data")
+def load_data(path, tokenizer="nltk", workers=None, chunk_size=1 << 20, pattern=TOKEN_PATTERN):
+    """
+    Tokenize a whole file. "regex" works line by line, so it tokenizes
+    line-aligned chunks on `workers` processes (default: all CPUs) with the
+    same result. "nltk" defaults to one in-process pass over the whole text:
+    Punkt's sentence splits depend on context, so an explicit workers > 1
+    (chunked, one tokenizer per process) may split sentences differently.
+    """
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer {tokenizer!r} (expected one of {TOKENIZERS})")
+    if workers is None:
+        workers = 1 if tokenizer == "nltk" else os.cpu_count() or 1
+    if tokenizer == "line" or workers == 1:
+        if tokenizer == "nltk":
+            with open(path, 'r', encoding='utf-8') as file:
+                return tokenize_text(file.read(), tokenizer)
+        return [s for chunk in _iter_chunks(path, chunk_size) for s in tokenize_text(chunk, tokenizer, pattern)]
+    if tokenizer == "nltk":
+        _load_nltk()  # check / fetch Punkt once, before the workers need it
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        # map() keeps chunk order, so the result matches in-process tokenization
+        chunks = pool.map(tokenize_text, _iter_chunks(path, chunk_size),
+                          itertools.repeat(tokenizer), itertools.repeat(pattern))
+        return [s for chunk in chunks for s in chunk]
+
+def iter_sentences(path, chunk_size=1 << 20, tokenizer="nltk"):
+    """
+    Stream tokenized sentences from `path`, reading and tokenizing about
+    `chunk_size` characters at a time. Chunks are cut at line boundaries, so a
+    sentence is never split across chunks (Punkt just can't join sentences
+    across a chunk boundary the way it can on the whole file).
+    """
+    for chunk in _iter_chunks(path, chunk_size):
+        yield from tokenize_text(chunk, tokenizer)
+
+def count_vocab(sentences, min_freq=1):
+    """First pass of a streaming vocab build: only word counts are held in memory."""
+    counts = Counter()
+    for sent in sentences:
+        counts.update(sent)
+    vocab = {w for w, c in counts.items() if c >= min_freq}
+    vocab.add("<unk>")
+    return sorted(vocab)
+
+def map_unk(sentences, vocab):
+    """Second pass: lazily replace out-of-vocabulary words with <unk>."""
+    vocab = set(vocab)
+    for sent in sentences:
+        yield [w if w in vocab else "<unk>" for w in sent]
+
+class StreamingCorpus:
+    """
+    Re-iterable, never-materialised view of a corpus file: every iteration
+    re-reads and re-tokenizes `path` chunk by chunk, mapping OOVs to <unk>
+    when a vocab is given. Pass it anywhere a list of sentences is expected
+    for a single pass (e.g. NGramModel.train).
+    """
+    def __init__(self, path, vocab=None, chunk_size=1 << 20, tokenizer="nltk"):
+        self.path = path
+        self.vocab = vocab
+        self.chunk_size = chunk_size
+        self.tokenizer = tokenizer
+
+    def __iter__(self):
+        sentences = iter_sentences(self.path, self.chunk_size, self.tokenizer)
+        return map_unk(sentences, self.vocab) if self.vocab is not None else sentences
+
+@timed("build_vocab_streaming")
+def build_vocab_streaming(path, min_freq=1, chunk_size=1 << 20, tokenizer="nltk"):
+    """Count-then-remap vocab build that never holds the corpus in memory."""
+    vocab = count_vocab(iter_sentences(path, chunk_size, tokenizer), min_freq)
+    return StreamingCorpus(path, vocab, chunk_size, tokenizer), vocab
+
+@timed("build_vocab")
 def build_vocab(tokenized_data, min_freq=1):
     
     counts = Counter(w for sent in tokenized_data for w in sent)
@@ -0,0 +1,266 @@
+import os
+import json
+import pickle
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from src.model_io import load_packed_models, load_smoothed
+from src.smoothing import LinearInterpolation, StupidBackoff
+from src.batch_scoring import sentence_logprobs, model_vocabulary
+from src.generate import generate_batch
+from src.arpa import read_arpa
+from src.compress import quantize
+
+# ----------------------------------------------------
+# Long-running scoring service
+#   POST /logprob     {"sentences": [...]}  -> per-sentence log2 / ln probs
+#   POST /perplexity  {"sentences": [...]}  -> corpus perplexity
+#   POST /generate    {"num", "max_len", "top_k", "top_p", "seed", "temperature"}
+#   GET  /health
+# Sentences are strings (whitespace-tokenized, wrapped in <s> … </s>) or token
+# lists used as-is. Concurrent scoring requests are micro-batched into one
+# vectorised score_batch() call on a bounded worker pool. Malformed requests
+# get 400, bodies over --max-body bytes 413; failures while scoring or
+# generating get 500. /generate's num and max_len are clamped to
+# --max-num / --max-len.
+# ----------------------------------------------------
+class BadRequest(ValueError):
+    """A malformed request (answered with 400; anything else raised is a 500)."""
+
+
+def _number(body, key, kind, default):
+    value = body.get(key, default)
+    if value is None and default is None:
+        return None  # optional parameter left unset
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{key!r} must be a number, got {value!r}") from None
+
+
+class MicroBatcher:
+    """Collects concurrent scoring requests and scores them together."""
+    def __init__(self, model, executor, max_batch=2048, max_wait=0.005):
+        self.model = model
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.batches = self.requests = 0
+        # Strong references to in-flight scoring tasks (the loop only keeps weak ones)
+        self.tasks = set()
+
+    async def score(self, sentences):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentences, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            size = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                size += len(item[0])
+            # Score in the background so the next batch can start collecting
+            task = asyncio.create_task(self._score(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _score(self, items):
+        loop = asyncio.get_running_loop()
+        batch = [s for sentences, _ in items for s in sentences]
+        try:
+            sums, lengths = await loop.run_in_executor(self.executor, sentence_logprobs, self.model, batch)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.requests += len(items)
+        start = 0
+        for sentences, future in items:
+            end = start + len(sentences)
+            if not future.done():
+                future.set_result((sums[start:end], lengths[start:end]))
+            start = end
+
+
+class ScoringServer:
+    def __init__(self, model, workers=4, max_batch=2048, max_wait=0.005, max_body=8 << 20,
+                 max_num=1000, max_len=200):
+        self.model = model
+        self.max_body = max_body
+        self.max_num = max_num
+        self.max_len = max_len
+        self.vocab = model_vocabulary(model)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batcher = MicroBatcher(model, self.executor, max_batch, max_wait)
+
+    def _tokenize(self, sentence):
+        if isinstance(sentence, str):
+            tokens = ["<s>"] + sentence.split() + ["</s>"]
+        elif isinstance(sentence, list) and all(isinstance(w, str) for w in sentence):
+            tokens = sentence
+        else:
+            raise BadRequest(f"a sentence must be a string or a list of tokens, got {sentence!r}")
+        return [w if w in self.vocab else "<unk>" for w in tokens]
+
+    async def handle(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "batches": self.batcher.batches, "requests": self.batcher.requests}
+        if method != "POST":
+            return 405, {"error": "method not allowed"}
+        if path in ("/logprob", "/perplexity"):
+            if not isinstance(body.get("sentences", []), list):
+                raise BadRequest("'sentences' must be a list")
+            sentences = [self._tokenize(s) for s in body.get("sentences", [])]
+            sums, lengths = await self.batcher.score(sentences)
+            if path == "/logprob":
+                return 200, {"log2prob": [float(x) if np.isfinite(x) else None for x in sums],
+                             "tokens": lengths.tolist()}
+            total, count = float(sums.sum()), int(lengths.sum())
+            pp = float(2.0 ** (-total / count)) if count and np.isfinite(total) else None
+            return 200, {"perplexity": pp, "tokens": count}
+        if path == "/generate":
+            loop = asyncio.get_running_loop()
+            params = {"num": _number(body, "num", int, 1), "max_len": _number(body, "max_len", int, 20),
+                      "temperature": _number(body, "temperature", float, 1.0),
+                      "top_k": _number(body, "top_k", int, None), "top_p": _number(body, "top_p", float, None),
+                      "seed": _number(body, "seed", int, None)}
+            if params["temperature"] <= 0:
+                raise BadRequest("'temperature' must be positive")
+            if params["num"] < 0 or params["max_len"] < 0:
+                raise BadRequest("'num' and 'max_len' must not be negative")
+            params["num"] = min(params["num"], self.max_num)
+            params["max_len"] = min(params["max_len"], self.max_len)
+            texts = await loop.run_in_executor(self.executor, lambda: generate_batch(self.model, **params))
+            return 200, {"texts": texts}
+        return 404, {"error": f"unknown endpoint {path}"}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = headers.get("content-length", "0")
+                if not (length.isascii() and length.isdigit()):
+                    # No trustworthy framing for the body: answer and drop the connection
+                    await self._respond(writer, 400, {"error": f"invalid Content-Length {length!r}"}, False)
+                    break
+                if int(length) > self.max_body:
+                    await self._respond(writer, 413, {"error": f"request body over {self.max_body} bytes"}, False)
+                    break
+                raw = await reader.readexactly(int(length))
+                try:
+                    body = json.loads(raw) if raw else {}
+                    if not isinstance(body, dict):
+                        raise BadRequest("the request body must be a JSON object")
+                    status, payload = await self.handle(method, path, body)
+                except (BadRequest, json.JSONDecodeError, UnicodeDecodeError) as e:
+                    status, payload = 400, {"error": str(e)}
+                except Exception as e:
+                    print(f"[ERROR] {method} {path}: {type(e).__name__}: {e}")
+                    status, payload = 500, {"error": f"internal error: {type(e).__name__}"}
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, payload, keep_alive):
+        data = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8080, socket_path=None):
+        batch_task = asyncio.create_task(self.batcher.run())
+        if socket_path:
+            server = await asyncio.start_unix_server(self.serve_connection, path=socket_path)
+            print(f"[INFO] Serving on unix:{socket_path}")
+        else:
+            server = await asyncio.start_server(self.serve_connection, host, port)
+            print(f"[INFO] Serving on http://{host}:{port}")
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batch_task.cancel()
+
+
+def add_model_arguments(parser):
+    """Model selection options shared by the server and the file scorer."""
+    parser.add_argument("--models", default=os.path.join("models", "base"))
+    parser.add_argument("--smoothed", help="saved smoothing parameters (e.g. models/backoff_best.json)")
+    parser.add_argument("--pickle", help="pickled smoothed model from older runs (e.g. models/backoff_best.pkl)")
+    parser.add_argument("--arpa", help="ARPA backoff model (e.g. models/kn4.arpa)")
+    parser.add_argument("--quantize", type=int, choices=[8, 16], help="quantize the ARPA model's weights in memory")
+    parser.add_argument("--smoothing", choices=["backoff", "interp"], default="backoff")
+    parser.add_argument("--alpha", type=float, default=0.4)
+    parser.add_argument("--lambdas", type=float, nargs=4, default=[0.1, 0.3, 0.3, 0.3])
+
+
+def load_scoring_model(args):
+    """Build the served model once: an ARPA file, a saved or pickled wrapper, or base models + smoothing."""
+    if args.arpa:
+        model = read_arpa(args.arpa)
+        return quantize(model, args.quantize) if args.quantize else model
+    if args.smoothed:
+        return load_smoothed(args.smoothed)
+    if args.pickle:
+        with open(args.pickle, "rb") as f:
+            return pickle.load(f)
+    uni, bi, tri, tetra = load_packed_models(args.models)
+    if args.smoothing == "interp":
+        return LinearInterpolation([uni, bi, tri, tetra], args.lambdas, n=4)
+    return StupidBackoff([tetra, tri, bi, uni], alpha=args.alpha)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="N-gram scoring server")
+    add_model_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", help="serve on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-batch", type=int, default=2048, help="max sentences per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--max-body", type=int, default=8 << 20, help="largest request body in bytes (else 413)")
+    parser.add_argument("--max-num", type=int, default=1000, help="most sentences one /generate call returns")
+    parser.add_argument("--max-len", type=int, default=200, help="longest sentence /generate produces")
+    args = parser.parse_args()
+
+    server = ScoringServer(load_scoring_model(args), args.workers, args.max_batch, args.max_wait_ms / 1000,
+                           args.max_body, args.max_num, args.max_len)
+    asyncio.run(server.serve(args.host, args.port, args.socket))
+
+
+if __name__ == "__main__":
+    main()
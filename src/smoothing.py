@@ -1,24 +1,279 @@
-import math
-from collections import Counter, defaultdict
 # from src.ngram_model import NGramModel
-class AddOneSmoothing:
+import threading
+from collections import OrderedDict
+import numpy as np
+from src.packed_model import CountTable, shared_tables
+from src.evaluate import evaluate_model
+from src import instrument
+from src.instrument import count
+
+def update_models(models, data):
+    """
+    Append documents to every wrapped model (one-shot iterators are materialised
+    first). Views of one shared count source (e.g. a SuffixArrayIndex) update it once.
+    A SuffixArrayIndex update re-sorts the whole corpus (see SuffixArrayIndex.update),
+    so pass documents in large batches.
+    """
+    if iter(data) is data:
+        data = list(data)
+    updated = set()
+    for model in models:
+        shared = getattr(model, "index", None)
+        if shared is not None:
+            if id(shared) in updated:
+                continue
+            updated.add(id(shared))
+        model.update(data)
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return getattr(value, "nbytes", 0)
+
+class LRUCache:
+    """
+    Small least-recently-used cache (OrderedDict based) with hit/miss counters.
+    Bounded by entry count and, with max_bytes, by the total nbytes of the
+    cached arrays. A named cache also feeds the run-wide
+    "cache.<name>.hits/misses" counters while instrumentation is on.
+    """
+    def __init__(self, maxsize=4096, name=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self.name = name
+        self._counters = (f"cache.{name}.hits", f"cache.{name}.misses") if name else None
+        # Shared by the server's worker threads
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.data.move_to_end(key)
+                self.hits += 1
+        if self._counters and instrument.ENABLED:
+            count(self._counters[value is None])
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.nbytes -= _nbytes(old)
+            self.data[key] = value
+            self.nbytes += _nbytes(value)
+            while len(self.data) > self.maxsize or (
+                    self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.data) > 1):
+                _, evicted = self.data.popitem(last=False)
+                self.nbytes -= _nbytes(evicted)
+
+def _no_overrides():
+    empty = np.zeros(0, dtype=np.int64)
+    return empty, empty, np.zeros(0)
+
+class NextWordDistribution:
+    """
+    Mixin giving smoothed models `next_word_distribution(context)`: p(w | context)
+    for every w in `self.words` as one NumPy vector, equal to calling prob() per
+    word. Vectors are assembled from each order's sparse successor set on top of a
+    context-independent base, and kept in an LRU cache keyed by context. Cache
+    entries are tied to the wrapped models' versions, so update() invalidates them.
+    Each cached vector is len(words) floats, so the cache is also capped at
+    `cache_bytes` (64 MB) however large the vocabulary.
+    """
+    cache_size = 256
+    cache_bytes = 64 << 20
+
+    def _base_models(self):
+        return self.models
+
+    def _state_key(self):
+        return tuple(getattr(m, "version", 0) for m in self._base_models())
+
+    def _dist_state(self):
+        state = self.__dict__.get("_dist")
+        key = self._state_key()
+        if state is None or state["key"] != key:
+            words = sorted(self._vocab_source())
+            state = {"key": key, "words": words, "index": {w: i for i, w in enumerate(words)},
+                     "cache": LRUCache(self.cache_size, "next_word_distribution", self.cache_bytes),
+                     "translations": {},
+                     "successors": LRUCache(16 * self.cache_size, "successors", self.cache_bytes)}
+            self._dist = state
+        return state
+
+    @property
+    def words(self):
+        return self._dist_state()["words"]
+
+    @property
+    def dist_cache(self):
+        return self._dist_state()["cache"]
+
+    def next_word_distribution(self, context):
+        state = self._dist_state()
+        key = (tuple(context), self._params())
+        dist = state["cache"].get(key)
+        if dist is None:
+            dist = self._distribution(tuple(context))
+            dist.setflags(write=False)
+            state["cache"].put(key, dist)
+        return dist
+
+    def next_word_distributions(self, contexts):
+        """
+        next_word_distribution for many contexts at once, as a len(contexts) x
+        len(words) matrix. Rows are built together and not cached.
+        """
+        contexts = [tuple(c) for c in contexts]
+        sparse = self.sparse_distributions(contexts)
+        if sparse is None:
+            return np.array([self.next_word_distribution(c) for c in contexts]).reshape(len(contexts), -1)
+        base, rows, pos, values = sparse
+        out = np.tile(base, (len(contexts), 1))
+        out[rows, pos] = values
+        return out
+
+    def sparse_distributions(self, contexts):
+        """
+        The same rows as a shared context-independent `base` vector plus
+        per-context overrides: (base, rows, positions, values), sorted by
+        (row, position), so row r is `base` with base[positions] = values for the
+        entries of row r. None for models whose distributions lack that shape.
+        """
+        if not hasattr(self, "_overrides"):
+            return None
+        state = self._dist_state()
+        bases = state.setdefault("bases", {})
+        base = bases.get(self._params())
+        if base is None:
+            base = bases[self._params()] = self._base(state)
+            base.setflags(write=False)
+        rows, pos, values = self._overrides(state, [tuple(c) for c in contexts], base)
+        return base, rows, pos, values
+
+    def _stacked_successors(self, state, model, contexts):
+        """Successor sets of `model` for each context, stacked as (rows, positions, counts, totals)."""
+        n = model.n
+        if hasattr(model, "context_indices"):
+            # Packed models: one vectorised lookup for the whole batch of contexts
+            i = model.context_indices([context[-(n-1):] if n > 1 else () for context in contexts])
+            seen = np.flatnonzero(i >= 0)
+            table = model.table
+            lo, hi = table.ctx_ptr[i[seen]], table.ctx_ptr[i[seen] + 1]
+            sizes = hi - lo
+            rows = np.repeat(seen, sizes)
+            flat = np.arange(sizes.sum()) + np.repeat(lo - np.cumsum(sizes) + sizes, sizes)
+            pos = self._translation(state, model)[table.keys[flat] & ((1 << table.bits) - 1)]
+            totals = np.repeat(table.ctx_totals[i[seen]].astype(np.float64), sizes)
+            keep = pos >= 0
+            return rows[keep], pos[keep], table.counts[flat][keep], totals[keep]
+        parts = [self._successors(model, context[-(n-1):] if n > 1 else (), state) for context in contexts]
+        sizes = [len(pos) for pos, _, _ in parts]
+        rows = np.repeat(np.arange(len(parts)), sizes)
+        if not len(rows):
+            return rows, rows, np.zeros(0), np.zeros(0)
+        return (rows, np.concatenate([pos for pos, _, _ in parts]),
+                np.concatenate([counts for _, counts, _ in parts]),
+                np.repeat([float(total) for _, _, total in parts], sizes))
+
+    def _successors(self, model, context, state=None):
+        """(positions in self.words, counts, total) for what `model` saw after `context`."""
+        state = state or self._dist_state()
+        # Per-order successor sets are shared across full contexts: the unigram
+        # set in particular is computed once and reused as the common base.
+        key = (id(model), context)
+        cached = state["successors"].get(key)
+        if cached is None:
+            cached = self._sparse_successors(state, model, context)
+            state["successors"].put(key, cached)
+        return cached
+
+    def _translation(self, state, model):
+        """Positions in self.words of every ID in `model`'s Vocabulary (-1: not a word here)."""
+        tkey = (id(model.ids), len(model.ids))
+        trans = state["translations"].get(tkey)
+        if trans is None:
+            index = state["index"]
+            trans = np.array([index.get(w, -1) for w in model.ids.words], dtype=np.int64)
+            state["translations"][tkey] = trans
+        return trans
+
+    def _sparse_successors(self, state, model, context):
+        total = model.context_total(context)
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), 0
+        if hasattr(model, "successors"):
+            # Packed and suffix-array models: successor IDs in their Vocabulary
+            ids, counts = model.successors(context)
+            pos = self._translation(state, model)[ids]
+        else:
+            index = state["index"]
+            items = [(index.get(w, -1), c) for w, c in model.counts[context].items() if c]
+            pos = np.array([i for i, _ in items], dtype=np.int64)
+            counts = np.array([c for _, c in items], dtype=np.int64)
+        keep = pos >= 0
+        return pos[keep], counts[keep], total
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_dist", None)
+        return state
+
+class AddOneSmoothing(NextWordDistribution):
+    scoring = "add_one"  # batch path in src.batch_scoring
+
     def __init__(self, model):
         self.model = model
         self.n = model.n
+
+    def update(self, data):
+        self.model.update(data)
+        return self
+
     def prob(self, context, word):
+        count("prob.add1")
+        V = len(self.model.vocab)
+        seen = self.model.count(context, word)
+        total = self.model.context_total(context)
+        return (seen + 1) / (total + V)
+
+    def _base_models(self):
+        return [self.model]
+
+    def _vocab_source(self):
+        return self.model.vocab
+
+    def _params(self):
+        return ()
+
+    def _distribution(self, context):
         V = len(self.model.vocab)
-        count = self.model.counts[context][word]
-        total = self.model.context_counts[context]
-        return (count + 1) / (total + V)
+        pos, counts, total = self._successors(self.model, context)
+        dist = np.full(len(self.words), 1 / (total + V))
+        dist[pos] = (counts + 1) / (total + V)
+        return dist
+
+class LinearInterpolation(NextWordDistribution):
+    scoring = "interpolation"
 
-class LinearInterpolation:
     def __init__(self, models, lambdas:list, n:int=3):
         # assert abs(sum(lambdas) - 1.0) == 0
         self.models = models
         self.lambdas = lambdas
         self.n = n
+
+    def update(self, data):
+        update_models(self.models, data)
+        return self
         
     def prob(self, context, word):
+        count("prob.interpolation")
         prob = 0
         for model, lam in zip(self.models, self.lambdas):
             n = model.n
@@ -26,24 +281,69 @@ class LinearInterpolation:
             prob += lam * model.prob(sub_context, word)
         return prob
 
-class StupidBackoff:
+    def _vocab_source(self):
+        return self.models[-1].vocab
+
+    def _params(self):
+        return tuple(self.lambdas)
+
+    def _distribution(self, context):
+        dist = np.zeros(len(self.words))
+        for model, lam in zip(self.models, self.lambdas):
+            n = model.n
+            sub_context = tuple(context[-(n-1):]) if n > 1 else ()
+            pos, counts, total = self._successors(model, sub_context)
+            if total:
+                dist[pos] += lam * (counts / total)
+        return dist
+
+    def _base(self, state):
+        # Unigram terms don't depend on the context
+        base = np.zeros(len(state["words"]))
+        for model, lam in zip(self.models, self.lambdas):
+            if model.n == 1:
+                pos, counts, total = self._successors(model, (), state)
+                if total:
+                    base[pos] += lam * (counts / total)
+        return base
+
+    def _overrides(self, state, contexts, base):
+        parts = [self._stacked_successors(state, model, contexts) + (lam,)
+                 for model, lam in zip(self.models, self.lambdas) if model.n > 1]
+        if not parts:
+            return _no_overrides()
+        V = len(base)
+        keys = np.concatenate([rows * V + pos for rows, pos, _, _, _ in parts])
+        mass = np.concatenate([lam * (counts / totals) for _, _, counts, totals, lam in parts])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        pos = keys % V
+        return keys // V, pos, base[pos] + np.bincount(inverse, weights=mass, minlength=len(keys))
+
+class StupidBackoff(NextWordDistribution):
+    scoring = "stupid_backoff"
+
     def __init__(self, models, alpha=0.4):
         self.models = models  # ordered: highest n to lowest
         self.alpha = alpha
         self.n = models[0].n  # Use highest order n-gram for context length
 
+    def update(self, data):
+        update_models(self.models, data)
+        return self
+
     def prob(self, context, word):
+        count("prob.stupid_backoff")
         score = 1.0
         for i, model in enumerate(self.models):
             n = model.n
             sub_context = tuple(context[-(n-1):]) if n > 1 else ()
             
-            count = model.counts[sub_context][word]
-            total = model.context_counts[sub_context]
+            seen = model.count(sub_context, word)
+            total = model.context_total(sub_context)
             
             if total > 0:
-                if count > 0:
-                    return score * (count / total)
+                if seen > 0:
+                    return score * (seen / total)
                 score *= self.alpha
             else:
                 score *= self.alpha
@@ -53,24 +353,176 @@ class StupidBackoff:
         # return a very small probability
         return score * (1.0 / len(self.models[0].vocab))  # Uniform over vocabulary
 
+    def _vocab_source(self):
+        return self.models[-1].vocab
+
+    def _params(self):
+        return (self.alpha,)
+
+    def _distribution(self, context):
+        # Fill from the lowest order up so higher orders overwrite: each word
+        # keeps the score of the highest order that has seen it, as in prob().
+        scores = [1.0]
+        for _ in self.models:
+            scores.append(scores[-1] * self.alpha)
+        dist = np.full(len(self.words), scores[-1] * (1.0 / len(self.models[0].vocab)))
+        for i in range(len(self.models) - 1, -1, -1):
+            model = self.models[i]
+            n = model.n
+            sub_context = tuple(context[-(n-1):]) if n > 1 else ()
+            pos, counts, total = self._successors(model, sub_context)
+            if total:
+                dist[pos] = scores[i] * (counts / total)
+        return dist
+
+    def _base(self, state):
+        scores = self.alpha ** np.arange(len(self.models) + 1)
+        base = np.full(len(state["words"]), scores[-1] * (1.0 / len(self.models[0].vocab)))
+        for i in range(len(self.models) - 1, -1, -1):
+            if self.models[i].n == 1:
+                pos, counts, total = self._successors(self.models[i], (), state)
+                if total:
+                    base[pos] = scores[i] * (counts / total)
+        return base
+
+    def _overrides(self, state, contexts, base):
+        # Highest order first, so the first entry per (row, word) is the one prob() uses
+        scores = self.alpha ** np.arange(len(self.models) + 1)
+        parts = [self._stacked_successors(state, model, contexts) + (scores[i],)
+                 for i, model in enumerate(self.models) if model.n > 1]
+        if not parts:
+            return _no_overrides()
+        V = len(base)
+        keys = np.concatenate([rows * V + pos for rows, pos, _, _, _ in parts])
+        values = np.concatenate([score * (counts / totals) for _, _, counts, totals, score in parts])
+        keys, first = np.unique(keys, return_index=True)
+        return keys // V, keys % V, values[first]
+
     def perplexity(self, data):
-        log_prob = 0.0
-        token_count = 0
-        
-        for sentence in data:
-            padded = ["<s>"] * (self.n - 1) + sentence
-            for i in range(self.n - 1, len(padded)):
-                context = tuple(padded[i-self.n+1:i])
-                word = padded[i]
-                p = self.prob(context, word)
-                
-                if p <= 0:
-                    return float("inf")
-                    
-                log_prob += math.log2(p)
-                token_count += 1
-                
-        if token_count == 0:
-            return float("inf")
-            
-        return math.pow(2, -log_prob / token_count)
+        return evaluate_model(self, data)
+
+class KneserNeySmoothing(NextWordDistribution):
+    """
+    Interpolated Modified Kneser-Ney over base models of orders 1..N.
+    Everything is computed once at build time into compact arrays per order:
+    the highest order keeps raw counts, lower orders use continuation counts
+    (number of distinct left extensions seen by the next order up), with three
+    discounts D1, D2, D3+ per order from count-of-counts. Each n-gram stores its
+    discounted weight (c - D(c)) / total and each context its backoff weight
+    gamma, so a query is at most two array lookups per order.
+    """
+    scoring = "kneser_ney"
+
+    def __init__(self, models):
+        self.models = sorted(models, key=lambda m: m.n)
+        self.n = self.models[-1].n
+        self._build()
+
+    def update(self, data):
+        update_models(self.models, data)
+        self._build()
+        return self
+
+    @staticmethod
+    def discounts(counts):
+        """Modified KN discounts (D1, D2, D3+) from count-of-counts n1..n4."""
+        n1, n2, n3, n4 = [int(np.count_nonzero(counts == i)) for i in (1, 2, 3, 4)]
+        if min(n1, n2, n3, n4) == 0:
+            return 0.5, 1.0, 1.5  # too little data for the estimates; conventional fallback
+        Y = n1 / (n1 + 2 * n2)
+        return (max(0.0, 1 - 2 * Y * n2 / n1),
+                max(0.0, 2 - 3 * Y * n3 / n2),
+                max(0.0, 3 - 4 * Y * n4 / n3))
+
+    def _build(self):
+        ids, bits, raw = shared_tables(self.models)
+        self.ids, self.bits = ids, bits
+        self.V = len(self.models[0].vocab)
+        self.tables, self.alphas, self.gammas, self.D = {}, {}, {}, {}
+        higher_keys = None
+        for n in sorted(raw, reverse=True):
+            if higher_keys is None:
+                table = raw[n]
+            else:
+                # Continuation count: distinct (n+1)-grams whose suffix is this n-gram
+                suffix = higher_keys & ((1 << (bits * n)) - 1)
+                table = CountTable.from_counts(n, bits, suffix, np.ones(len(suffix), dtype=np.int64))
+            D1, D2, D3 = self.discounts(table.counts)
+            disc = np.where(table.counts == 1, D1, np.where(table.counts == 2, D2, D3))
+            starts = table.ctx_ptr[:-1]
+            totals = table.ctx_totals.astype(np.float64)
+            ctx_of = np.repeat(np.arange(len(starts)), np.diff(table.ctx_ptr))
+            self.alphas[n] = (table.counts - disc) / totals[ctx_of] if len(ctx_of) else np.zeros(0)
+            mass = np.add.reduceat(disc, starts) if len(starts) else np.zeros(0)
+            self.gammas[n] = mass / totals
+            self.tables[n] = table
+            self.D[n] = (D1, D2, D3)
+            higher_keys = table.keys
+        # Drop cached distributions built from the previous tables
+        self.__dict__.pop("_dist", None)
+
+    def _encode(self, tokens):
+        key = 0
+        for w in tokens:
+            idx = self.ids.index.get(w)
+            if idx is None:
+                return None
+            key = (key << self.bits) | idx
+        return key
+
+    def prob(self, context, word):
+        count("prob.kneser_ney")
+        p = 1.0 / self.V
+        w = self.ids.index.get(word, -1)
+        for m in self.models:
+            n = m.n
+            sub_context = tuple(context[-(n-1):]) if n > 1 else ()
+            if len(sub_context) != n - 1:
+                continue
+            ctx = self._encode(sub_context)
+            table = self.tables[n]
+            i = table.find(table.ctx_keys, ctx) if ctx is not None else -1
+            if i < 0:
+                continue  # unseen context: pass the lower-order estimate through
+            alpha = 0.0
+            if w >= 0:
+                j = table.find(table.keys, (ctx << self.bits) | w)
+                alpha = self.alphas[n][j] if j >= 0 else 0.0
+            p = alpha + self.gammas[n][i] * p
+        return float(p)
+
+    def _vocab_source(self):
+        return self.models[0].vocab
+
+    def _params(self):
+        return ()
+
+    def _distribution(self, context):
+        state = self._dist_state()
+        tkey = ("kn", len(self.ids))
+        trans = state["translations"].get(tkey)
+        if trans is None:
+            index = state["index"]
+            trans = np.array([index.get(w, -1) for w in self.ids.words], dtype=np.int64)
+            state["translations"][tkey] = trans
+        dist = np.full(len(self.words), 1.0 / self.V)
+        mask = (1 << self.bits) - 1
+        for m in self.models:
+            n = m.n
+            sub_context = tuple(context[-(n-1):]) if n > 1 else ()
+            if len(sub_context) != n - 1:
+                continue
+            ctx = self._encode(sub_context)
+            table = self.tables[n]
+            i = table.find(table.ctx_keys, ctx) if ctx is not None else -1
+            if i < 0:
+                continue
+            lo, hi = table.ctx_ptr[i], table.ctx_ptr[i + 1]
+            pos = trans[table.keys[lo:hi] & mask]
+            keep = pos >= 0
+            dist *= self.gammas[n][i]
+            dist[pos[keep]] += self.alphas[n][lo:hi][keep]
+        return dist
+
+    def perplexity(self, data):
+        return evaluate_model(self, data)
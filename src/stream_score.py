@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from functools import partial
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from src.preprocess import _iter_chunks, tokenize_text, TOKENIZERS
+from src.corpus_cache import encode_sentences
+from src.batch_scoring import as_corpus, score_batch, model_vocabulary, _count_arrays
+from src.smoothing import AddOneSmoothing
+from src.arpa import BackoffModel
+from src.parallel_train import _bounded_map
+from src.instrument import count, timed, counted, collect_counts
+
+# ----------------------------------------------------
+# Streaming file scorer
+#   python -m src.stream_score corpus.txt --arpa models/kn4.arpa -o scores.jsonl
+# The input is read in line-aligned blocks and each block is tokenized,
+# vectorised-scored and serialised on its own (optionally on worker
+# processes, with a bounded number of blocks in flight), so memory stays flat
+# however large the file. A zero-probability token makes only its own sentence
+# -inf. Output is JSONL (one object per sentence) or a columnar directory of
+# flat binary arrays (see load_columns).
+# ----------------------------------------------------
+_STATE = {}  # set in worker processes only, by the pool initializer
+
+def _init_worker(state):
+    _STATE.update(state)
+
+def backoff_orders(model, corpus):
+    """Order of the longest n-gram behind each token's probability (0: none matched)."""
+    if isinstance(model, BackoffModel):
+        trans = corpus.translate(model.ids)
+        k = min(model.n - 1, corpus.n - 1)
+        hist = trans[corpus.history[:, corpus.n - 1 - k:]] if k else np.zeros((len(corpus), 0), dtype=np.int64)
+        return model.log10_probs(hist, trans[corpus.words], return_orders=True)[1]
+    if isinstance(model, AddOneSmoothing):
+        bases = [model.model]
+    else:
+        bases = getattr(model, "models", None) or [model]
+    orders = np.zeros(len(corpus), dtype=np.int8)
+    for m in sorted(bases, key=lambda m: m.n):
+        arrays = _count_arrays(m, corpus) if m.n - 1 <= corpus.n - 1 else None
+        if arrays is not None:
+            orders[arrays[0] > 0] = m.n
+    return orders
+
+def score_sentences(model, sentences, tokens=False, orders=False):
+    """
+    Per-sentence scores of a list of token lists: a dict of arrays "log2prob"
+    (sum, -inf if any token has zero probability), "tokens" and "zeros" (number
+    of zero-probability tokens), plus per-token "token_log2prob" / "token_order".
+    `sentences` may also be an EncodedSplit (see corpus_cache).
+    """
+    corpus = as_corpus(sentences, model.n)
+    log_probs = score_batch(model, corpus)
+    lengths = np.diff(corpus.offsets)
+    starts = corpus.offsets[:-1]
+    sums = np.zeros(len(lengths))
+    zeros = np.zeros(len(lengths), dtype=np.int64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(log_probs, starts[nonempty])
+        zeros[nonempty] = np.add.reduceat(~np.isfinite(log_probs), starts[nonempty])
+    result = {"log2prob": sums, "tokens": lengths, "zeros": zeros}
+    if tokens:
+        result["token_log2prob"] = log_probs
+    if orders:
+        result["token_order"] = backoff_orders(model, corpus)
+    return result
+
+def _json_lines(sentences, result):
+    # Rendered without the leading "{" so the writer can prepend the global id
+    lines = []
+    per_token = "token_log2prob" in result
+    with_orders = "token_order" in result
+    offsets = np.concatenate([[0], np.cumsum(result["tokens"])])
+    for i in range(len(result["tokens"])):
+        total = result["log2prob"][i]
+        row = {"log2prob": round(float(total), 4) if np.isfinite(total) else None,
+               "tokens": int(result["tokens"][i]), "zeros": int(result["zeros"][i])}
+        if per_token or with_orders:
+            lo, hi = offsets[i], offsets[i + 1]
+            row["words"] = sentences[i]
+            if per_token:
+                row["token_log2prob"] = [round(x, 4) if x != -np.inf else None
+                                         for x in result["token_log2prob"][lo:hi].tolist()]
+            if with_orders:
+                row["token_order"] = result["token_order"][lo:hi].tolist()
+        lines.append(json.dumps(row)[1:])
+    return lines
+
+def _score_block(text, state=None):
+    state = state or _STATE
+    model = state["model"]
+    sentences = tokenize_text(text, state["tokenizer"])
+    if state["unk"]:
+        # IDs straight from the model's vocabulary (unseen words → <unk>), skipping
+        # the per-token interning EncodedCorpus would otherwise do
+        sentences = encode_sentences(sentences, state["words"], state["index"])
+    result = score_sentences(model, sentences, state["tokens"], state["orders"])
+    if state["fmt"] == "jsonl":
+        result["lines"] = _json_lines(sentences, result)
+    result["sentences"] = len(sentences)
+    return result
+
+# ----------------------------------------------------
+# Output writers
+# ----------------------------------------------------
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+        self.next_id = 0
+
+    def write(self, result):
+        first = self.next_id
+        self.file.write("".join(f'{{"id": {first + i}, {line}\n' for i, line in enumerate(result["lines"])))
+        self.next_id += result["sentences"]
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+COLUMNS = {"log2prob": np.float64, "tokens": np.int32, "zeros": np.int32,
+           "token_log2prob": np.float32, "token_order": np.int8}
+
+class ColumnWriter:
+    """Appends each column to its own raw binary file in `path`; meta.json is written on close."""
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.files = {}
+        self.rows = {}
+
+    def write(self, result):
+        for name, dtype in COLUMNS.items():
+            if name not in result:
+                continue
+            if name not in self.files:
+                self.files[name] = open(os.path.join(self.path, f"{name}.bin"), "wb")
+                self.rows[name] = 0
+            np.asarray(result[name], dtype=dtype).tofile(self.files[name])
+            self.rows[name] += len(result[name])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        meta = {"columns": {name: {"dtype": np.dtype(COLUMNS[name]).name, "rows": rows}
+                            for name, rows in self.rows.items()},
+                "note": "token columns are concatenated per sentence; sentence i spans tokens[:i].sum() + tokens[i]"}
+        with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+
+def load_columns(path):
+    """Memory-map a columnar score directory as {column: array}."""
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    return {name: np.memmap(os.path.join(path, f"{name}.bin"), dtype=info["dtype"], mode="r", shape=(info["rows"],))
+            if info["rows"] else np.zeros(0, dtype=info["dtype"])
+            for name, info in meta["columns"].items()}
+
+# ----------------------------------------------------
+# Driver
+# ----------------------------------------------------
+@timed("score_file")
+def score_file(model, path, output="-", fmt="jsonl", tokens=False, orders=False, tokenizer="line",
+               workers=1, block_size=1 << 20, unk=True):
+    """
+    Score every sentence of `path` ("-" for stdin) and stream the results to
+    `output` ("-" for stdout with JSONL; a directory for fmt="columns").
+    Tokens the model has never seen become <unk> when unk=True. workers > 1
+    scores blocks on a process pool (the model is shared by fork). Returns a
+    summary dict.
+    """
+    if fmt not in ("jsonl", "columns"):
+        raise ValueError(f"Unknown output format {fmt!r} (expected 'jsonl' or 'columns')")
+    if fmt == "columns" and output == "-":
+        raise ValueError("Columnar output needs a directory, not stdout")
+    words = sorted(model_vocabulary(model) | {"<s>", "</s>", "<unk>"})
+    state = {"model": model, "words": words, "index": {w: i for i, w in enumerate(words)},
+             "tokenizer": tokenizer, "tokens": tokens, "orders": orders, "fmt": fmt, "unk": unk}
+    writer = JsonlWriter(output) if fmt == "jsonl" else ColumnWriter(output)
+    log = sys.stderr if output == "-" else sys.stdout
+    start = time.perf_counter()
+    sentences = num_tokens = zero_sentences = 0
+    total = 0.0
+    blocks = _iter_chunks(path, block_size)
+    pool = None
+    if workers > 1:
+        fork = "fork" in mp.get_all_start_methods()
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("fork" if fork else "spawn"),
+                                   initializer=_init_worker, initargs=(state,))
+        results = collect_counts(_bounded_map(pool, partial(counted, _score_block), blocks, 2 * workers))
+    else:
+        results = (_score_block(block, state) for block in blocks)
+    try:
+        for result in results:
+            writer.write(result)
+            sentences += result["sentences"]
+            num_tokens += int(result["tokens"].sum())
+            finite = np.isfinite(result["log2prob"])
+            zero_sentences += int((~finite).sum())
+            total += float(result["log2prob"][finite].sum())
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.shutdown()
+    seconds = time.perf_counter() - start
+    count("stream_score.sentences", sentences)
+    summary = {"sentences": sentences, "tokens": num_tokens, "zero_prob_sentences": zero_sentences,
+               "log2prob": total, "seconds": round(seconds, 3),
+               "sentences_per_second": round(sentences / seconds, 1) if seconds else None}
+    print(f"[INFO] Scored {sentences:,} sentences ({num_tokens:,} tokens) in {seconds:.2f}s "
+          f"→ {summary['sentences_per_second']:,} sentences/s; {zero_sentences} with zero-probability tokens",
+          file=log)
+    return summary
+
+def main():
+    from src.server import add_model_arguments, load_scoring_model
+    parser = argparse.ArgumentParser(description="Stream per-sentence (and per-token) scores for a text file")
+    parser.add_argument("input", help="text file to score, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL file (- for stdout) or directory for --format columns")
+    parser.add_argument("--format", choices=["jsonl", "columns"], default="jsonl")
+    parser.add_argument("--tokens", action="store_true", help="include per-token log2 probabilities")
+    parser.add_argument("--orders", action="store_true", help="include the n-gram order used for each token")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default="line")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--block-size", type=int, default=1 << 20, help="characters read per block")
+    parser.add_argument("--no-unk", action="store_true", help="don't map unseen words to <unk>")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+    # Keep stdout clean for the JSONL stream: load-time messages go to stderr
+    with contextlib.redirect_stdout(sys.stderr if args.output == "-" else sys.stdout):
+        model = load_scoring_model(args)
+    score_file(model, args.input, args.output, args.format, args.tokens, args.orders,
+               args.tokenizer, args.workers, args.block_size, unk=not args.no_unk)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import numpy as np
+from src.packed_model import (PackedNGramModel, CountTable, Vocabulary, key_bits, pack_keys,
+                              _CountsView, _ContextTotalsView)
+from src.corpus_cache import EncodedSplit
+from src.evaluate import evaluate_model
+from src.instrument import count, timed
+
+SEP = -1       # sentence separator in the encoded stream
+_END = -2      # reads past the end of the stream (sorts before every token)
+_MISSING = -3  # query token that can never match (unknown word)
+
+# ----------------------------------------------------
+# Suffix-array count engine
+# The training sentences are stored once as a flat int32 stream
+#   SEP s1 SEP s2 ... SEP sN SEP
+# reversed, together with the suffix array of that reversed stream. Reading
+# an n-gram right to left (word, then its history newest-first) makes every
+# order an extension of the previous one: a single SA range is narrowed one
+# token at a time, and its width after k tokens is the count of the k-gram.
+# NGramModel(n) pads each sentence with n-1 <s>; that padding is not stored.
+# Windows that reach into it are counted as sentence-initial matches instead
+# (SEP + the rest of the n-gram), so one stream serves every order. Memory is
+# two int32 arrays of corpus length, whatever the maximum order.
+# ----------------------------------------------------
+@timed("suffix_array")
+def suffix_array(text):
+    """Suffix array of an integer sequence by prefix doubling (reading past the end sorts first)."""
+    n = len(text)
+    rank = np.unique(text, return_inverse=True)[1].astype(np.int64).ravel()
+    sa = np.argsort(rank, kind="stable")
+    k = 1
+    while n > 1:
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - k] = rank[k:] + 1
+        key = rank * (n + 1) + second
+        sa = np.argsort(key)
+        key = key[sa]
+        rank = np.empty(n, dtype=np.int64)
+        rank[sa] = np.cumsum(np.r_[0, key[1:] != key[:-1]])
+        if rank[sa[-1]] == n - 1 or k >= n:
+            break
+        k <<= 1
+    return sa.astype(np.int32 if n < 2**31 else np.int64)
+
+
+class SuffixArrayIndex:
+    """
+    Counts of n-grams of any order over one training corpus, answered on demand
+    from a suffix array. `model(n)` / `models(orders)` give NGramModel-like views
+    that StupidBackoff and LinearInterpolation take as base models.
+    """
+    def __init__(self, sentences=(), ids=None):
+        self.ids = ids if ids is not None else Vocabulary()
+        self.version = 0
+        self._set_stream(self._encode(sentences))
+
+    @classmethod
+    def from_split(cls, split):
+        """Index an EncodedSplit (corpus_cache) without re-interning its tokens."""
+        index = cls.__new__(cls)
+        index.ids = Vocabulary(split.words)
+        index.version = 0
+        lengths = np.diff(np.asarray(split.offsets))
+        index._set_stream(index._stream(np.asarray(split.ids, dtype=np.int32), lengths))
+        return index
+
+    def _encode(self, sentences):
+        add = self.ids.add
+        flat, lengths = [], []
+        for sentence in sentences:
+            flat.extend(add(w) for w in sentence)
+            lengths.append(len(sentence))
+        return self._stream(np.array(flat, dtype=np.int32), np.array(lengths, dtype=np.int64))
+
+    @staticmethod
+    def _stream(ids, lengths):
+        """Forward stream SEP s1 SEP s2 ... SEP sN SEP (empty sentences have no n-grams and are dropped)."""
+        lengths = lengths[lengths > 0]
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        stream = np.full(len(ids) + len(lengths) + 1, SEP, dtype=np.int32)
+        stream[np.arange(len(ids)) + sentence + 1] = ids
+        return stream
+
+    def _set_stream(self, forward):
+        self.text = np.ascontiguousarray(forward[::-1])
+        self.sa = suffix_array(self.text)
+        self.num_sentences = int(np.count_nonzero(self.text == SEP)) - 1
+        self.num_tokens = len(self.text) - self.num_sentences - 1
+        self.vocab = {self.ids.words[i] for i in np.unique(self.text[self.text >= 0])}
+        self.version += 1
+
+    @property
+    def forward(self):
+        return self.text[::-1]
+
+    def update(self, data):
+        """
+        Append documents. The suffix array is rebuilt from scratch over the grown
+        stream, O(N log² N) in the total corpus length however little is added,
+        so batch many documents into one call rather than updating per document.
+        """
+        added = self._encode(data)
+        self._set_stream(np.concatenate([self.forward[:-1], added]))
+        return self
+
+    def model(self, n):
+        return SuffixArrayModel(self, n)
+
+    def models(self, orders):
+        return [SuffixArrayModel(self, n) for n in orders]
+
+    @property
+    def nbytes(self):
+        return self.text.nbytes + self.sa.nbytes
+
+    # ------------------------------------------------
+    # Range queries
+    # ------------------------------------------------
+    def _narrow(self, lo, hi, depth, tokens):
+        """
+        Sub-ranges of [lo, hi) (suffixes sharing their first `depth` tokens)
+        whose next token equals `tokens`, by vectorised binary search.
+        """
+        text, sa, n = self.text, self.sa, len(self.text)
+        tokens = np.broadcast_to(tokens, lo.shape)
+
+        def bound(lo, hi, right):
+            lo, hi = lo.copy(), hi.copy()
+            idx = np.flatnonzero(lo < hi)
+            while idx.size:
+                mid = (lo[idx] + hi[idx]) >> 1
+                pos = sa[mid].astype(np.int64) + depth
+                value = np.where(pos < n, text[np.minimum(pos, n - 1)], _END)
+                go = value <= tokens[idx] if right else value < tokens[idx]
+                lo[idx[go]] = mid[go] + 1
+                hi[idx[~go]] = mid[~go]
+                idx = idx[lo[idx] < hi[idx]]
+            return lo
+        first = bound(lo, hi, False)
+        return first, bound(first, hi, True)
+
+    def _full(self, T):
+        return np.zeros(T, dtype=np.int64), np.full(T, len(self.text), dtype=np.int64)
+
+    def lookup(self, history, words, max_order=None):
+        """
+        Counts for every token and every order up to max_order (default: all
+        the history allows). `history` is a (T, k) matrix of this index's IDs
+        (-1 for unknown), `words` a (T,) ID array. Returns a list whose entry
+        n-1 is (count(context + word), count(context)) for order n, where the
+        context is the last n-1 history tokens.
+        """
+        T = len(words)
+        k = history.shape[1] if max_order is None else min(max_order - 1, history.shape[1])
+        bos = self.ids.index.get("<s>", _MISSING)
+        history = np.where(history >= 0, history, _MISSING)
+        words = np.where(words >= 0, words, _MISSING)
+        sep = np.full(T, SEP)
+        # A: word + history (newest first); B: history alone; C: SEP + history,
+        # i.e. the context at the end of a sentence, which predicts nothing.
+        a_lo, a_hi = self._narrow(*self._full(T), 0, words)
+        b_lo, b_hi = self._full(T)
+        c_lo, c_hi = self._narrow(*self._full(T), 0, sep)
+        # pad_*: matches that run into the virtual <s> padding (sentence-initial)
+        pad_counts = np.zeros(T, dtype=np.int64)
+        pad_totals = np.zeros(T, dtype=np.int64)
+        result = [(a_hi - a_lo, b_hi - b_lo - (c_hi - c_lo))]
+        for d in range(1, k + 1):
+            token = history[:, -d]
+            pad = token == bos
+            if pad.any():
+                # Context (<s>, rest...): the padded window also matches wherever
+                # `rest` starts a sentence, on top of the matches stored in the stream
+                i = np.flatnonzero(pad)
+                lo, hi = self._narrow(a_lo[i], a_hi[i], d, sep[i])
+                ext_a = hi - lo
+                if d == 1:
+                    ext_b = np.full(len(i), self.num_sentences)
+                else:
+                    lo, hi = self._narrow(b_lo[i], b_hi[i], d - 1, sep[i])
+                    lo2, hi2 = self._narrow(c_lo[i], c_hi[i], d, sep[i])
+                    ext_b = (hi - lo) - (hi2 - lo2)
+                pad_counts[i] += ext_a
+                pad_totals[i] += ext_b
+            pad_counts[~pad] = 0
+            pad_totals[~pad] = 0
+            a_lo, a_hi = self._narrow(a_lo, a_hi, d, token)
+            b_lo, b_hi = self._narrow(b_lo, b_hi, d - 1, token)
+            c_lo, c_hi = self._narrow(c_lo, c_hi, d, token)
+            result.append((a_hi - a_lo + pad_counts, b_hi - b_lo - (c_hi - c_lo) + pad_totals))
+        count("suffix_array.lookups", T)
+        return result
+
+    def _ids(self, tokens):
+        return np.array([self.ids.index.get(w, -1) for w in tokens], dtype=np.int64)
+
+    def counts(self, context, word):
+        """(count(context + word), count(context)) under NGramModel(len(context) + 1)."""
+        counts, totals = self.lookup(self._ids(context)[None, :], self._ids([word]))[-1]
+        return int(counts[0]), int(totals[0])
+
+    def successors(self, context):
+        """(word IDs, counts) of everything observed after `context`, padding included."""
+        ctx = self._ids(context)
+        if (ctx < 0).any():
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        bos = self.ids.index.get("<s>")
+        ranges = []
+        lo, hi = self._full(1)
+        for d in range(1, len(ctx) + 1):
+            if ctx[-d] == bos:
+                # Sentence-initial occurrences of the newer part stand in for the
+                # padding, as long as everything older in the context is <s> too
+                ranges.append(self._narrow(lo, hi, d - 1, np.array([SEP])))
+            else:
+                ranges = []
+            lo, hi = self._narrow(lo, hi, d - 1, ctx[-d:len(ctx) - d + 1])
+        ranges.append((lo, hi))
+        # In the reversed stream the forward successor sits just before each match
+        starts = np.concatenate([self.sa[l[0]:h[0]] for l, h in ranges]).astype(np.int64)
+        starts = starts[starts > 0]
+        following = self.text[starts - 1]
+        following = following[following >= 0]
+        ids, counts = np.unique(following, return_counts=True)
+        return ids.astype(np.int64), counts.astype(np.int64)
+
+
+class SuffixArrayModel:
+    """
+    Order-n view of a SuffixArrayIndex with the NGramModel lookup interface
+    (count, context_total, prob, counts[context][word], context_counts). Every
+    order shares the index, so adding one costs nothing.
+    """
+    scoring = "suffix_array"  # batch path in src.batch_scoring
+
+    def __init__(self, index, n):
+        self.index = index
+        self.n = n
+
+    @property
+    def ids(self):
+        return self.index.ids
+
+    @property
+    def vocab(self):
+        return self.index.vocab
+
+    @property
+    def version(self):
+        return self.index.version
+
+    def update(self, data):
+        self.index.update(data)
+        return self
+
+    def freeze(self):
+        return self
+
+    def count(self, context, word):
+        if len(context) != self.n - 1:
+            return 0
+        return self.index.counts(tuple(context), word)[0]
+
+    def context_total(self, context):
+        if len(context) != self.n - 1:
+            return 0
+        return self.index.counts(tuple(context), None)[1]
+
+    def successors(self, context):
+        if len(context) != self.n - 1:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return self.index.successors(tuple(context))
+
+    @property
+    def counts(self):
+        return _CountsView(self)
+
+    @property
+    def context_counts(self):
+        return _ContextTotalsView(self)
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes
+
+    def prob(self, context, word):
+        count("prob.mle")
+        seen, total = self.index.counts(tuple(context), word) if len(context) == self.n - 1 else (0, 0)
+        return seen / total if total else 0.0
+
+    def packed(self):
+        """Materialise this order as a PackedNGramModel (e.g. for Kneser-Ney or saving)."""
+        n = self.n
+        forward = self.index.forward.astype(np.int64)
+        ids = self.ids
+        bos = ids.index.get("<s>")
+        if bos is None:
+            # Never add to the shared vocabulary (the index's version and vocab
+            # wouldn't know): pad with <s> from a private copy instead
+            ids = Vocabulary(ids.words + ["<s>"])
+            bos = ids.index["<s>"]
+        # Pad every sentence with n-1 <s> after its separator, as NGramModel does
+        sep = np.flatnonzero(forward == SEP)[:-1]
+        inserted = np.repeat(sep + 1, n - 1)
+        padded = np.insert(forward, inserted, bos)
+        end = len(padded) - n + 1
+        starts = np.arange(max(end, 0))
+        windows = padded[starts[:, None] + np.arange(n)] if end > 0 else np.zeros((0, n), dtype=np.int64)
+        windows = windows[(windows != SEP).all(axis=1)]
+        bits = key_bits(len(ids))
+        if bits * n > 63:
+            raise ValueError(f"Vocabulary of {len(ids)} words is too large to pack {n}-grams into int64 keys")
+        model = PackedNGramModel(n, ids)
+        model.table = CountTable.from_counts(n, bits, pack_keys(windows, bits), np.ones(len(windows), dtype=np.int64))
+        model.vocab = {ids.words[i] for i in np.unique(windows[:, -1])}
+        return model
+
+    def perplexity(self, data):
+        return evaluate_model(self, data)
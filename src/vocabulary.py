@@ -0,0 +1,65 @@
+import numpy as np
+
+# ----------------------------------------------------
+# Token interning and int64 n-gram keys
+# Kept free of model imports so that every layer (packed tables, batch
+# scoring, the smoothing wrappers) can depend on it.
+# ----------------------------------------------------
+class Vocabulary:
+    """Interns tokens to dense integer IDs (shared by all packed models of a run)."""
+    def __init__(self, words=()):
+        self.words = []
+        self.index = {}
+        for w in words:
+            self.add(w)
+
+    def add(self, word):
+        idx = self.index.get(word)
+        if idx is None:
+            idx = len(self.words)
+            self.index[word] = idx
+            self.words.append(word)
+        return idx
+
+    def get(self, word, default=-1):
+        return self.index.get(word, default)
+
+    def lookup(self, tokens):
+        """Encode tokens without interning; unknown tokens map to -1."""
+        return np.fromiter((self.index.get(w, -1) for w in tokens), dtype=np.int64, count=len(tokens))
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, idx):
+        return self.words[idx]
+
+
+def key_bits(vocab_size):
+    """Bits per token when packing IDs into int64 keys."""
+    return max(1, (max(vocab_size, 2) - 1).bit_length())
+
+
+def pack_keys(ids, bits):
+    """Pack an (N, k) ID matrix into N int64 keys, most significant token first."""
+    keys = np.zeros(ids.shape[0], dtype=np.int64)
+    for j in range(ids.shape[1]):
+        keys = (keys << bits) | ids[:, j]
+    return keys
+
+
+def unpack_keys(keys, order, bits):
+    """Inverse of pack_keys: (N,) keys -> (N, order) ID matrix."""
+    ids = np.empty((len(keys), order), dtype=np.int64)
+    mask = (1 << bits) - 1
+    keys = keys.copy()
+    for j in range(order - 1, -1, -1):
+        ids[:, j] = keys & mask
+        keys >>= bits
+    return ids
@@ -0,0 +1,35 @@
+import os
+import sys
+import random
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.ngram_model import NGramModel
+
+# ----------------------------------------------------
+# Shared fixtures: a small Zipf-ish corpus (sentences wrapped in <s> … </s>,
+# as load_data returns them) and dict-based base models of orders 1-4.
+# Test words unseen in training are mapped to <unk>, which training sees once.
+# ----------------------------------------------------
+def _sentences(rng, num, vocab):
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    return [["<s>"] + rng.choices(vocab, weights, k=rng.randint(2, 9)) + ["</s>"] for _ in range(num)]
+
+@pytest.fixture(scope="session")
+def corpus():
+    rng = random.Random(0)
+    train = _sentences(rng, 300, [f"w{i}" for i in range(40)]) + [["<s>", "<unk>", "</s>"]]
+    seen = {w for s in train for w in s}
+    test = [[w if w in seen else "<unk>" for w in s] for s in _sentences(rng, 60, [f"w{i}" for i in range(45)])]
+    return train, test
+
+@pytest.fixture(scope="session")
+def models(corpus):
+    train, _ = corpus
+    models = []
+    for n in (1, 2, 3, 4):
+        m = NGramModel(n)
+        m.train(train)
+        models.append(m.freeze())
+    return models
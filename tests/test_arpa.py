@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from src.arpa import compile_backoff, write_arpa, read_arpa
+from src.batch_scoring import score_batch
+from src.smoothing import KneserNeySmoothing, LinearInterpolation, StupidBackoff
+
+
+CONTEXTS = [("w0",), ("w1", "w0"), ("<s>", "<s>", "w2"), ("w3", "w1", "w0"), ("nope", "w0", "w1")]
+
+
+@pytest.fixture(scope="module")
+def kn(models):
+    return KneserNeySmoothing(models)
+
+
+@pytest.fixture(scope="module")
+def compiled(kn):
+    return compile_backoff(kn)
+
+
+def test_compiled_kneser_ney_is_exact(kn, compiled, corpus):
+    _, test = corpus
+    # log10 values are stored as float32, so "exact" means to float32 precision
+    for context in CONTEXTS:
+        for w in kn.words:
+            assert compiled.prob(context, w) == pytest.approx(kn.prob(context, w), rel=1e-6)
+    np.testing.assert_allclose(score_batch(compiled, test), score_batch(kn, test), rtol=1e-6)
+    assert compiled.perplexity(test) == pytest.approx(kn.perplexity(test))
+
+
+def test_arpa_round_trip(compiled, corpus, tmp_path):
+    _, test = corpus
+    path = tmp_path / "kn.arpa"
+    write_arpa(compiled, str(path))
+    loaded = read_arpa(str(path))
+    assert loaded.n == compiled.n
+    assert loaded.sizes() == compiled.sizes()
+    # ARPA stores log10 values as printed decimals, so compare in log space
+    np.testing.assert_allclose(score_batch(loaded, test), score_batch(compiled, test), atol=1e-5)
+    for context in CONTEXTS:
+        assert loaded.log10_prob(context, "w0") == pytest.approx(compiled.log10_prob(context, "w0"), abs=1e-5)
+
+
+def test_inexact_models_need_approximate(models, corpus):
+    _, test = corpus
+    for model in (LinearInterpolation(models[:3], [0.2, 0.3, 0.5], n=3), StupidBackoff(models[:3][::-1])):
+        with pytest.raises(ValueError):
+            compile_backoff(model)
+        approx = compile_backoff(model, approximate=True)
+        assert np.isfinite(approx.perplexity(test))
@@ -0,0 +1,74 @@
+import math
+import numpy as np
+import pytest
+from src.batch_scoring import EncodedCorpus, score_batch, sentence_logprobs
+from src.evaluate import evaluate_model
+from src.packed_model import PackedNGramModel, Vocabulary
+from src.smoothing import AddOneSmoothing, LinearInterpolation, StupidBackoff, KneserNeySmoothing
+
+
+def _reference_logprobs(model, data):
+    """Per-token log2 p(w | context) through prob(), as evaluate_model used to score."""
+    out = []
+    for sentence in data:
+        padded = ["<s>"] * (model.n - 1) + sentence
+        for i in range(model.n - 1, len(padded)):
+            out.append(math.log2(model.prob(tuple(padded[i - model.n + 1:i]), padded[i])))
+    return np.array(out)
+
+
+def _smoothed(models):
+    ids = Vocabulary()
+    packed = [PackedNGramModel.from_model(m, ids) for m in models]
+    return {
+        "add_one": AddOneSmoothing(models[2]),
+        "add_one_packed": AddOneSmoothing(packed[2]),
+        "interpolation": LinearInterpolation(models[:3], [0.2, 0.3, 0.5], n=3),
+        "interpolation_packed": LinearInterpolation(packed[:3], [0.2, 0.3, 0.5], n=3),
+        "stupid_backoff": StupidBackoff(models[:3][::-1]),
+        "stupid_backoff_packed": StupidBackoff(packed[:3][::-1]),
+        "kneser_ney": KneserNeySmoothing(models),
+        "kneser_ney_packed": KneserNeySmoothing(packed),
+    }
+
+
+@pytest.fixture(scope="module")
+def smoothed(models):
+    return _smoothed(models)
+
+
+NAMES = ["add_one", "interpolation", "stupid_backoff", "kneser_ney"]
+
+
+@pytest.mark.parametrize("name", NAMES + [name + "_packed" for name in NAMES])
+def test_batch_matches_per_token(smoothed, corpus, name):
+    _, test = corpus
+    model = smoothed[name]
+    expected = _reference_logprobs(model, test)
+    np.testing.assert_allclose(score_batch(model, test), expected, rtol=1e-9)
+    assert evaluate_model(model, test) == pytest.approx(2.0 ** -expected.mean())
+
+
+def test_packed_and_dict_scores_agree(smoothed, corpus):
+    _, test = corpus
+    for name in NAMES:
+        np.testing.assert_allclose(score_batch(smoothed[name + "_packed"], test),
+                                   score_batch(smoothed[name], test), rtol=1e-9)
+
+
+def test_sentence_logprobs_sum_token_scores(smoothed, corpus):
+    _, test = corpus
+    model = smoothed["kneser_ney"]
+    sums, lengths = sentence_logprobs(model, test)
+    assert list(lengths) == [len(s) for s in test]
+    np.testing.assert_allclose(sums.sum(), score_batch(model, test).sum())
+
+
+def test_encoded_corpus_reuse(smoothed, corpus):
+    _, test = corpus
+    model = smoothed["interpolation"]
+    encoded = EncodedCorpus(test, model.n)
+    first = score_batch(model, encoded)
+    np.testing.assert_array_equal(score_batch(model, encoded), first)
+    head = encoded.head(10)
+    np.testing.assert_allclose(score_batch(model, head), score_batch(model, test[:10]))
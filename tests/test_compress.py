@@ -0,0 +1,82 @@
+import csv
+import numpy as np
+import pytest
+from src.arpa import compile_backoff
+from src.compress import prune_counts, entropy_prune, quantize, compression_report
+from src.model_io import save_packed_models
+from src.packed_model import PackedNGramModel, Vocabulary, unpack_keys
+from src.smoothing import KneserNeySmoothing
+
+
+CONTEXTS = [(), ("w0",), ("w1", "w0"), ("<s>", "<s>", "w2"), ("w3", "w1", "w0")]
+
+
+def _grams(model, n):
+    words = model.ids.words
+    return {tuple(words[i] for i in row) for row in unpack_keys(model.orders[n][0], n, model.bits)}
+
+
+def _assert_normalised(model, vocab):
+    for context in CONTEXTS:
+        assert sum(model.prob(context, w) for w in vocab) == pytest.approx(1.0, abs=1e-4)
+
+
+@pytest.fixture(scope="module")
+def kn(models):
+    return KneserNeySmoothing(models)
+
+
+@pytest.fixture(scope="module")
+def compiled(kn):
+    return compile_backoff(kn)
+
+
+def test_prune_counts_drops_rare_ngrams(kn, compiled, models):
+    pruned = prune_counts(compiled, {3: 2, 4: 2}, kn.models)
+    for n in (3, 4):
+        kept = _grams(pruned, n)
+        assert len(kept) < len(_grams(compiled, n))
+        higher = _grams(pruned, n + 1) if n < 4 else set()
+        for gram in _grams(compiled, n):
+            c = models[n - 1].count(gram[:-1], gram[-1])
+            if c >= 2:
+                assert gram in kept
+            elif gram in kept:
+                assert any(h[:-1] == gram for h in higher)  # kept only as a prefix
+    _assert_normalised(pruned, kn.words)
+
+
+def test_entropy_prune_shrinks_with_threshold(compiled, kn, corpus):
+    _, test = corpus
+    entries = [sum(compiled.sizes().values())]
+    for threshold in (1e-6, 1e-4, 1e-2):
+        pruned = entropy_prune(compiled, threshold)
+        entries.append(sum(pruned.sizes().values()))
+        assert pruned.sizes()[1] == compiled.sizes()[1]
+        assert np.isfinite(pruned.perplexity(test))
+        _assert_normalised(pruned, kn.words)
+    assert entries == sorted(entries, reverse=True)
+    assert entries[-1] < entries[0]
+
+
+@pytest.mark.parametrize("bits, tol", [(16, 1e-3), (8, 0.1)])
+def test_quantize_stays_close(compiled, corpus, bits, tol):
+    _, test = corpus
+    quantized = quantize(compiled, bits)
+    assert quantized.nbytes < compiled.nbytes
+    assert quantized.sizes() == compiled.sizes()
+    assert quantized.perplexity(test) == pytest.approx(compiled.perplexity(test), rel=tol)
+
+
+def test_compression_report(models, corpus, tmp_path):
+    _, test = corpus
+    base = tmp_path / "base"
+    ids = Vocabulary()
+    save_packed_models([PackedNGramModel.from_model(m, ids) for m in models], str(base))
+    path = tmp_path / "report.csv"
+    rows = compression_report(models, test, thresholds=(0, 1e-6), quant_bits=(None, 8),
+                              path=str(path), base_path=str(base))
+    assert len(rows) == 2 * 2 * 2
+    assert rows[0]["size_ratio"] == 1.0 and rows[0]["pp_delta"] == 0.0
+    with open(path, newline="") as f:
+        assert [r["bytes"] for r in csv.DictReader(f)] == [str(r["bytes"]) for r in rows]
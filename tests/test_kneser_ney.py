@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from src.ngram_model import NGramModel
+from src.smoothing import KneserNeySmoothing
+
+
+CONTEXTS = [(), ("w0",), ("<s>", "<s>", "<s>"), ("w1", "w0", "w2"), ("<s>", "w3", "w0"), ("nope", "nope", "w0")]
+
+
+@pytest.fixture(scope="module")
+def kn(models):
+    return KneserNeySmoothing(models)
+
+
+@pytest.mark.parametrize("context", CONTEXTS)
+def test_distribution_sums_to_one(kn, context):
+    dist = kn.next_word_distribution(context)
+    assert len(dist) == len(kn.words)
+    assert dist.sum() == pytest.approx(1.0)
+    assert (dist > 0).all()
+
+
+@pytest.mark.parametrize("context", CONTEXTS)
+def test_distribution_matches_prob(kn, context):
+    dist = kn.next_word_distribution(context)
+    np.testing.assert_allclose(dist, [kn.prob(context, w) for w in kn.words], rtol=1e-12)
+
+
+def test_stacked_distributions_match(kn):
+    np.testing.assert_allclose(kn.next_word_distributions(CONTEXTS),
+                               np.vstack([kn.next_word_distribution(c) for c in CONTEXTS]))
+
+
+def test_update_rebuilds(corpus):
+    train, test = corpus
+    half = len(train) // 2
+    base = []
+    for n in (1, 2, 3):
+        m = NGramModel(n)
+        m.train(train[:half])
+        base.append(m)
+    kn = KneserNeySmoothing(base)
+    kn.next_word_distribution(("w0", "w1"))  # populate the cache before updating
+    kn.update(train[half:])
+    full = []
+    for n in (1, 2, 3):
+        m = NGramModel(n)
+        m.train(train)
+        full.append(m)
+    expected = KneserNeySmoothing(full)
+    np.testing.assert_allclose(kn.next_word_distribution(("w0", "w1")),
+                               expected.next_word_distribution(("w0", "w1")))
+    assert kn.perplexity(test) == pytest.approx(expected.perplexity(test))
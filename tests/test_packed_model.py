@@ -0,0 +1,48 @@
+import pytest
+from src.ngram_model import NGramModel
+from src.packed_model import PackedNGramModel, Vocabulary
+from src.model_io import save_packed_models, load_packed_models
+
+
+def _ngrams(model):
+    return {(context, word): c for context, successors in model.counts.items() for word, c in successors.items() if c}
+
+
+@pytest.mark.parametrize("order", [1, 2, 3, 4])
+def test_packed_counts_match_dict(models, order):
+    m = models[order - 1]
+    packed = PackedNGramModel.from_model(m)
+    assert packed.vocab == m.vocab
+    for (context, word), c in _ngrams(m).items():
+        assert packed.count(context, word) == c
+        assert packed.context_total(context) == m.context_total(context)
+        assert packed.prob(context, word) == pytest.approx(m.prob(context, word))
+
+
+def test_packed_training_matches_conversion(corpus, models):
+    train, _ = corpus
+    ids = Vocabulary()
+    for m in models:
+        trained = PackedNGramModel(m.n, ids)
+        trained.train(train)
+        assert {(c, w): trained.count(c, w) for c, w in _ngrams(m)} == _ngrams(m)
+        assert len(trained.table.keys) == len(_ngrams(m))
+
+
+def test_unseen_lookups_read_zero(models):
+    packed = PackedNGramModel.from_model(models[2])
+    assert packed.count(("nope", "w1"), "w2") == 0
+    assert packed.context_total(("nope", "w1")) == 0
+    assert packed.prob(("nope", "w1"), "w2") == 0.0
+
+
+def test_binary_round_trip(tmp_path, corpus, models):
+    _, test = corpus
+    ids = Vocabulary()
+    packed = [PackedNGramModel.from_model(m, ids) for m in models]
+    save_packed_models(packed, str(tmp_path / "base"))
+    loaded = load_packed_models(str(tmp_path / "base"))
+    for original, m in zip(packed, loaded):
+        assert m.n == original.n
+        assert m.vocab == original.vocab
+        assert m.perplexity(test) == pytest.approx(original.perplexity(test))
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from src.batch_scoring import score_batch
+from src.ngram_model import NGramModel
+from src.smoothing import LinearInterpolation, StupidBackoff
+from src.suffix_array import SuffixArrayIndex, suffix_array
+
+
+ORDERS = [1, 2, 3, 4, 5]
+
+
+def _ngrams(model):
+    return {(context, word): c for context, successors in model.counts.items() for word, c in successors.items() if c}
+
+
+def _dict_model(train, n):
+    m = NGramModel(n)
+    m.train(train)
+    return m
+
+
+@pytest.fixture(scope="module")
+def index(corpus):
+    train, _ = corpus
+    return SuffixArrayIndex(train)
+
+
+def test_suffix_array_sorts_suffixes():
+    text = np.array([3, 1, 2, 1, 2, 1, 0], dtype=np.int32)
+    sa = suffix_array(text)
+    suffixes = [tuple(text[i:]) for i in sa]
+    assert sorted(range(len(text)), key=lambda i: tuple(text[i:])) == list(sa)
+    assert suffixes == sorted(suffixes)
+
+
+def _lookup(index, grams, n):
+    """Vectorised (counts, context totals) of `grams` at order n."""
+    rows = np.array([[index.ids.index.get(w, -1) for w in context + (word,)] for context, word in grams],
+                    dtype=np.int64).reshape(len(grams), n)
+    return index.lookup(rows[:, :-1], rows[:, -1])[-1]
+
+
+@pytest.mark.parametrize("n", ORDERS)
+def test_counts_match_ngram_model(index, corpus, n):
+    train, _ = corpus
+    expected = _dict_model(train, n)
+    grams = _ngrams(expected)
+    counts, totals = _lookup(index, list(grams), n)
+    assert list(counts) == list(grams.values())
+    assert list(totals) == [expected.context_total(context) for context, _ in grams]
+    # The scalar NGramModel-style interface, on a sample
+    model = index.model(n)
+    for context, word in list(grams)[:20]:
+        assert model.count(context, word) == grams[context, word]
+        assert model.context_total(context) == expected.context_total(context)
+    if n > 1:
+        assert model.count(("nope",) * (n - 1), "w0") == 0
+        assert model.context_total(("nope",) * (n - 1)) == 0
+
+
+@pytest.mark.parametrize("n", ORDERS)
+def test_packed_matches_ngram_model(index, corpus, n):
+    train, _ = corpus
+    expected = _ngrams(_dict_model(train, n))
+    size = len(index.ids)
+    packed = index.model(n).packed()
+    assert len(index.ids) == size  # the shared vocabulary is left alone
+    assert len(packed.table.keys) == len(expected)
+    assert {key: packed.count(*key) for key in expected} == expected
+
+
+def test_batch_scoring_matches_prob(index, corpus):
+    _, test = corpus
+    test = test[:10]  # prob() runs one suffix-array search per call
+    models = index.models([1, 2, 3])
+    for model in (LinearInterpolation(models, [0.2, 0.3, 0.5], n=3), StupidBackoff(models[::-1])):
+        expected = [np.log2(model.prob(tuple((["<s>"] * 2 + s)[i:i + 2]), w))
+                    for s in test for i, w in enumerate(s)]
+        np.testing.assert_allclose(score_batch(model, test), expected, rtol=1e-9)
+
+
+def test_update_matches_retraining(corpus):
+    train, test = corpus
+    half = len(train) // 2
+    grown = SuffixArrayIndex(train[:half])
+    version = grown.version
+    grown.update(train[half:])
+    assert grown.version > version
+    full = SuffixArrayIndex(train)
+    np.testing.assert_array_equal(grown.text, full.text)
+    for n in (2, 4):
+        grams = _ngrams(_dict_model(train, n))
+        assert list(_lookup(grown, list(grams), n)[0]) == list(grams.values())